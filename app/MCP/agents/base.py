@@ -2,14 +2,52 @@
 
 # All agents are represented as a function that is called with specific parameters. 
 
+import asyncio
+import json
+import time
+from functools import partial
 from typing import Optional, Type, TypeVar
+from pydantic import BaseModel, TypeAdapter, ValidationError
 from mcp_agent.agents.agent import Agent
 from mcp_agent.workflows.llm.augmented_llm_ollama import OllamaAugmentedLLM
 
+from MCP.cassette import get_cassette
+from MCP.limiter import is_congestion_error, llm_limiter
+from MCP.logprob_scoring import logprob_score
+from MCP.ollama import DEFAULT_MODEL, backend_pool, llm_http_client, logprob_agents, streaming_agents
+from MCP.prompt import count_tokens, record_token_usage
+from MCP.speculation import current_attempt
+
+
+def _context_for_backend(context, base_url: str, agent_name: str):
+    """ Returns a copy of the mcp_agent context that sends all LLM calls to the given Ollama backend,
+    over the shared async connection pool with the timeouts of the agent (see MCP.ollama).
+    The library reads both from the shared config, so each call gets its own shallow copy with them replaced."""
+    openai_config = context.config.openai.model_copy(update={
+        "base_url": base_url + "/v1",
+        "http_client": llm_http_client(agent_name),
+    })
+    config = context.config.model_copy(update={"openai": openai_config})
+    return context.model_copy(update={"config": config})
+
+
+class _SharedCall:
+    """ A running call and the number of callers waiting for it."""
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+# The calls that are currently running, keyed by (agent name, model, prompt, output type, attempt). See run_basic_ollama_agent.
+# The attempt number (see MCP.speculation) keeps a backup attempt from just joining the call it is supposed to back up.
+_in_flight: dict[tuple[str, Optional[str], str, object, int], _SharedCall] = {}
+
 
 T = TypeVar("T")
 async def run_basic_ollama_agent(name: str, prompt: str, server_list: list[str], custom_llm: Optional[str] = None, output_type: Type[T] = str) -> Optional[T]:
     """ A basic agents that runs a prompt with the default (or specific) LLM and the given MCP servers.
+    If the exact same call is already running (e.g. the same paper is scored for the same question by two requests),
+    no new call is made; instead, the result of the running call is shared.
     Args:
         name (str): The name of the agent.
         prompt (str): The prompt to run, already formatted.
@@ -17,19 +55,150 @@ async def run_basic_ollama_agent(name: str, prompt: str, server_list: list[str],
         custom_llm (Optional[str]): A custom LLM to use instead of the default.
         Returns: the response from the agent as type T or None if the agent failed."""
 
+    key = (name, custom_llm, prompt, output_type, current_attempt.get())
+    call = _in_flight.get(key)
+    if call is None:
+        call = _SharedCall(asyncio.create_task(_run_ollama_agent(name, prompt, server_list, custom_llm, output_type)))
+        _in_flight[key] = call
+        call.task.add_done_callback(lambda _: _in_flight.pop(key, None))
+
+    call.waiters += 1
+    try:
+        # The shield makes sure that cancelling one waiter (e.g. because its request was aborted) doesn't cancel the call for the others.
+        return await asyncio.shield(call.task)
+    except asyncio.CancelledError:
+        # If nobody is waiting anymore, the call is cancelled as well, so it gives its concurrency slot back right away.
+        if call.waiters == 1:
+            call.task.cancel()
+            _in_flight.pop(key, None)
+        raise
+    finally:
+        call.waiters -= 1
+
+
+async def _run_ollama_agent(name: str, prompt: str, server_list: list[str], custom_llm: Optional[str], output_type: Type[T]) -> Optional[T]:
+    """ Runs the agent, or, in replay mode, serves its result from the cassette. In record mode, the call is written to the cassette (see MCP.cassette)."""
+    cassette = get_cassette()
+    if cassette is not None and cassette.mode == "replay":
+        return await cassette.replay(name, custom_llm, prompt, output_type)
+
+    start = time.perf_counter()
+    # The adaptive limiter decides how many calls may run at once (see MCP.limiter).
+    try:
+        async with llm_limiter.slot():
+            if name in logprob_agents:
+                # A single decoded token, the score comes from its probabilities.
+                result, completion_tokens = await logprob_score(name, prompt, custom_llm), 1
+            elif name in streaming_agents and not server_list:
+                result, completion_tokens = await _stream_ollama_agent(name, prompt, custom_llm, output_type, streaming_agents[name])
+            else:
+                result, completion_tokens = await _call_ollama_agent(name, prompt, server_list, custom_llm, output_type), None
+    except Exception as e:
+        # Only timeouts and connection problems get here, the limiter counted them as congestion.
+        # Everything else (like an answer that doesn't parse) was already turned into None by the calls.
+        print(f"Error running agent {name}: {e}")
+        result, completion_tokens = None, None
+    latency = time.perf_counter() - start
+    record_token_usage(name, custom_llm, prompt, latency, completion_tokens)
+    if cassette is not None:
+        cassette.record(name, custom_llm, prompt, output_type, result, latency)
+    return result
+
+
+async def _call_ollama_agent(name: str, prompt: str, server_list: list[str], custom_llm: Optional[str], output_type: Type[T]) -> Optional[T]:
+    """ Actually runs the agent, on the least loaded Ollama backend of the pool (see MCP.ollama)."""
+
     try: 
         agent = Agent(name=name, instruction=prompt, server_names=server_list)
         async with agent:
-            if custom_llm:
-                llm = await agent.attach_llm(lambda:
-                        OllamaAugmentedLLM( 
-                    default_model=custom_llm,
+            model = custom_llm or agent.context.config.openai.default_model
+            async with backend_pool.backend(model) as backend:
+                llm = await agent.attach_llm(partial(
+                    OllamaAugmentedLLM,
+                    default_model=model,
+                    context=_context_for_backend(agent.context, backend.base_url, name),
                 ))
-            else:
-                llm = await agent.attach_llm(OllamaAugmentedLLM)
-            # llm is now definetly defined. 
-            response = await llm.generate_structured(prompt, response_model=output_type)
-            return response
+                # llm is now definetly defined. 
+                response = await llm.generate_structured(prompt, response_model=output_type)
+                return response
+    except Exception as e:
+        if is_congestion_error(e):
+            raise  # For the limiter, see _run_ollama_agent.
+        print(f"Error running agent {name}: {e}")
+        return None
+
+
+_decoder = json.JSONDecoder()
+
+
+def _response_format(output_type: Type[T]) -> tuple[dict, bool]:
+    """ Returns the JSON schema that constrains the answer of a streaming agent, and whether the value is wrapped.
+    Everything that is not a model (like a float) is wrapped in an object {"value": ...}, so the end of the answer
+    is always a closing brace. A bare number could still go on: "0.8" might become "0.85"."""
+    schema = TypeAdapter(output_type).json_schema()
+    if isinstance(output_type, type) and issubclass(output_type, BaseModel):
+        return schema, False
+    definitions = schema.pop("$defs", None)
+    wrapped = {"type": "object", "properties": {"value": schema}, "required": ["value"]}
+    if definitions:
+        wrapped["$defs"] = definitions
+    return wrapped, True
+
+
+async def _stream_ollama_agent(name: str, prompt: str, custom_llm: Optional[str], output_type: Type[T], think: bool) -> tuple[Optional[T], Optional[int]]:
+    """ Runs the prompt over the streaming chat API of Ollama, with the answer constrained to the schema of the output type.
+    The stream is read until the first complete JSON value, then closed, which stops the generation on the server,
+    so nothing the model might add after the answer is waited for.
+    Returns the result (None if the agent failed) and the number of generated tokens."""
+    model = custom_llm or DEFAULT_MODEL
+    response_format, wrapped = _response_format(output_type)
+    text = ""
+    thinking = ""
+    eval_count: Optional[int] = None  # Ollama only reports the generated tokens in the last chunk, which is rarely read.
+
+    def generated_tokens() -> int:
+        # A chunk is not always a single token, so without the count of Ollama, the received text is counted with the tokenizer.
+        return eval_count if eval_count is not None else count_tokens(thinking + text, model)
+    try:
+        async with backend_pool.backend(model) as backend:
+            request = {
+                "model": model,
+                "messages": [{"role": "user", "content": prompt}],
+                "format": response_format,
+                "think": think,
+                "stream": True,
+            }
+            async with llm_http_client(name).stream("POST", backend.base_url + "/api/chat", json=request) as response:
+                response.raise_for_status()
+                # Every line is one chunk of the answer.
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if "error" in chunk:
+                        raise RuntimeError(chunk["error"])
+                    message = chunk.get("message", {})
+                    thinking += message.get("thinking", "")
+                    text += message.get("content", "")
+                    if chunk.get("done"):
+                        eval_count = chunk.get("eval_count")
+                    try:
+                        value, _ = _decoder.raw_decode(text.lstrip())
+                        break  # The answer is complete, leaving the with block closes the stream.
+                    except json.JSONDecodeError:
+                        pass
+                    if chunk.get("done"):
+                        raise ValueError(f"The answer ended before it was complete: {text!r}")
+                else:
+                    raise ValueError(f"The stream ended before the answer was complete: {text!r}")
+        if wrapped:
+            value = value["value"]
+        return TypeAdapter(output_type).validate_python(value), generated_tokens()
+    except (ValidationError, TypeError, KeyError) as e:
+        print(f"Error running agent {name}: invalid answer {text!r}: {e}")
+        return None, generated_tokens()
     except Exception as e:
+        if is_congestion_error(e):
+            raise  # For the limiter, see _run_ollama_agent.
         print(f"Error running agent {name}: {e}")
-        return None
\ No newline at end of file
+        return None, generated_tokens()
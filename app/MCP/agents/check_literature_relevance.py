@@ -1,28 +1,99 @@
-from typing import List, Optional
+from typing import Optional
 from .base import run_basic_ollama_agent
-from MCP.types import Article, RequestStatus, StepInformation
+from MCP.clustering import papers_to_score, propagate_cluster_scores
+from MCP.limiter import run_concurrently
+from MCP.logprob_scoring import engine_fingerprint
+from MCP.memo import memoized
+from MCP.prompt import build_prompt
+from MCP.speculation import run_speculatively
+from MCP.types import Article, RequestStages, RequestStatus, StepInformation
 
 
 async def run_check_literature_relevance_agent(
-    article: Article, research_question: str
+    article: Article,
+    research_question: str,
+    engine: str = "generate",
+    custom_llm: Optional[str] = None,
 ) -> Optional[float]:
     """This agent receives an article and a research question and returns an estimated relevance score for the article between 0 and 1.
     The higher the score, the more relevant the article is to the research question.
+    With the "logprob" engine, the score is read from the token probabilities instead (see MCP.logprob_scoring).
     """
 
-    prompt = f"""
+    if engine == "logprob":
+        return await run_check_literature_relevance_logprob_agent(
+            article, research_question, custom_llm
+        )
+
+    # The abstract is the only part that can get long, so it is shortened if the prompt is over the budget.
+    prompt = build_prompt(
+        "check_literature_relevance_agent",
+        """
 You are a professional research assistant. Given a research question and an article, you need to estimate the relevance of the article to the research question.
 Only based on the title, abstract and author of the article, return a score between 0 and 1 for the relevance of the article to the research question.
 
 research question: {research_question}
 
-Article: {article.title} by {article.author}
-Abstract: {article.abstract}
-"""
+Article: {title} by {author}
+Abstract: {abstract}
+""",
+        trimmable=("abstract",),
+        model=custom_llm,
+        research_question=research_question,
+        title=article.title,
+        author=article.author,
+        abstract=article.abstract,
+    )
     return await run_basic_ollama_agent(
-        name="relevant_literature_agent",
+        name="check_literature_relevance_agent",
         prompt=prompt,
         server_list=[],
+        custom_llm=custom_llm,
+        output_type=float,
+    )
+
+
+def check_literature_relevance_logprob_prompt(
+    article: Article, research_question: str, custom_llm: Optional[str] = None
+) -> str:
+    """The prompt of the logprob agent, also used to calibrate its scores (see MCP.calibrate_relevance)."""
+
+    return build_prompt(
+        "check_literature_relevance_logprob_agent",
+        """
+You are a professional research assistant. Given a research question and an article, you need to rate the relevance of the article to the research question.
+Only based on the title, abstract and author of the article, rate the relevance with a single digit from 0 to 9, where 0 means not relevant at all and 9 means highly relevant.
+
+research question: {research_question}
+
+Article: {title} by {author}
+Abstract: {abstract}
+
+Answer with the digit only.
+""",
+        trimmable=("abstract",),
+        model=custom_llm,
+        research_question=research_question,
+        title=article.title,
+        author=article.author,
+        abstract=article.abstract,
+    )
+
+
+async def run_check_literature_relevance_logprob_agent(
+    article: Article, research_question: str, custom_llm: Optional[str] = None
+) -> Optional[float]:
+    """Like run_check_literature_relevance_agent, but the model only answers with a single digit,
+    and the score is computed from the probabilities of the digits.
+    """
+
+    return await run_basic_ollama_agent(
+        name="check_literature_relevance_logprob_agent",
+        prompt=check_literature_relevance_logprob_prompt(
+            article, research_question, custom_llm
+        ),
+        server_list=[],
+        custom_llm=custom_llm,
         output_type=float,
     )
 
@@ -39,33 +110,34 @@ async def run_single_check_literature_relevance_agent(
     # Because we can't modify the request status in place, we need to modify it outside of the loop.
     to_change: Optional[tuple[int, float]] = None
 
-    for i, (article, relevance) in enumerate(request_status.papers):
-        # Only if the relevance is None, we need to check it.
-        if relevance is None:
-            # Run the agent on the article.
-            relevance = await run_check_literature_relevance_agent(
-                article, request_status.settings.research_question
+    # Only the scores are iterated, the article itself is only loaded once its relevance needs to be checked.
+    # If the papers are clustered, only the representatives are checked (see MCP.clustering).
+    for i in papers_to_score(request_status):
+        article = request_status.get_paper(i)
+        # Run the agent on the article.
+        relevance = await run_check_literature_relevance_agent(
+            article,
+            request_status.settings.research_question,
+            request_status.settings.relevance_engine,
+        )
+        if relevance is not None and isinstance(relevance, float):
+            to_change = (i, relevance)
+            break  # We found an article to change, so we can break the loop.
+        elif isinstance(relevance, Exception):
+            step_info.add_error(
+                f"Error checking relevance of paper {article.title}: {relevance}"
+            )
+            continue
+        else:
+            step_info.add_error(
+                f"Error checking relevance of paper {article.title}, skipping."
             )
-            if relevance is not None and isinstance(relevance, float):
-                to_change = (i, relevance)
-                break  # We found an article to change, so we can break the loop.
-            elif isinstance(relevance, Exception):
-                step_info.add_error(
-                    f"Error checking relevance of paper {article.title}: {relevance}"
-                )
-                continue
-            else:
-                step_info.add_error(
-                    f"Error checking relevance of paper {article.title}, skipping."
-                )
-
-        # If the relevance is already set, we can skip it.
+
     if to_change is not None:
         # Update the request status with the new relevance score.
-        request_status.papers[to_change[0]] = (
-            request_status.papers[to_change[0]][0],
-            to_change[1],
-        )
+        request_status.set_paper_relevance(to_change[0], to_change[1])
+        # If that was the last representative of its cluster, the rest of the cluster gets its score now.
+        propagate_cluster_scores(request_status)
 
     return (request_status, step_info)  # Return the updated request status.
 
@@ -76,33 +148,69 @@ async def run_all_check_literature_relevance_agent(
     """Run the check_literature_relevance agent on all articles in the request status."""
 
     step_info = StepInformation()
-    to_change: List[tuple[int, float]] = []
-
-    for i, (article, relevance) in enumerate(request_status.papers):
-        # Only if the relevance is None, we need to check it.
-        if relevance is None:
-            # Run the agent on the article.
-            relevance = await run_check_literature_relevance_agent(
-                article, request_status.settings.research_question
+
+    # Only if the relevance is None, we need to check it.
+    # If the papers are clustered, only the representatives are checked (see MCP.clustering).
+    to_check = papers_to_score(request_status)
+
+    async def check(i: int) -> Optional[float]:
+        # The article is only loaded once its check actually starts.
+        article = request_status.get_paper(i)
+        # The score only depends on the article and the research question, so it is reused if it was checked before.
+        return await memoized(
+            request_status,
+            RequestStages.CHECKING_LITERATURE_RELEVANCE,
+            (
+                request_status.settings.research_question,
+                article.model_dump(),
+                engine_fingerprint(
+                    request_status.settings.relevance_engine,
+                    "check_literature_relevance_logprob_agent",
+                ),
+            ),
+            float,
+            lambda: run_speculatively(
+                "check_literature_relevance_agent",
+                lambda: run_check_literature_relevance_agent(
+                    article,
+                    request_status.settings.research_question,
+                    request_status.settings.relevance_engine,
+                ),
+                request_status.settings.max_attempts,
+            ),
+        )
+
+    def apply(i: int, relevance: Optional[float]):
+        # Every score is written as soon as it is known, so a stage that is cut off by the deadline keeps the finished ones.
+        if relevance is not None and isinstance(relevance, float):
+            request_status.set_paper_relevance(i, relevance)
+
+    # All articles are checked concurrently, as far as the limiter allows it.
+    results = await run_concurrently(to_check, check, apply)
+
+    changed = 0
+    for i, relevance in zip(to_check, results):
+        if relevance is not None and isinstance(relevance, float):
+            changed += 1
+        elif isinstance(relevance, Exception):
+            step_info.add_error(
+                f"Error checking relevance of paper {request_status.get_paper(i).title}: {relevance}"
+            )
+        else:
+            step_info.add_error(
+                f"Error checking relevance of paper {request_status.get_paper(i).title}, skipping."
             )
-            if relevance is not None and isinstance(relevance, float):
-                to_change.append((i, relevance))
-            elif isinstance(relevance, Exception):
-                step_info.add_error(
-                    f"Error checking relevance of paper {article.title}: {relevance}"
-                )
-                continue
-            else:
-                step_info.add_error(
-                    f"Error checking relevance of paper {article.title}, skipping."
-                )
-
-    # Update the request status with the new relevance scores.
-    for i, relevance in to_change:
-        request_status.papers[i] = (request_status.papers[i][0], relevance)
-    else:
+
+    if not changed:
         step_info.add_warning("No more papers to check relevance for.")
 
+    # The other papers of the clusters get the scores of their representatives.
+    propagated = propagate_cluster_scores(request_status)
+    if propagated:
+        step_info.add_warning(
+            f"Gave {propagated} papers the relevance score of their cluster instead of checking them."
+        )
+
     return (
         request_status,
         step_info,
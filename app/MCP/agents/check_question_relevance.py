@@ -1,25 +1,83 @@
 from typing import Optional
 
-from MCP.types import RequestStatus, StepInformation
+from MCP.types import RequestStages, RequestStatus, StepInformation
 from .base import run_basic_ollama_agent
+from MCP.limiter import run_concurrently
+from MCP.logprob_scoring import engine_fingerprint
+from MCP.prompt import build_prompt
+from MCP.memo import memoized
+from MCP.speculation import run_speculatively
 
 
 async def run_check_question_relevance_agent(
-    question: str, research_question: str
+    question: str,
+    research_question: str,
+    engine: str = "generate",
+    custom_llm: Optional[str] = None,
 ) -> Optional[float]:
     """This agent receives a question and a research question and returns an estimated relevance score for the question between 0 and 1.
     The higher the score, the more relevant the question is to the research question.
+    With the "logprob" engine, the score is read from the token probabilities instead (see MCP.logprob_scoring).
     """
 
-    prompt = f"""
+    if engine == "logprob":
+        return await run_check_question_relevance_logprob_agent(
+            question, research_question, custom_llm
+        )
+
+    prompt = build_prompt(
+        "check_question_relevance_agent",
+        """
 You are a professional research assistant. Given a research question and another question, which will be asked in a survey, you need to estimate the relevance of the question to the research question.
 Only based on the content of the question, return a score between 0 and 1 for the relevance of the question to the research question.
 Research question: {research_question}
-Question: {question}"""
+Question: {question}""",
+        model=custom_llm,
+        research_question=research_question,
+        question=question,
+    )
     return await run_basic_ollama_agent(
         name="check_question_relevance_agent",
         prompt=prompt,
         server_list=[],
+        custom_llm=custom_llm,
+        output_type=float,
+    )
+
+
+def check_question_relevance_logprob_prompt(
+    question: str, research_question: str, custom_llm: Optional[str] = None
+) -> str:
+    """The prompt of the logprob agent, also used to calibrate its scores (see MCP.calibrate_relevance)."""
+
+    return build_prompt(
+        "check_question_relevance_logprob_agent",
+        """
+You are a professional research assistant. Given a research question and another question, which will be asked in a survey, you need to rate the relevance of the question to the research question.
+Only based on the content of the question, rate the relevance with a single digit from 0 to 9, where 0 means not relevant at all and 9 means highly relevant.
+Research question: {research_question}
+Question: {question}
+Answer with the digit only.""",
+        model=custom_llm,
+        research_question=research_question,
+        question=question,
+    )
+
+
+async def run_check_question_relevance_logprob_agent(
+    question: str, research_question: str, custom_llm: Optional[str] = None
+) -> Optional[float]:
+    """Like run_check_question_relevance_agent, but the model only answers with a single digit,
+    and the score is computed from the probabilities of the digits.
+    """
+
+    return await run_basic_ollama_agent(
+        name="check_question_relevance_logprob_agent",
+        prompt=check_question_relevance_logprob_prompt(
+            question, research_question, custom_llm
+        ),
+        server_list=[],
+        custom_llm=custom_llm,
         output_type=float,
     )
 
@@ -41,7 +99,9 @@ async def run_single_check_question_relevance_agent(
         if relevance is None:
             # Run the agent on the question.
             relevance = await run_check_question_relevance_agent(
-                question.question, request_status.settings.research_question
+                question.question,
+                request_status.settings.research_question,
+                request_status.settings.relevance_engine,
             )
             if relevance is not None and isinstance(relevance, float):
                 to_change = (i, relevance)
@@ -74,29 +134,67 @@ async def run_all_check_question_relevance_agent(
     """
 
     step_info = StepInformation()
+    if (
+        request_status.settings.fuse_question_stages
+        and request_status.settings.relevance_engine == "logprob"
+    ):
+        # See next_step in MCP.steps, the fused stage can't give logprob scores.
+        step_info.add_warning(
+            "fuse_question_stages has no effect with the logprob relevance engine, the questions are scored and formatted separately."
+        )
+
+    to_check = [
+        i
+        for i, (_, relevance) in enumerate(request_status.questions)
+        if relevance is None
+    ]
+
+    def apply(i: int, relevance: Optional[float]):
+        # Every score is written as soon as it is known, so a stage that is cut off by the deadline keeps the finished ones.
+        if relevance is not None and isinstance(relevance, float):
+            request_status.questions[i] = (request_status.questions[i][0], relevance)
+
+    # Run the agent on all questions concurrently, as far as the limiter allows it.
+    results = await run_concurrently(
+        to_check,
+        lambda i: memoized(
+            request_status,
+            RequestStages.CHECKING_QUESTION_RELEVANCE,
+            (
+                request_status.settings.research_question,
+                request_status.questions[i][0].question,
+                engine_fingerprint(
+                    request_status.settings.relevance_engine,
+                    "check_question_relevance_logprob_agent",
+                ),
+            ),
+            float,
+            lambda: run_speculatively(
+                "check_question_relevance_agent",
+                lambda: run_check_question_relevance_agent(
+                    request_status.questions[i][0].question,
+                    request_status.settings.research_question,
+                    request_status.settings.relevance_engine,
+                ),
+                request_status.settings.max_attempts,
+            ),
+        ),
+        apply,
+    )
 
-    to_change: Optional[tuple[int, float]] = None
-
-    for i, (question, relevance) in enumerate(request_status.questions):
-        if relevance is None:
-            # Run the agent on the question.
-            relevance = await run_check_question_relevance_agent(
-                question.question, request_status.settings.research_question
+    changed = 0
+    for i, relevance in zip(to_check, results):
+        question = request_status.questions[i][0]
+        if relevance is not None and isinstance(relevance, float):
+            changed += 1
+        elif isinstance(relevance, Exception):
+            step_info.add_error(
+                f"Error checking relevance of question {question.question}: {relevance}"
             )
-            if relevance is not None and isinstance(relevance, float):
-                to_change = (i, relevance)
-            elif isinstance(relevance, Exception):
-                step_info.add_error(
-                    f"Error checking relevance of question {question.question}: {relevance}"
-                )
-            else:
-                step_info.add_error(
-                    f"Error checking relevance of question {question.question}, skipping."
-                )
-    # If we found questions to change, we update the request status.
-    if to_change is not None:
-        i, relevance = to_change
-        request_status.questions[i] = (request_status.questions[i][0], relevance)
-    else:
+        else:
+            step_info.add_error(
+                f"Error checking relevance of question {question.question}, skipping."
+            )
+    if not changed:
         step_info.add_warning("No more questions to check relevance for.")
     return (request_status, step_info)
@@ -0,0 +1,44 @@
+import asyncio
+
+from MCP.clustering import cluster_vectors, embed_papers
+from MCP.types import RequestStatus, StepInformation
+
+
+async def run_single_cluster_literature(
+    request_status: RequestStatus,
+) -> tuple[RequestStatus, StepInformation]:
+    """Dummy function to keep the interface consistent.
+    k-means needs all papers at once, so clustering them one at a time is not possible.
+    """
+
+    request_status, step_info = await run_all_cluster_literature(request_status)
+    step_info.add_warning(
+        "Please use run_all_cluster_literature instead of run_single_cluster_literature."
+    )
+    return request_status, step_info
+
+
+async def run_all_cluster_literature(
+    request_status: RequestStatus,
+) -> tuple[RequestStatus, StepInformation]:
+    """Cluster the papers of the request status by topic, so the relevance check only needs to score a few per cluster.
+    See MCP.clustering for how the clusters are used.
+    """
+
+    step_info = StepInformation()
+
+    vectors = await embed_papers(request_status)
+    if vectors is None:
+        step_info.add_error(
+            "Error embedding the papers, the relevance of every paper will be checked."
+        )
+        # Every paper in its own cluster is the same as no clustering, and this stage is not run again.
+        request_status.paper_clusters = [
+            [i] for i in range(request_status.num_papers())
+        ]
+        return request_status, step_info
+
+    # k-means takes a few seconds for tens of thousands of papers, so it runs in a thread (NumPy releases the GIL)
+    # instead of blocking the event loop for the other requests.
+    request_status.paper_clusters = await asyncio.to_thread(cluster_vectors, vectors)
+    return request_status, step_info
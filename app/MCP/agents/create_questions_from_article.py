@@ -1,13 +1,34 @@
-from typing import Optional
+import asyncio
+import re
+from typing import Callable, Optional
 from .base import run_basic_ollama_agent
-from MCP.types import Article, RequestStatus, StepInformation, SurveyQuestion
+from MCP.limiter import run_concurrently
+from MCP.memo import stage_memo
+from MCP.ollama import DEFAULT_MODEL
+from MCP.prompt import agent_token_budgets, build_prompt, trim_to_tokens
+from MCP.speculation import run_speculatively
+from MCP.types import (
+    Article,
+    ArticleQuestions,
+    RequestStages,
+    RequestStatus,
+    StepInformation,
+    SurveyQuestion,
+)
 
 
 async def run_create_questions_from_article_agent(
-    article: Article, research_question: str, num_questions: int
+    article: Article,
+    research_question: str,
+    num_questions: int,
+    excerpts: Optional[list[str]] = None,
+    existing_questions: Optional[list[str]] = None,
+    custom_llm: Optional[str] = None,
 ) -> Optional[list[str]]:
     """This agent receives an article and a research question and returns a list of questions to ask the surveytakers.
     They are supposed to be open-ended and not correctly formatted yet.
+    If excerpts of the full text of the article are given, they are added to the prompt as context.
+    If existing questions are given, the agent is asked for different ones (used when more questions per article are needed).
     """
 
     # The prompt needs to be very specific about how many Questions there should be.
@@ -15,28 +36,282 @@ async def run_create_questions_from_article_agent(
     question_output_hint = ", ".join(question_output_hint)
     question_output_hint = f'["{question_output_hint}"]'
 
-    prompt = f"""Create survey questions about this research topic.
+    # The excerpts are the parts of the full text most relevant to the research question (see MCP.fulltext).
+    excerpt_info = ""
+    if excerpts:
+        excerpt_info = "\n                RELEVANT EXCERPTS:\n" + "\n".join(
+            f"                - {excerpt}" for excerpt in excerpts
+        )
+
+    existing_info = ""
+    if existing_questions:
+        existing_info = (
+            "\n                ALREADY ASKED (create different questions):\n"
+            + "\n".join(
+                f"                - {question}" for question in existing_questions
+            )
+        )
+
+    # If the prompt is too long, the excerpts are shortened first, then the abstract.
+    prompt = build_prompt(
+        "create_questions_from_article_agent",
+        """Create survey questions about this research topic.
 
                 RESEARCH TOPIC: {research_question}
 
                 ARTICLE INFO:
-                Title: {article.title}
-                Author: {article.author}  
-                Abstract: {article.abstract}
+                Title: {title}
+                Author: {author}  
+                Abstract: {abstract}
+{excerpt_info}{existing_info}
 
                 Create exactly {num_questions} survey questions. Output format:
                 {question_output_hint}
 
-                Questions:"""
-    # TODO: Here, both few-shot and RAG should be used.
+                Questions:""",
+        trimmable=("excerpt_info", "abstract"),
+        model=custom_llm,
+        research_question=research_question,
+        title=article.title,
+        author=article.author,
+        abstract=article.abstract,
+        excerpt_info=excerpt_info,
+        existing_info=existing_info,
+        num_questions=str(num_questions),
+        question_output_hint=question_output_hint,
+    )
+    # TODO: Here, few-shot should be used as well.
     return await run_basic_ollama_agent(
         name="create_questions_from_article_agent",
         prompt=prompt,
         server_list=[],
+        custom_llm=custom_llm,
         output_type=list[str],
     )
 
 
+async def run_create_questions_from_articles_agent(
+    articles: list[tuple[Article, int, Optional[list[str]], list[str]]],
+    research_question: str,
+    custom_llm: Optional[str] = None,
+) -> Optional[list[ArticleQuestions]]:
+    """The batched version of run_create_questions_from_article_agent: creates questions for several articles in one call.
+    Each article is given as (article, number of questions, excerpts, existing questions), and gets the number of its
+    position in the list (starting at 1) as its article_id. The agent sees all articles at once, so it can avoid
+    asking the same thing twice. The answer is not validated here (see _create_questions_in_batches).
+    """
+
+    # Every article gets an equal share of the budget, half for the abstract and half for the excerpts.
+    # The shares are trimmed up front, since trimming the whole prompt would cut off the last articles.
+    budget = agent_token_budgets["create_questions_from_articles_agent"]
+    share = max((budget - 256) // len(articles) // 2, 32)
+
+    article_infos = []
+    for article_id, (article, num_questions, excerpts, existing_questions) in enumerate(
+        articles, start=1
+    ):
+        article_info = f"""
+                ARTICLE {article_id} (create exactly {num_questions} questions):
+                Title: {article.title}
+                Author: {article.author}
+                Abstract: {trim_to_tokens(article.abstract or "", share, custom_llm or DEFAULT_MODEL)}"""
+        if excerpts:
+            article_info += "\n                RELEVANT EXCERPTS:\n" + trim_to_tokens(
+                "\n".join(f"                - {excerpt}" for excerpt in excerpts),
+                share,
+                custom_llm or DEFAULT_MODEL,
+            )
+        if existing_questions:
+            article_info += (
+                "\n                ALREADY ASKED (create different questions):\n"
+                + "\n".join(
+                    f"                - {question}" for question in existing_questions
+                )
+            )
+        article_infos.append(article_info)
+
+    output_hint = ", ".join(
+        f'{{"article_id": {article_id}, "questions": ["Question 1", ...]}}'
+        for article_id in range(1, len(articles) + 1)
+    )
+
+    prompt = build_prompt(
+        "create_questions_from_articles_agent",
+        """Create survey questions about this research topic from several articles.
+
+                RESEARCH TOPIC: {research_question}
+{article_infos}
+
+                For every article, create exactly the number of survey questions given for it, based on that article.
+                Every question has to ask about something different: do not repeat a question of another article or one that was already asked.
+                Output format, with one entry per article:
+                [{output_hint}]
+
+                Questions:""",
+        model=custom_llm,
+        research_question=research_question,
+        article_infos="\n".join(article_infos),
+        output_hint=output_hint,
+    )
+    return await run_basic_ollama_agent(
+        name="create_questions_from_articles_agent",
+        prompt=prompt,
+        server_list=[],
+        custom_llm=custom_llm,
+        output_type=list[ArticleQuestions],
+    )
+
+
+def _normalize_question(question: str) -> str:
+    """The words of a question in lower case, so questions that only differ in case and punctuation count as the same."""
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+
+async def _create_questions_in_batches(
+    request_status: RequestStatus,
+    on_questions: Callable[[int, list[str]], None],
+    custom_llm: Optional[str] = None,
+) -> list[Optional[list[str]]]:
+    """Creates the questions of all articles with the batched agent, articles_per_batch articles per call.
+    Returns the questions of every article, like the per-article agent would (None if none could be created).
+    on_questions is called with the index and the questions of every article as soon as it has all of its questions
+    (and at the end for the articles that only got some).
+
+    The answer is checked for every article on its own: questions that repeat a question of any article are dropped,
+    and an article that is missing from the answer (or got too few questions) is put into a batch again,
+    asking only for the questions it still needs. The articles that were answered are not asked again.
+    Like the per-article calls, every batch call is backed up by another one if it fails or is unusually slow (see MCP.speculation).
+    The rounds and the backups share one budget: no article is part of more than max_attempts calls.
+    """
+    num_papers = request_status.num_papers()
+    wanted = request_status.settings.question_per_article
+    research_question = request_status.settings.research_question
+    memo = stage_memo(request_status)
+
+    def memo_inputs(i: int) -> tuple:
+        # The batched agent avoids the questions of the other articles of the request, so its questions
+        # are memoized apart from the ones of the per-article agent.
+        return (
+            research_question,
+            request_status.get_paper(i).model_dump(),
+            request_status.paper_contexts.get(i),
+            "batched",
+        )
+
+    # The questions of every article so far, starting with the ones of earlier requests (see MCP.memo).
+    # The memo is an SQLite file, so it is read in a thread.
+    known: list[list[str]] = [[] for _ in range(num_papers)]
+    if memo is not None:
+        # The inputs are made here, since the articles of a large-run request can only be read on this thread.
+        all_inputs = [memo_inputs(i) for i in range(num_papers)]
+        memoized_questions = await asyncio.to_thread(
+            lambda: [
+                memo.get(
+                    RequestStages.CREATING_SURVEY_QUESTIONS,
+                    inputs,
+                    list[str],
+                    custom_llm,
+                )
+                for inputs in all_inputs
+            ]
+        )
+        known = [(questions or [])[:wanted] for questions in memoized_questions]
+    # All questions of all articles, so no article gets a question another one already has.
+    seen = {
+        _normalize_question(question) for questions in known for question in questions
+    }
+    for i in range(num_papers):
+        if len(known[i]) >= wanted:
+            on_questions(i, known[i])
+
+    # The articles that got all of their questions in this round, to be written to the memo after it.
+    to_memoize: list[int] = []
+
+    def take_answer(batch: list[int], answer: Optional[list[ArticleQuestions]]):
+        if not isinstance(answer, list):
+            return  # The whole batch failed, its articles are tried again in the next round.
+        for entry in answer:
+            # The article_id is the position in the batch, anything else is ignored.
+            if not 1 <= entry.article_id <= len(batch):
+                continue
+            i = batch[entry.article_id - 1]
+            if len(known[i]) >= wanted:
+                continue  # The article is complete already (e.g. it appeared twice in the answer).
+            for question in entry.questions:
+                normalized = _normalize_question(question)
+                if len(known[i]) >= wanted or not normalized or normalized in seen:
+                    continue
+                seen.add(normalized)
+                known[i].append(question.strip())
+            if len(known[i]) >= wanted:
+                to_memoize.append(i)
+                on_questions(i, known[i])
+
+    max_attempts = request_status.settings.max_attempts
+    calls = [0] * num_papers  # How many calls every article was part of so far.
+
+    def call_batch(batch: list[int]):
+        def attempt():
+            for i in batch:
+                calls[i] += 1
+            return run_create_questions_from_articles_agent(
+                [
+                    (
+                        request_status.get_paper(i),
+                        wanted - len(known[i]),
+                        request_status.paper_contexts.get(i),
+                        known[i],
+                    )
+                    for i in batch
+                ],
+                research_question,
+                custom_llm,
+            )
+
+        # The batch may only make as many calls as all of its articles have left.
+        return run_speculatively(
+            "create_questions_from_articles_agent",
+            attempt,
+            max_attempts - max(calls[i] for i in batch),
+        )
+
+    batch_size = request_status.settings.articles_per_batch
+    while True:
+        missing = [
+            i
+            for i in range(num_papers)
+            if len(known[i]) < wanted and calls[i] < max_attempts
+        ]
+        if not missing:
+            break
+        batches = [
+            missing[start : start + batch_size]
+            for start in range(0, len(missing), batch_size)
+        ]
+        await run_concurrently(batches, call_batch, take_answer)
+        if memo is not None and to_memoize:
+            outputs = [(memo_inputs(i), known[i]) for i in to_memoize]
+            await asyncio.to_thread(
+                lambda: [
+                    memo.put(
+                        RequestStages.CREATING_SURVEY_QUESTIONS,
+                        inputs,
+                        list[str],
+                        questions,
+                        custom_llm,
+                    )
+                    for inputs, questions in outputs
+                ]
+            )
+            to_memoize.clear()
+
+    # Articles with too few questions keep the ones they got, which is reported like a short answer of the per-article agent.
+    for i in range(num_papers):
+        if 0 < len(known[i]) < wanted:
+            on_questions(i, known[i])
+    return [questions or None for questions in known]
+
+
 async def run_single_create_questions_from_article_agent(
     request_status: RequestStatus,
 ) -> tuple[RequestStatus, StepInformation]:
@@ -50,7 +325,7 @@ async def run_single_create_questions_from_article_agent(
     questions_per_article = request_status.settings.question_per_article
     next_article_index = num_current_questions // questions_per_article
 
-    if next_article_index >= len(request_status.papers):
+    if next_article_index >= request_status.num_papers():
         # No more articles to process.
         return request_status, StepInformation(
             warnings=["No more articles to process."]
@@ -66,10 +341,13 @@ async def run_single_create_questions_from_article_agent(
             "This may lead to unexpected results."
         )
 
-    article, _ = request_status.papers[next_article_index]
+    article = request_status.get_paper(next_article_index)
     # Run the agent on the article.
     questions = await run_create_questions_from_article_agent(
-        article, request_status.settings.research_question, questions_per_article
+        article,
+        request_status.settings.research_question,
+        questions_per_article,
+        request_status.paper_contexts.get(next_article_index),
     )
     if questions is None:
         step_info.add_error(
@@ -118,17 +396,81 @@ async def run_all_create_questions_from_article_agent(
     step_info = StepInformation()
 
     # If there are no papers, we can't create questions.
-    if len(request_status.papers) == 0:
+    if request_status.num_papers() == 0:
         step_info.add_error("No papers to process.")
         return request_status, step_info
 
-    # Process each article in the request status.
-    for article, _ in request_status.papers:
-        questions = await run_create_questions_from_article_agent(
-            article,
+    # Process all articles in the request status concurrently, as far as the limiter allows it.
+    # In large-run mode, each article is only loaded from the store when its prompt is built.
+    async def create(i: int) -> Optional[list[str]]:
+        article = request_status.get_paper(i)
+        wanted = request_status.settings.question_per_article
+
+        # The questions created for this article by earlier requests (see MCP.memo). If there are enough, they are reused.
+        # If the request wants more questions per article than before, only the missing ones are created.
+        memo = stage_memo(request_status)
+        inputs = (
             request_status.settings.research_question,
-            request_status.settings.question_per_article,
+            article.model_dump(),
+            request_status.paper_contexts.get(i),
+        )
+        known = []
+        if memo is not None:
+            known = (
+                memo.get(RequestStages.CREATING_SURVEY_QUESTIONS, inputs, list[str])
+                or []
+            )
+        if len(known) >= wanted:
+            return known[:wanted]
+
+        new = await run_speculatively(
+            "create_questions_from_article_agent",
+            lambda: run_create_questions_from_article_agent(
+                article,
+                request_status.settings.research_question,
+                wanted - len(known),
+                request_status.paper_contexts.get(i),
+                known,
+            ),
+            request_status.settings.max_attempts,
+        )
+        if not isinstance(new, list):
+            return new  # The error is reported below.
+        if memo is not None:
+            memo.put(
+                RequestStages.CREATING_SURVEY_QUESTIONS, inputs, list[str], known + new
+            )
+        return known + new
+
+    def add_questions(i: int, questions: Optional[list[str]]):
+        # The questions of every article are added as soon as it is done, so a stage that is cut off by the deadline
+        # keeps the finished articles. The questions stay grouped by article, in the order the articles were done.
+        if not isinstance(questions, list):
+            return  # The error is reported below.
+        for question in questions:
+            # The field requires a SurveyQuestion object, so we create it.
+            survey_question = SurveyQuestion(
+                question=question,
+                answer_type=None,  # The type of answer is not known yet, so we set it to None.
+                options=None,  # The options for the answer are not known yet, so we set it to None.
+            )
+            request_status.questions.append(
+                (
+                    survey_question,
+                    None,  # The relevance score is not known yet, so we set it to None.
+                )
+            )
+
+    # With articles_per_batch, several articles share a call (see _create_questions_in_batches).
+    if request_status.settings.articles_per_batch > 1:
+        results = await _create_questions_in_batches(request_status, add_questions)
+    else:
+        results = await run_concurrently(
+            range(request_status.num_papers()), create, add_questions
         )
+
+    for i, questions in enumerate(results):
+        article = request_status.get_paper(i)
         if questions is None:
             step_info.add_error(
                 f"Error creating questions from article {article.title}, skipping."
@@ -148,18 +490,4 @@ async def run_all_create_questions_from_article_agent(
                 f"but expected {request_status.settings.question_per_article}."
             )
 
-        # Add the questions to the request status.
-        for question in questions:
-            survey_question = SurveyQuestion(
-                question=question,
-                answer_type=None,  # The type of answer is not known yet, so we set it to None.
-                options=None,  # The options for the answer are not known yet, so we set it to None.
-            )
-            request_status.questions.append(
-                (
-                    survey_question,
-                    None,  # The relevance score is not known yet, so we set it to None.
-                )
-            )
-
     return (request_status, step_info)  # Return the updated request status.
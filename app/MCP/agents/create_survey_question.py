@@ -1,14 +1,20 @@
-from typing import List, Optional
+from typing import Optional
 from .base import run_basic_ollama_agent
-from MCP.types import RequestStatus, StepInformation, SurveyQuestion
+from MCP.limiter import run_concurrently
+from MCP.prompt import build_prompt
+from MCP.memo import memoized
+from MCP.speculation import run_speculatively
+from MCP.types import RequestStages, RequestStatus, StepInformation, SurveyQuestion
 
 
 async def run_create_survey_question_agent(
-    question: str, research_question: str
+    question: str, research_question: str, custom_llm: Optional[str] = None
 ) -> Optional[SurveyQuestion]:
     """This agent receives a question and the main research question and returns a correctly formatted survey question."""
 
-    prompt = f"""
+    prompt = build_prompt(
+        "create_survey_question_agent",
+        """
 You are a professional research assistant. You will be creating a survey for a research question.
 Given a question, you need to think ybout how it will be answered and output correctly formatted survey question.
 The question should either be a text field, multiple choice, yes/no or a range question.
@@ -17,12 +23,17 @@ For example, if the question has a range answer, the options should be a tuple o
 And if the question is a multiple choice question, the options should be a list of strings representing the possible answers.
 
 Research question: {research_question}
-Question: {question}"""
+Question: {question}""",
+        model=custom_llm,
+        research_question=research_question,
+        question=question,
+    )
 
     return await run_basic_ollama_agent(
         name="create_survey_question_agent",
         prompt=prompt,
         server_list=[],
+        custom_llm=custom_llm,
         output_type=SurveyQuestion,
     )
 
@@ -39,8 +50,8 @@ async def run_single_create_survey_question_agent(
     to_change: Optional[tuple[int, SurveyQuestion]] = None
 
     for i, (question, relevance) in enumerate(request_status.questions):
-        # Only if the question is not already formatted, we need to check it.
-        if question.answer_type is None or question.options is None:
+        # Only if the question is not already formatted (and relevant enough), we need to check it.
+        if request_status.needs_formatting(question, relevance):
             # Run the agent on the question.
             formatted_question = await run_create_survey_question_agent(
                 question.question, request_status.settings.research_question
@@ -90,13 +101,50 @@ async def run_all_create_survey_questions_agent(
         step_info.add_error("No questions to process.")
         return request_status, step_info
 
-    to_change: List[tuple[int, SurveyQuestion]] = []
+    # Only the questions that still need it are formatted. Questions that were formatted together with their
+    # relevance check (see score_and_format_question) or are below the question_relevance_threshold are skipped.
+    to_format = [
+        i
+        for i, (question, relevance) in enumerate(request_status.questions)
+        if request_status.needs_formatting(question, relevance)
+    ]
+
+    def apply(i: int, formatted_question: Optional[SurveyQuestion]):
+        # Every question is written as soon as it is formatted, so a stage that is cut off by the deadline keeps the finished ones.
+        if formatted_question is not None and isinstance(
+            formatted_question, SurveyQuestion
+        ):
+            request_status.questions[i] = (
+                formatted_question,
+                request_status.questions[i][1],  # Keep the relevance score unchanged.
+            )
 
-    # Process each question in the request status.
-    for i, (question, relevance) in enumerate(request_status.questions):
-        formatted_question = await run_create_survey_question_agent(
-            question.question, request_status.settings.research_question
-        )
+    # Process the questions concurrently, as far as the limiter allows it.
+    results = await run_concurrently(
+        to_format,
+        lambda i: memoized(
+            request_status,
+            RequestStages.FORMATTING_SURVEY_QUESTIONS,
+            (
+                request_status.settings.research_question,
+                request_status.questions[i][0].question,
+            ),
+            SurveyQuestion,
+            lambda: run_speculatively(
+                "create_survey_question_agent",
+                lambda: run_create_survey_question_agent(
+                    request_status.questions[i][0].question,
+                    request_status.settings.research_question,
+                ),
+                request_status.settings.max_attempts,
+            ),
+        ),
+        apply,
+    )
+
+    changed = 0
+    for i, formatted_question in zip(to_format, results):
+        question = request_status.questions[i][0]
         if formatted_question is None:
             step_info.add_error(
                 f"Error formatting question {question.question}, skipping."
@@ -110,15 +158,8 @@ async def run_all_create_survey_questions_agent(
             )
             continue
 
-        # Add the formatted question to the list of questions to change.
-        to_change.append((i, formatted_question))
+        changed += 1
 
-    # Update the request status with the new formatted questions.
-    for i, formatted_question in to_change:
-        request_status.questions[i] = (
-            formatted_question,
-            request_status.questions[i][1],  # Keep the relevance score unchanged.
-        )
-    else:
+    if not changed:
         step_info.add_warning("No more questions to format.")
     return request_status, step_info  # Return the updated request status and step info.
@@ -1,18 +1,28 @@
 from typing import Optional
 from .base import run_basic_ollama_agent
-from MCP.types import Article, RequestStatus, StepInformation
+from MCP.dedup import deduplicate_articles
+from MCP.memo import memoized
+from MCP.prompt import build_prompt
+from MCP.semantic_cache import seed_from_similar_request
+from MCP.types import Article, RequestStages, RequestStatus, StepInformation
 
 
 async def run_relevant_literature_agent(
-    research_question: str, paper_limit: int
+    research_question: str, paper_limit: int, custom_llm: Optional[str] = None
 ) -> Optional[list[Article]]:
     """This agent receives the research question and returns a list of relevant literature in the proper format."""
 
-    prompt = f"""
+    prompt = build_prompt(
+        "relevant_literature_agent",
+        """
     You are a research assistant. Given a research question, you need to find relevant literature.
     You have access to Google Scholar to look up papers. For the research question, find the most relevant papers and return a list of articles with their title, abstract, author and URL.
     Limit the number of articles to {paper_limit}.
-    research question: {research_question}"""  # TODO: Add examples on how to do this, multi-shot learning is important
+    research question: {research_question}""",  # TODO: Add examples on how to do this, multi-shot learning is important
+        paper_limit=str(paper_limit),
+        model=custom_llm,
+        research_question=research_question,
+    )
 
     return await run_basic_ollama_agent(
         name="relevant_literature_agent",
@@ -30,19 +40,48 @@ async def run_single_relevant_literature_agent(
     step_info = StepInformation()
 
     # If we already have papers, we don't need to run the agent again.
-    if request_status.papers:
+    if request_status.num_papers() > 0:
         step_info.add_warning(
             "Papers already found, skipping relevant literature agent."
         )
         return request_status, step_info
 
-    # Run the agent to find relevant literature.
-    articles = await run_relevant_literature_agent(
-        request_status.settings.research_question, request_status.settings.paper_limit
+    # If an earlier request had a similar enough research question, its papers can be reused.
+    if request_status.settings.reuse_similar_requests:
+        similar_question = await seed_from_similar_request(
+            request_status, request_status.settings.reuse_relevance_scores
+        )
+        if similar_question is not None:
+            step_info.add_warning(
+                f"Reused the literature of an earlier request with the research question: {similar_question}"
+            )
+            return request_status, step_info
+
+    # Run the agent to find relevant literature, unless it was already run with the same question and limit.
+    articles = await memoized(
+        request_status,
+        RequestStages.FINDING_LITERATURE,
+        (
+            request_status.settings.research_question,
+            request_status.settings.paper_limit,
+        ),
+        list[Article],
+        lambda: run_relevant_literature_agent(
+            request_status.settings.research_question,
+            request_status.settings.paper_limit,
+        ),
     )
 
     if articles is not None and isinstance(articles, list):
-        request_status.papers = [(article, None) for article in articles]
+        # The same work often comes back several times (preprint and published version, different URLs).
+        # Merging the copies here means each work is only scored and turned into questions once.
+        unique_articles = deduplicate_articles(articles)
+        if len(unique_articles) < len(articles):
+            step_info.add_warning(
+                f"Merged {len(articles) - len(unique_articles)} duplicate articles."
+            )
+        request_status.clear_papers()
+        request_status.add_papers(unique_articles)
     elif isinstance(articles, Exception):
         step_info.add_error(f"Error finding relevant literature: {articles}")
     else:
@@ -0,0 +1,64 @@
+from MCP.fulltext import ChunkIndex, chunks_per_article, fetch_full_texts
+from MCP.types import RequestStatus, StepInformation
+
+
+async def run_single_retrieve_full_text(
+    request_status: RequestStatus,
+) -> tuple[RequestStatus, StepInformation]:
+    """Dummy function to keep the interface consistent.
+    The chunks of all articles are put into one index, so retrieving them one article at a time would not save anything.
+    """
+
+    request_status, step_info = await run_all_retrieve_full_text(request_status)
+    step_info.add_warning(
+        "Please use run_all_retrieve_full_text instead of run_single_retrieve_full_text."
+    )
+    return request_status, step_info
+
+
+async def run_all_retrieve_full_text(
+    request_status: RequestStatus,
+) -> tuple[RequestStatus, StepInformation]:
+    """Download the full texts of all articles in the request status and store the excerpts most relevant to the research question.
+    The excerpts are used as context by the create_questions_from_article agent.
+    """
+
+    step_info = StepInformation()
+
+    # Only the articles that don't have their excerpts yet.
+    to_retrieve = [
+        i
+        for i in range(request_status.num_papers())
+        if i not in request_status.paper_contexts
+    ]
+    urls = {i: request_status.get_paper(i).url for i in to_retrieve}
+    texts = await fetch_full_texts([url for url in urls.values() if url])
+
+    found: dict[int, str] = {}
+    for i, url in urls.items():
+        text = texts.get(url) if url else None
+        if text:
+            found[i] = text
+        else:
+            step_info.add_warning(
+                f"No full text for paper {request_status.get_paper(i).title}, only the abstract will be used."
+            )
+
+    index = ChunkIndex()
+    if not await index.build(found):
+        step_info.add_error(
+            "Error embedding the full texts, only the abstracts will be used."
+        )
+
+    excerpts = await index.top_chunks(
+        request_status.settings.research_question, chunks_per_article
+    )
+    # Articles without a full text get an empty list, so this stage is not run for them again.
+    # Articles whose text could not be embedded (e.g. Ollama was down for a moment) are left out, so they are tried again.
+    for i in to_retrieve:
+        if i not in found:
+            request_status.paper_contexts[i] = []
+        elif i in excerpts:
+            request_status.paper_contexts[i] = excerpts[i]
+
+    return request_status, step_info
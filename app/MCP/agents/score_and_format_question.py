@@ -0,0 +1,175 @@
+from typing import Optional
+from .base import run_basic_ollama_agent
+from MCP.limiter import run_concurrently
+from MCP.memo import memoized
+from MCP.prompt import build_prompt
+from MCP.speculation import run_speculatively
+from MCP.types import (
+    RequestStages,
+    RequestStatus,
+    ScoredSurveyQuestion,
+    StepInformation,
+    SurveyQuestion,
+)
+
+# This agent does the work of check_question_relevance and create_survey_question in one call.
+# Both of them send the research question and the question, so doing it at once halves the round trips per question.
+# It is only used if fuse_question_stages is set in the settings of the request.
+
+
+async def run_score_and_format_question_agent(
+    question: str,
+    research_question: str,
+    threshold: Optional[float] = None,
+    custom_llm: Optional[str] = None,
+) -> Optional[ScoredSurveyQuestion]:
+    """This agent receives a question and the research question and returns the relevance of the question between 0 and 1,
+    together with the answer type and options of the question as a survey question.
+    If a threshold is given, the agent may leave out the format for questions below it.
+    """
+
+    threshold_info = ""
+    if threshold is not None:
+        threshold_info = f"If the relevance is below {threshold}, set answer_type and options to null.\n"
+
+    prompt = build_prompt(
+        "score_and_format_question_agent",
+        """
+You are a professional research assistant. You will be creating a survey for a research question.
+Given a question, which will be asked in the survey, you need to do two things:
+1. Estimate the relevance of the question to the research question. Only based on the content of the question, give a score between 0 and 1.
+2. Think about how it will be answered and format it as a survey question.
+The question should either be a text field, multiple choice, yes/no or a range question.
+The options should be set accordingly.
+For example, if the question has a range answer, the options should be a tuple of two integers representing the minimum and maximum values.
+And if the question is a multiple choice question, the options should be a list of strings representing the possible answers.
+{threshold_info}
+Research question: {research_question}
+Question: {question}""",
+        model=custom_llm,
+        research_question=research_question,
+        question=question,
+        threshold_info=threshold_info,
+    )
+
+    return await run_basic_ollama_agent(
+        name="score_and_format_question_agent",
+        prompt=prompt,
+        server_list=[],
+        custom_llm=custom_llm,
+        output_type=ScoredSurveyQuestion,
+    )
+
+
+def _apply_scored_question(
+    request_status: RequestStatus, i: int, scored: ScoredSurveyQuestion
+):
+    """Writes the relevance and (if there is one and it's needed) the format of a scored question into the request status.
+    If the format is missing for a question above the threshold, only the relevance is set, and the question is
+    formatted by the normal formatting stage later.
+    """
+    question = request_status.questions[i][0]
+    if (
+        request_status.needs_formatting(question, scored.relevance)
+        and scored.answer_type is not None
+        and scored.options is not None
+    ):
+        question = SurveyQuestion(
+            question=question.question,  # The text is kept, the agent is only asked for the format.
+            answer_type=scored.answer_type,
+            options=scored.options,
+        )
+    request_status.questions[i] = (question, scored.relevance)
+
+
+async def run_single_score_and_format_question_agent(
+    request_status: RequestStatus,
+) -> tuple[RequestStatus, StepInformation]:
+    """Run the score_and_format_question agent on the next question without a relevance score in the request status."""
+
+    step_info = StepInformation()
+
+    for i, (question, relevance) in enumerate(request_status.questions):
+        # Only if the relevance is None, we need to check it.
+        if relevance is None:
+            scored = await run_score_and_format_question_agent(
+                question.question,
+                request_status.settings.research_question,
+                request_status.settings.question_relevance_threshold,
+            )
+            if scored is not None and isinstance(scored, ScoredSurveyQuestion):
+                _apply_scored_question(request_status, i, scored)
+                return request_status, step_info
+            elif isinstance(scored, Exception):
+                step_info.add_error(
+                    f"Error scoring and formatting question {question.question}: {scored}"
+                )
+            else:
+                step_info.add_error(
+                    f"Error scoring and formatting question {question.question}, skipping."
+                )
+
+    step_info.add_warning("No more questions to score and format.")
+    return request_status, step_info
+
+
+async def run_all_score_and_format_question_agent(
+    request_status: RequestStatus,
+) -> tuple[RequestStatus, StepInformation]:
+    """Run the score_and_format_question agent on all questions without a relevance score in the request status."""
+
+    step_info = StepInformation()
+
+    to_check = [
+        i
+        for i, (_, relevance) in enumerate(request_status.questions)
+        if relevance is None
+    ]
+
+    def apply(i: int, scored: Optional[ScoredSurveyQuestion]):
+        # Every question is written as soon as it is done, so a stage that is cut off by the deadline keeps the finished ones.
+        if scored is not None and isinstance(scored, ScoredSurveyQuestion):
+            _apply_scored_question(request_status, i, scored)
+
+    # Run the agent on all questions concurrently, as far as the limiter allows it.
+    results = await run_concurrently(
+        to_check,
+        lambda i: memoized(
+            request_status,
+            RequestStages.SCORING_AND_FORMATTING_SURVEY_QUESTIONS,
+            (
+                request_status.settings.research_question,
+                request_status.questions[i][0].question,
+                request_status.settings.question_relevance_threshold,
+            ),
+            ScoredSurveyQuestion,
+            lambda: run_speculatively(
+                "score_and_format_question_agent",
+                lambda: run_score_and_format_question_agent(
+                    request_status.questions[i][0].question,
+                    request_status.settings.research_question,
+                    request_status.settings.question_relevance_threshold,
+                ),
+                request_status.settings.max_attempts,
+            ),
+        ),
+        apply,
+    )
+
+    changed = 0
+    for i, scored in zip(to_check, results):
+        question = request_status.questions[i][0]
+        if scored is not None and isinstance(scored, ScoredSurveyQuestion):
+            changed += 1
+        elif isinstance(scored, Exception):
+            step_info.add_error(
+                f"Error scoring and formatting question {question.question}: {scored}"
+            )
+        else:
+            step_info.add_error(
+                f"Error scoring and formatting question {question.question}, skipping."
+            )
+
+    if not changed:
+        step_info.add_warning("No more questions to score and format.")
+    return request_status, step_info
@@ -0,0 +1,102 @@
+# Out-of-line storage for articles, used by the large-run mode of a request.
+
+# For runs with thousands of candidate papers, keeping every full Article (with its long abstract) inside the RequestStatus
+# makes every copy and dump of the status grow with it.
+# In large-run mode the article bodies live in a SQLite file and the status only keeps compact IDs and scores.
+# This module deliberately knows nothing about the Article model (that would be a circular import with MCP.types),
+# it only stores and returns the serialized JSON of the articles.
+
+import math
+import sqlite3
+from array import array
+from typing import Iterable, Iterator, Optional
+
+
+class ArticleStore:
+    """A blob store for serialized articles, backed by a single SQLite file.
+    Each stored article gets a compact integer ID, which is all the request status needs to keep in memory.
+    """
+
+    def __init__(self, path: str):
+        """Opens (or creates) the store at the given path."""
+        self.path = path
+        # A single connection is held, opening one for every article would be far too slow for large runs.
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS articles (id INTEGER PRIMARY KEY, body TEXT NOT NULL)"
+        )
+        self._connection.commit()
+
+    def put_many(self, bodies: Iterable[str]) -> list[int]:
+        """Stores the serialized articles in one transaction and returns their IDs, in the same order."""
+        ids = []
+        with self._connection:
+            for body in bodies:
+                cursor = self._connection.execute(
+                    "INSERT INTO articles (body) VALUES (?)", (body,)
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def get(self, article_id: int) -> str:
+        """Loads a single serialized article. Raises a KeyError if the ID is unknown."""
+        row = self._connection.execute(
+            "SELECT body FROM articles WHERE id = ?", (article_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"Article {article_id} is not in the store at {self.path}.")
+        return row[0]
+
+    def close(self):
+        """Closes the connection to the store."""
+        self._connection.close()
+
+
+class PaperTable:
+    """Array-backed columns of the papers of a request in large-run mode.
+    Only the article IDs and the relevance scores are held in memory, the article bodies are loaded from the store on demand.
+    A missing relevance score (None) is stored as NaN, so the score column can stay a plain array of doubles.
+    """
+
+    def __init__(self, store: ArticleStore):
+        self.store = store
+        self.ids = array("q")  # The IDs of the articles in the store.
+        self.scores = array("d")  # The relevance scores, NaN if not known yet.
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append_many(self, bodies: list[str], scores: list[Optional[float]]):
+        """Stores the serialized articles and appends them with their scores to the table."""
+        self.ids.extend(self.store.put_many(bodies))
+        self.scores.extend(math.nan if score is None else score for score in scores)
+
+    def restore(self, ids: list[int], scores: list[Optional[float]]):
+        """Replaces the columns with saved ones (see RequestStatus.from_json). The articles have to be in the store already."""
+        self.ids = array("q", ids)
+        self.scores = array(
+            "d", (math.nan if score is None else score for score in scores)
+        )
+
+    def clear(self):
+        """Removes all papers from the table. The bodies stay in the store, they are just not referenced anymore."""
+        self.ids = array("q")
+        self.scores = array("d")
+
+    def get_body(self, index: int) -> str:
+        """Loads the serialized article at the given position from the store."""
+        return self.store.get(self.ids[index])
+
+    def get_score(self, index: int) -> Optional[float]:
+        """Returns the relevance score at the given position, or None if it is not known yet."""
+        score = self.scores[index]
+        return None if math.isnan(score) else score
+
+    def set_score(self, index: int, score: Optional[float]):
+        """Sets the relevance score at the given position."""
+        self.scores[index] = math.nan if score is None else score
+
+    def iter_scores(self) -> Iterator[Optional[float]]:
+        """Iterates over all relevance scores without touching the store."""
+        for score in self.scores:
+            yield None if math.isnan(score) else score
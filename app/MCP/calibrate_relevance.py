@@ -0,0 +1,113 @@
+# Calibration of the logprob relevance scores (see MCP.logprob_scoring).
+
+# Takes a small labelled set in JSONL, one example per line, with the research question, an article or a question,
+# and a label between 0 (not relevant) and 1 (relevant):
+#     {"research_question": "...", "article": {"title": "...", "author": "...", "abstract": "...", "url": "..."}, "label": 1}
+#     {"research_question": "...", "question": "...", "label": 0}
+# Scores every example with the logprob agents, fits a calibration per agent and stores it in CALIBRATION_FILE,
+# where the agents pick it up on their next start. A few dozen examples per agent are enough for the two parameters.
+#     uv run -m MCP.calibrate_relevance labelled.jsonl
+
+import argparse
+import asyncio
+import json
+from typing import Optional
+
+import numpy as np
+
+from MCP.agents.check_literature_relevance import (
+    check_literature_relevance_logprob_prompt,
+)
+from MCP.agents.check_question_relevance import check_question_relevance_logprob_prompt
+from MCP.limiter import run_concurrently
+from MCP.logprob_scoring import (
+    CALIBRATION_FILE,
+    Calibration,
+    raw_logprob_score,
+    save_calibration,
+)
+from MCP.ollama import close_llm_http_clients
+from MCP.types import Article
+
+min_examples = (
+    10  # Below that, the fit says more about the examples than about the model.
+)
+
+
+def example_prompt(example: dict) -> tuple[str, str]:
+    """Returns the name of the agent that scores the example, and its prompt."""
+    if "article" in example:
+        return (
+            "check_literature_relevance_logprob_agent",
+            check_literature_relevance_logprob_prompt(
+                Article(**example["article"]), example["research_question"]
+            ),
+        )
+    return (
+        "check_question_relevance_logprob_agent",
+        check_question_relevance_logprob_prompt(
+            example["question"], example["research_question"]
+        ),
+    )
+
+
+async def calibrate(
+    path: str, model: Optional[str] = None, output: str = CALIBRATION_FILE
+):
+    """Fits and stores the calibrations of the agents from the labelled examples in path."""
+    with open(path, "r") as file:
+        examples = [json.loads(line) for line in file if line.strip()]
+    prompts = [example_prompt(example) for example in examples]
+
+    try:
+        raw_scores = await run_concurrently(
+            prompts, lambda prompt: raw_logprob_score(prompt[0], prompt[1], model)
+        )
+    finally:
+        await close_llm_http_clients()
+
+    by_agent: dict[str, tuple[list[float], list[float]]] = {}
+    for (agent_name, _), example, raw in zip(prompts, examples, raw_scores):
+        if raw is None or isinstance(raw, Exception):
+            print(f"Skipping an example of {agent_name}, it could not be scored: {raw}")
+            continue
+        scores, labels = by_agent.setdefault(agent_name, ([], []))
+        scores.append(raw)
+        labels.append(float(example["label"]))
+
+    for agent_name, (scores, labels) in by_agent.items():
+        if len(scores) < min_examples:
+            print(
+                f"Not calibrating {agent_name}, it has only {len(scores)} examples (at least {min_examples} needed)."
+            )
+            continue
+        calibration = Calibration.fit(scores, labels)
+        calibrated = np.array([calibration(raw) for raw in scores])
+        y = np.array(labels)
+        print(
+            f"{agent_name}: a={calibration.a:.3f}, b={calibration.b:.3f}, "
+            f"mean squared error {np.mean((np.array(scores) - y) ** 2):.4f} raw, "
+            f"{np.mean((calibrated - y) ** 2):.4f} calibrated ({len(scores)} examples)"
+        )
+        save_calibration(agent_name, calibration, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Calibrates the logprob relevance scores on a labelled set."
+    )
+    parser.add_argument("examples", help="JSONL file with the labelled examples")
+    parser.add_argument(
+        "--model", default=None, help="The model to calibrate (default: DEFAULT_MODEL)"
+    )
+    parser.add_argument(
+        "--output",
+        default=CALIBRATION_FILE,
+        help="Where the calibrations are stored",
+    )
+    args = parser.parse_args()
+    asyncio.run(calibrate(args.examples, args.model, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# Record and replay of agent calls.
+
+# Model time drowns everything else, so the orchestration of the pipeline can't be profiled or regression-tested with a real model.
+# In record mode, every call of run_basic_ollama_agent is written to a cassette file, together with its result and latency.
+# In replay mode, the results are served back from the cassette instead, without touching any model.
+# The mode can be set with the environment variables below, or by calling use_cassette before the pipeline runs.
+
+import asyncio
+import json
+import os
+from collections import defaultdict
+from typing import Any, Literal, Optional
+
+from pydantic import TypeAdapter, ValidationError
+
+CassetteMode = Literal["record", "replay"]
+
+# Example: SURVEY_MACHINE_CASSETTE=MCP/traces/cassette.jsonl SURVEY_MACHINE_CASSETTE_MODE=replay uv run -m MCP.main
+CASSETTE_ENV = "SURVEY_MACHINE_CASSETTE"  # The path of the cassette file.
+CASSETTE_MODE_ENV = "SURVEY_MACHINE_CASSETTE_MODE"  # Either "record" or "replay".
+REPLAY_LATENCY_ENV = (
+    "SURVEY_MACHINE_REPLAY_LATENCY"  # Either "recorded" (default) or "zero".
+)
+
+
+class Cassette:
+    """A file with one recorded agent call per line.
+    Calls are matched by agent name, model and prompt. If the same call was recorded several times,
+    the recordings are served in the order they were recorded, so a replay is deterministic.
+    """
+
+    def __init__(self, path: str, mode: CassetteMode, recorded_latency: bool = True):
+        self.path = path
+        self.mode = mode
+        self.recorded_latency = recorded_latency  # Whether a replay waits as long as the recorded call took.
+        self._recordings: dict[tuple, list[dict]] = defaultdict(list)
+        self._next: dict[tuple, int] = defaultdict(int)
+        if mode == "replay":
+            with open(path, "r") as file:
+                for line in file:
+                    recording = json.loads(line)
+                    key = (recording["name"], recording["model"], recording["prompt"])
+                    self._recordings[key].append(recording)
+
+    def record(
+        self,
+        name: str,
+        model: Optional[str],
+        prompt: str,
+        output_type: Any,
+        result: Any,
+        latency: float,
+    ):
+        """Appends a call and its result to the cassette file."""
+        recording = {
+            "name": name,
+            "model": model,
+            "prompt": prompt,
+            "result": (
+                None
+                if result is None
+                else TypeAdapter(output_type).dump_python(result, mode="json")
+            ),
+            "latency": latency,
+        }
+        # Like the trace files, the cassette is opened and closed for every write.
+        with open(self.path, "a") as file:
+            file.write(json.dumps(recording) + "\n")
+
+    async def replay(
+        self, name: str, model: Optional[str], prompt: str, output_type: Any
+    ) -> Any:
+        """Serves the next recorded result for the call.
+        Returns None (like a failed agent) if the call was never recorded, or if the recorded result doesn't fit the output type anymore.
+        """
+        key = (name, model, prompt)
+        recordings = self._recordings.get(key)
+        if not recordings:
+            print(
+                f"Error replaying agent {name}: the call is not in the cassette {self.path}."
+            )
+            return None
+        # If the pipeline makes the call more often than it was recorded, the last recording is repeated.
+        recording = recordings[min(self._next[key], len(recordings) - 1)]
+        self._next[key] += 1
+
+        if self.recorded_latency:
+            await asyncio.sleep(recording["latency"])
+        if recording["result"] is None:
+            return None
+        try:
+            return TypeAdapter(output_type).validate_python(recording["result"])
+        except ValidationError as e:
+            print(
+                f"Error replaying agent {name}: the recorded result doesn't validate: {e}"
+            )
+            return None
+
+
+_cassette: Optional[Cassette] = None
+if os.getenv(CASSETTE_ENV):
+    _cassette = Cassette(
+        os.environ[CASSETTE_ENV],
+        os.getenv(CASSETTE_MODE_ENV, "replay"),  # type: ignore
+        os.getenv(REPLAY_LATENCY_ENV, "recorded") != "zero",
+    )
+
+
+def use_cassette(
+    path: Optional[str], mode: CassetteMode = "replay", recorded_latency: bool = True
+):
+    """Sets the cassette for all following agent calls. Passing None as the path turns record/replay off again."""
+    global _cassette
+    _cassette = None if path is None else Cassette(path, mode, recorded_latency)
+
+
+def set_cassette(cassette: Optional[Cassette]):
+    """Sets an already created cassette (e.g. a subclass that makes up its results, see MCP.profile) for all following agent calls."""
+    global _cassette
+    _cassette = cassette
+
+
+def get_cassette() -> Optional[Cassette]:
+    """Returns the cassette in use, or None if the agents talk to the model normally."""
+    return _cassette
+
+
+def is_replaying() -> bool:
+    """Whether the agent calls are currently served from a cassette."""
+    return _cassette is not None and _cassette.mode == "replay"
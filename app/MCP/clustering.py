@@ -0,0 +1,170 @@
+# Topic clustering of the candidate papers, so only a few papers per topic need an LLM relevance check.
+
+# With a large candidate set, most papers are near-duplicates in topic: ten papers on "Instagram use and anxiety in teens"
+# will all get about the same relevance score. Here the title and abstract of every paper are embedded and grouped
+# with k-means (plain NumPy, all papers at once). The relevance stage then only scores the papers closest to the centre
+# of each cluster (the representatives), and the other papers of the cluster get the mean of their scores.
+# If the representatives of a cluster disagree too much, the cluster is not about one thing after all,
+# so its other papers are scored one by one like without clustering.
+
+import math
+from typing import Optional
+
+import numpy as np
+
+from MCP.ollama import embed
+from MCP.types import RequestStatus
+
+papers_per_cluster = 8  # The average cluster size that k is chosen for.
+max_clusters = 256  # The upper limit for k. Beyond it, k-means gets slow and the clusters are only split finer.
+min_papers_to_cluster = (
+    16  # Below this, clustering saves too few calls to be worth the embedding.
+)
+max_representative_spread = 0.3  # If the scores of the representatives of a cluster differ by more, its papers are scored individually.
+kmeans_iterations = (
+    50  # The maximum number of k-means iterations. It usually converges long before.
+)
+embedding_batch_size = 64  # How many abstracts are embedded in one call.
+
+
+def kmeans(vectors: np.ndarray, k: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Clusters the (normalized) row vectors into k clusters with k-means++ initialization.
+    Returns the cluster of every vector and the centroids. The seed is fixed, so the same papers always give the same clusters.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    k = min(k, n)
+    # All distances are computed as |v|^2 - 2 v.c + |c|^2, so they are matrix products instead of huge temporary arrays.
+    squared_norms = np.sum(vectors**2, axis=1)
+
+    # k-means++: every next centroid is picked with a probability proportional to its squared distance to the closest one so far.
+    centroids = np.empty((k, vectors.shape[1]), dtype=vectors.dtype)
+    centroids[0] = vectors[rng.integers(n)]
+    closest = squared_norms - 2 * (vectors @ centroids[0]) + centroids[0] @ centroids[0]
+    for c in range(1, k):
+        # Rounding can make the distance of a vector to itself slightly negative.
+        closest = np.maximum(closest, 0)
+        # Sampling by the cumulative sum, rng.choice with p checks the whole distribution on every call and is slow.
+        cumulative = np.cumsum(closest)
+        if cumulative[-1] > 0:
+            index = int(np.searchsorted(cumulative, rng.random() * cumulative[-1]))
+        else:
+            index = int(rng.integers(n))
+        centroids[c] = vectors[min(index, n - 1)]
+        closest = np.minimum(
+            closest,
+            squared_norms - 2 * (vectors @ centroids[c]) + centroids[c] @ centroids[c],
+        )
+
+    labels = np.full(n, -1)
+    for _ in range(kmeans_iterations):
+        # The squared distances of all vectors to all centroids at once.
+        distances = (
+            squared_norms[:, np.newaxis]
+            - 2 * (vectors @ centroids.T)
+            + np.sum(centroids**2, axis=1)[np.newaxis, :]
+        )
+        new_labels = np.argmin(distances, axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        # The new centroids are the means of their members, summed up for all clusters at once.
+        one_hot = np.zeros((k, n), dtype=vectors.dtype)
+        one_hot[labels, np.arange(n)] = 1
+        sums = one_hot @ vectors
+        counts = np.bincount(labels, minlength=k)
+        # An empty cluster keeps its old centroid, it may win some vectors back in the next iteration.
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+    return labels, centroids
+
+
+def cluster_vectors(vectors: np.ndarray) -> list[list[int]]:
+    """Clusters the vectors and returns the clusters as lists of row indices, each sorted by the distance to its centroid
+    (closest first, so the first ones are the representatives). Empty clusters are left out.
+    """
+    k = min(max_clusters, max(1, math.ceil(len(vectors) / papers_per_cluster)))
+    labels, centroids = kmeans(vectors, k)
+    clusters = []
+    for c in range(len(centroids)):
+        (members,) = np.nonzero(labels == c)
+        if len(members) == 0:
+            continue
+        distances = np.sum((vectors[members] - centroids[c]) ** 2, axis=1)
+        clusters.append([int(i) for i in members[np.argsort(distances)]])
+    return clusters
+
+
+async def embed_papers(request_status: RequestStatus) -> Optional[np.ndarray]:
+    """Embeds the title and abstract of every paper. Returns the normalized vectors, or None if the embedding failed."""
+    embeddings: list[list[float]] = []
+    for start in range(0, request_status.num_papers(), embedding_batch_size):
+        texts = []
+        for i in range(
+            start, min(start + embedding_batch_size, request_status.num_papers())
+        ):
+            article = request_status.get_paper(i)
+            texts.append(f"{article.title}\n{article.abstract}")
+        batch = await embed(texts)
+        if batch is None:
+            return None
+        embeddings.extend(batch)
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def representatives(request_status: RequestStatus, cluster: list[int]) -> list[int]:
+    """Returns the papers of the cluster that are scored by the LLM."""
+    return cluster[: request_status.settings.representatives_per_cluster]
+
+
+def _representative_scores(
+    request_status: RequestStatus, cluster: list[int]
+) -> Optional[list[float]]:
+    """Returns the scores of the representatives of the cluster, or None if some are not scored yet."""
+    scores = [
+        request_status.get_paper_relevance(i)
+        for i in representatives(request_status, cluster)
+    ]
+    if any(score is None for score in scores):
+        return None
+    return scores
+
+
+def papers_to_score(request_status: RequestStatus) -> list[int]:
+    """Returns the papers whose relevance should be checked by the LLM next.
+    Without clusters, that is every paper without a score. With clusters, it is only the representatives,
+    and once they are all scored, the papers of the clusters whose representatives disagree.
+    """
+    relevances = request_status.paper_relevances()
+    unscored = [i for i, relevance in enumerate(relevances) if relevance is None]
+    if not request_status.paper_clusters:
+        return unscored
+
+    to_score = [
+        i
+        for cluster in request_status.paper_clusters
+        for i in representatives(request_status, cluster)
+        if relevances[i] is None
+    ]
+    if to_score:
+        return to_score
+    # All representatives are scored, so whatever is left couldn't be given a propagated score.
+    return unscored
+
+
+def propagate_cluster_scores(request_status: RequestStatus) -> int:
+    """Gives the unscored papers of every cluster the mean score of its representatives, if they agree.
+    Returns the number of papers that got a score this way.
+    """
+    propagated = 0
+    for cluster in request_status.paper_clusters:
+        scores = _representative_scores(request_status, cluster)
+        if scores is None or max(scores) - min(scores) > max_representative_spread:
+            continue
+        mean = sum(scores) / len(scores)
+        for i in cluster:
+            if request_status.get_paper_relevance(i) is None:
+                request_status.set_paper_relevance(i, mean)
+                propagated += 1
+    return propagated
@@ -0,0 +1,222 @@
+# Deduplication of the literature of a request, before any relevance scoring.
+
+# The relevant_literature agent often returns the same work several times: as a preprint and as the published version,
+# or with different forms of the same URL (http/https, with tracking parameters, doi.org and dx.doi.org, ...).
+# Every copy would then be scored and turned into questions on its own, which costs LLM calls and duplicates questions.
+# Here the works are grouped by their normalized DOI, their normalized URL and a fingerprint of their title,
+# and every group is merged into a single Article.
+# Everything goes through hash indexes, so only works that share a key are ever compared. Titles that only share a key
+# are confirmed with the edit distance before they are merged. A key shared by very many different works ("a survey of
+# deep learning ...") says little about any of them, so its bucket stops growing at max_bucket_size, which keeps the
+# number of comparisons linear in the number of papers.
+
+import re
+import unicodedata
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from MCP.types import Article
+
+# Two titles are the same work if at most this share of their characters differs (e.g. a fixed typo or a changed word).
+max_title_distance = 0.1
+# Titles shorter than this (after normalization) are too generic ("Introduction", "Editorial") to merge works by.
+min_title_length = 20
+# How many words at the start and at the end of a title are hashed for the fuzzy index.
+fingerprint_words = 4
+# How many different works a key of the fuzzy index holds at most. Later titles with that key are not compared under it.
+max_bucket_size = 32
+
+# A DOI ends at the query or the fragment of the URL it is in.
+_doi_pattern = re.compile(r"10\.\d{4,9}/[^\s\"<>?#]+", re.IGNORECASE)
+_arxiv_pattern = re.compile(
+    r"arxiv\.org/(?:abs|pdf)/(\d{4}\.\d{4,5}|[a-z\-]+(?:\.[a-z]{2})?/\d{7})(?:v\d+)?",
+    re.IGNORECASE,
+)
+# Query parameters that only track where a click came from.
+_tracking_params = re.compile(r"^(utm_.*|fbclid|gclid|ref|referrer|source)$")
+_stop_words = {"a", "an", "the", "of", "and", "or", "in", "on", "for", "to", "with"}
+
+
+def normalize_doi(text: Optional[str]) -> Optional[str]:
+    """Returns the DOI in a text (usually a URL like https://doi.org/10.1000/XYZ) in lower case, or None if there is none.
+    DOIs are case-insensitive, so the lower case form can be compared directly.
+    """
+    if not text:
+        return None
+    match = _doi_pattern.search(text)
+    if match is None:
+        return None
+    # Trailing punctuation is almost never part of the DOI, but often of the sentence around it.
+    return match.group(0).rstrip(".,;)]}").lower()
+
+
+def normalize_url(url: Optional[str]) -> Optional[str]:
+    """Returns a canonical form of the URL, so different links to the same page compare equal.
+    The scheme, "www.", the fragment, tracking parameters and a trailing slash are removed.
+    Links to a DOI or an arXiv paper are reduced to the DOI or the arXiv ID, since there are many forms of those.
+    """
+    if not url:
+        return None
+    doi = normalize_doi(url)
+    if doi is not None:
+        return "doi:" + doi
+    arxiv = _arxiv_pattern.search(url)
+    if arxiv is not None:
+        # The versions (v1, v2, ...) of an arXiv paper are the same work.
+        return "arxiv:" + arxiv.group(1).lower()
+
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix("www.")
+    query = urlencode(
+        sorted(
+            (name, value)
+            for name, value in parse_qsl(parts.query)
+            if not _tracking_params.match(name.lower())
+        )
+    )
+    return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))
+
+
+def normalize_title(title: Optional[str]) -> str:
+    """Returns the title in lower case, without accents, punctuation and extra whitespace."""
+    if not title:
+        return ""
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(char for char in title if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^\w\s]", " ", title.lower()).split())
+
+
+def title_fingerprints(normalized_title: str) -> list[str]:
+    """Returns the keys under which the title is put into the fuzzy index.
+    A preprint and its published version usually differ only at one end of the title (a subtitle, a typo fix),
+    so one key is made from the first words and one from the last words. Two titles that differ at both ends
+    are not found, but they are also rarely the same work.
+    """
+    words = [word for word in normalized_title.split() if word not in _stop_words]
+    if len(normalized_title) < min_title_length or not words:
+        return []
+    return [
+        "head:" + " ".join(words[:fingerprint_words]),
+        "tail:" + " ".join(words[-fingerprint_words:]),
+    ]
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Returns the Levenshtein distance between a and b, or limit + 1 as soon as it is sure to be larger than limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _same_title(a: str, b: str) -> bool:
+    limit = int(max(len(a), len(b)) * max_title_distance)
+    return edit_distance(a, b, limit) <= limit
+
+
+def _author_names(author: Optional[str]) -> set[str]:
+    return {word for word in normalize_title(author).split() if len(word) > 1}
+
+
+def _authors_conflict(a: Article, b: Article) -> bool:
+    """Whether two works with similar titles are clearly by different people, e.g. two different "A Survey of ..." papers.
+    Only a missing overlap of the names counts, since the agents format the authors very differently.
+    """
+    names_a, names_b = _author_names(a.author), _author_names(b.author)
+    return bool(names_a and names_b and not names_a & names_b)
+
+
+def find_duplicates(articles: list[Article]) -> list[list[int]]:
+    """Groups the articles that are the same work. Returns the groups as lists of indices, in the order of their first article.
+    Articles are the same work if they have the same DOI or URL, or if their titles are almost the same and their authors
+    don't contradict that.
+    """
+    parents = list(range(len(articles)))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(i: int, j: int):
+        i, j = find(i), find(j)
+        if i != j:
+            # The smaller index stays the root, so the groups keep the order of the articles.
+            parents[max(i, j)] = min(i, j)
+
+    url_index: dict[str, int] = {}
+    fuzzy_index: dict[str, list[int]] = {}
+    titles = [normalize_title(article.title) for article in articles]
+    for i, article in enumerate(articles):
+        url = normalize_url(article.url)
+        if url is not None:
+            if url in url_index:
+                union(url_index[url], i)
+            else:
+                url_index[url] = i
+
+        # Same titles are found here as well (with a distance of 0), so the authors are checked for them too.
+        for key in title_fingerprints(titles[i]):
+            candidates = fuzzy_index.setdefault(key, [])
+            merged = False
+            for j in candidates:
+                if find(i) == find(j):
+                    merged = True
+                elif not _authors_conflict(article, articles[j]) and _same_title(
+                    titles[i], titles[j]
+                ):
+                    union(i, j)
+                    merged = True
+            # A bucket only holds one title per work, a duplicate is already represented by the title it was merged with.
+            if not merged and len(candidates) < max_bucket_size:
+                candidates.append(i)
+
+    groups: dict[int, list[int]] = {}
+    for i in range(len(articles)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def merge_articles(articles: list[Article]) -> Article:
+    """Merges several versions of the same work into one Article.
+    The version with the longest abstract is kept, its missing fields are filled from the others,
+    and if any version has a DOI, the URL points to the DOI (which always resolves to the published version).
+    """
+    best = max(articles, key=lambda article: len(article.abstract or ""))
+    merged = best.model_copy()
+    for article in articles:
+        merged.title = merged.title or article.title
+        merged.author = merged.author or article.author
+        merged.url = merged.url or article.url
+    for article in articles:
+        doi = normalize_doi(article.url)
+        if doi is not None:
+            merged.url = "https://doi.org/" + doi
+            break
+    return merged
+
+
+def deduplicate_articles(articles: list[Article]) -> list[Article]:
+    """Merges the duplicates among the articles. Returns the remaining articles, in the order of their first version.
+    It runs before any relevance scoring, so there are no scores to merge.
+    """
+    return [
+        merge_articles([articles[i] for i in group])
+        for group in find_duplicates(articles)
+    ]
@@ -0,0 +1,224 @@
+# Full-text retrieval of articles, for retrieval-augmented question generation.
+
+# The question generation only sees the title, author and abstract of an article, which is often too little.
+# Here the full texts are downloaded (HTML or PDF), split into chunks and put into a small vector index per request,
+# so that only the few chunks most relevant to the research question end up in the prompt.
+# Downloads are cached on disk by content hash, so no document is ever fetched twice, not even across requests.
+
+import asyncio
+import hashlib
+import io
+import os
+import re
+from html.parser import HTMLParser
+from typing import Optional
+
+import httpx
+import numpy as np
+
+from MCP.ollama import embed
+
+FULLTEXT_CACHE_DIR = "MCP/cache/fulltext"
+
+fetch_concurrency = 8  # How many documents are downloaded at the same time.
+max_download_bytes = (
+    20 * 2**20
+)  # Larger documents are not downloaded, they are rarely articles and would only fill the memory.
+chunk_words = 200  # The size of a chunk in words.
+chunk_overlap = (
+    40  # How many words consecutive chunks share, so no sentence is lost at the border.
+)
+max_chunks_per_document = (
+    100  # Very long documents are cut off, embedding them completely is not worth it.
+)
+chunks_per_article = 3  # How many chunks of an article go into the prompt.
+embedding_batch_size = 64  # How many chunks are embedded in one call.
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML page, skipping scripts and styles."""
+
+    def __init__(self):
+        super().__init__()
+        self.parts: list[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "noscript"):
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "noscript") and self._skipping:
+            self._skipping -= 1
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def extract_text(content: bytes, content_type: str) -> str:
+    """Extracts the plain text of a downloaded document."""
+    if "pdf" in content_type or content.startswith(b"%PDF"):
+        from pypdf import PdfReader
+
+        reader = PdfReader(io.BytesIO(content))
+        text = "\n".join(page.extract_text() or "" for page in reader.pages)
+    else:
+        extractor = _TextExtractor()
+        extractor.feed(content.decode("utf-8", errors="replace"))
+        text = " ".join(extractor.parts)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _cached_text(url: str) -> Optional[str]:
+    """Returns the cached text of the URL, or None if it was never downloaded.
+    If the text file is gone (e.g. the cache was cleaned up by hand), that is a miss as well, and the URL is downloaded again.
+    """
+    url_file = os.path.join(FULLTEXT_CACHE_DIR, "urls", _sha256(url.encode()))
+    try:
+        with open(url_file, "r") as file:
+            content_hash = file.read().strip()
+        with open(os.path.join(FULLTEXT_CACHE_DIR, content_hash + ".txt"), "r") as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def _cache_text(url: str, text: str):
+    """Stores the text under its content hash and points the URL to it.
+    Different URLs for the same document (e.g. with and without tracking parameters) share one stored copy.
+    """
+    os.makedirs(os.path.join(FULLTEXT_CACHE_DIR, "urls"), exist_ok=True)
+    content_hash = _sha256(text.encode())
+    text_file = os.path.join(FULLTEXT_CACHE_DIR, content_hash + ".txt")
+    if not os.path.exists(text_file):
+        with open(text_file, "w") as file:
+            file.write(text)
+    with open(
+        os.path.join(FULLTEXT_CACHE_DIR, "urls", _sha256(url.encode())), "w"
+    ) as file:
+        file.write(content_hash)
+
+
+async def fetch_full_texts(urls: list[str]) -> dict[str, Optional[str]]:
+    """Downloads the full texts of the given URLs concurrently, using the cache wherever possible.
+    Returns the text for each URL, or None if it could not be downloaded.
+    """
+    texts: dict[str, Optional[str]] = {}
+    to_fetch = []
+    unique_urls = list(dict.fromkeys(urls))  # Removes duplicates, keeping the order.
+    # The cache is on disk, so it is read (and written below) in a thread, like the PDFs are parsed.
+    cached_texts = await asyncio.to_thread(
+        lambda: [_cached_text(url) for url in unique_urls]
+    )
+    for url, cached in zip(unique_urls, cached_texts):
+        if cached is not None:
+            texts[url] = cached
+        else:
+            to_fetch.append(url)
+
+    semaphore = asyncio.Semaphore(fetch_concurrency)
+
+    async def fetch(client: httpx.AsyncClient, url: str):
+        async with semaphore:
+            try:
+                content, content_type = await _download(client, url)
+                # Parsing a PDF takes long enough to stall every other request, so it runs in a thread.
+                text = await asyncio.to_thread(extract_text, content, content_type)
+            except Exception as e:
+                print(f"Error fetching full text of {url}: {e}")
+                texts[url] = None
+                return
+        await asyncio.to_thread(_cache_text, url, text)
+        texts[url] = text
+
+    # One client for all downloads, so connections to the same host are reused.
+    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+        await asyncio.gather(*(fetch(client, url) for url in to_fetch))
+    return texts
+
+
+async def _download(client: httpx.AsyncClient, url: str) -> tuple[bytes, str]:
+    """Downloads a document and returns its content and content type.
+    The body is streamed, so anything over max_download_bytes is rejected before it is read completely.
+    """
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        length = response.headers.get("content-length", "")
+        if length.isdigit() and int(length) > max_download_bytes:
+            raise ValueError(f"The document has {length} bytes, that is too large.")
+        content = bytearray()
+        async for data in response.aiter_bytes():
+            content += data
+            if len(content) > max_download_bytes:
+                raise ValueError(
+                    f"The document has more than {max_download_bytes} bytes, that is too large."
+                )
+        return bytes(content), response.headers.get("content-type", "")
+
+
+def split_into_chunks(text: str) -> list[str]:
+    """Splits a text into overlapping chunks of chunk_words words."""
+    words = text.split()
+    step = chunk_words - chunk_overlap
+    chunks = [
+        " ".join(words[start : start + chunk_words])
+        for start in range(0, max(len(words) - chunk_overlap, 1), step)
+    ]
+    return chunks[:max_chunks_per_document]
+
+
+class ChunkIndex:
+    """A vector index over the chunks of the full texts of one request."""
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.owners: list[int] = []  # The index of the paper each chunk belongs to.
+        self.matrix: Optional[np.ndarray] = (
+            None  # The normalized embeddings, one row per chunk.
+        )
+
+    async def build(self, texts: dict[int, str]) -> bool:
+        """Chunks and embeds the texts, keyed by the index of their paper. Returns False if the embedding failed."""
+        for paper_index, text in texts.items():
+            chunks = split_into_chunks(text)
+            self.chunks.extend(chunks)
+            self.owners.extend([paper_index] * len(chunks))
+        if not self.chunks:
+            return True
+        embeddings: list[list[float]] = []
+        for start in range(0, len(self.chunks), embedding_batch_size):
+            batch = await embed(self.chunks[start : start + embedding_batch_size])
+            if batch is None:
+                return False
+            embeddings.extend(batch)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        self.matrix = matrix / np.maximum(
+            np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12
+        )
+        return True
+
+    async def top_chunks(self, query: str, k: int) -> dict[int, list[str]]:
+        """Returns the k chunks most similar to the query for every paper of the index."""
+        if self.matrix is None:
+            return {}
+        embeddings = await embed([query])
+        if embeddings is None:
+            return {}
+        query_vector = np.asarray(embeddings[0], dtype=np.float32)
+        similarities = self.matrix @ (
+            query_vector / max(np.linalg.norm(query_vector), 1e-12)
+        )
+
+        owners = np.asarray(self.owners)
+        result: dict[int, list[str]] = {}
+        for paper_index in set(self.owners):
+            (positions,) = np.nonzero(owners == paper_index)
+            best = positions[np.argsort(-similarities[positions])[:k]]
+            # Keep the chunks in document order, so the excerpts read naturally.
+            result[paper_index] = [self.chunks[i] for i in sorted(best)]
+        return result
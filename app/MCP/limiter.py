@@ -0,0 +1,216 @@
+# Adaptive concurrency limit for the LLM calls.
+
+# A fixed limit is always wrong: the number of Ollama slots, the model size and the CPU load change all the time,
+# and too many parallel calls just queue up inside Ollama and inflate the latency of every single one.
+# Instead, the limit is found with AIMD (additive increase, multiplicative decrease), like TCP does it:
+# while the throughput improves, one more call is allowed; on latency spikes or when many calls time out
+# or can't connect, the limit is cut. A model answer that doesn't parse says nothing about the load, so it doesn't count.
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, TypeVar
+
+import httpx
+
+
+class AdaptiveLimiter:
+    """Limits the number of concurrent calls, adapting the limit to the measured latency, throughput and error rate.
+    The limit is re-evaluated after every window of completed calls.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 2,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        window: int = 8,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        max_error_rate: float = 0.25,
+    ):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = (
+            window  # Number of completed calls after which the limit is re-evaluated.
+        )
+        self.decrease_factor = (
+            decrease_factor  # The limit is multiplied by this on congestion.
+        )
+        self.latency_tolerance = latency_tolerance  # A window slower than the baseline times this counts as a latency spike.
+        self.max_error_rate = max_error_rate  # A window with a larger share of failed calls counts as congested.
+
+        self.in_flight = 0
+        self.baseline_latency: float | None = (
+            None  # The lowest average latency seen so far, the latency without congestion.
+        )
+        self._condition: asyncio.Condition | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+        # Statistics of the current window.
+        self._window_start = time.monotonic()
+        self._window_latencies: list[float] = []
+        self._window_failures = 0
+        self._last_throughput: float | None = None
+
+        # Totals, for the metrics.
+        self.total_calls = 0
+        self.total_failures = 0
+
+    def _get_condition(self) -> asyncio.Condition:
+        """Returns the condition of the running event loop. Asyncio primitives are bound to a loop, so a new one is needed per loop."""
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self.in_flight = 0
+        return self._condition
+
+    async def acquire(self):
+        """Waits until a call may start."""
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, latency: float | None, failed: bool):
+        """Marks a call as finished and adapts the limit once the window is full.
+        A latency of None means the call was cancelled: it gives its slot back, but says nothing about congestion.
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if latency is None:
+                condition.notify_all()
+                return
+            self.total_calls += 1
+            self._window_latencies.append(latency)
+            if failed:
+                self.total_failures += 1
+                self._window_failures += 1
+            if len(self._window_latencies) >= self.window:
+                self._adapt()
+            condition.notify_all()
+
+    def _adapt(self):
+        """Re-evaluates the limit from the statistics of the finished window, then starts a new window."""
+        now = time.monotonic()
+        average_latency = sum(self._window_latencies) / len(self._window_latencies)
+        throughput = len(self._window_latencies) / max(now - self._window_start, 1e-9)
+
+        if self.baseline_latency is None or average_latency < self.baseline_latency:
+            self.baseline_latency = average_latency
+
+        congested = (
+            self._window_failures / len(self._window_latencies) > self.max_error_rate
+            or average_latency > self.baseline_latency * self.latency_tolerance
+        )
+        if congested:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        elif self._last_throughput is None or throughput > self._last_throughput:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_latencies = []
+        self._window_failures = 0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[Callable[[], None]]:
+        """Runs the body of the with statement in a slot of the limiter.
+        The body gets a function it can call to mark the call as failed (e.g. if it timed out, see is_congestion_error).
+        Exceptions count as failures, so the callers only let those through that mean congestion.
+        Cancellations don't count: speculative attempts that lost, aborted requests and deadlines cancel calls
+        all the time, and that is no sign of an overloaded model.
+        """
+        failed = False
+        cancelled = False
+
+        def mark_failed():
+            nonlocal failed
+            failed = True
+
+        await self.acquire()
+        start = time.monotonic()
+        try:
+            yield mark_failed
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            await self.release(None if cancelled else time.monotonic() - start, failed)
+
+    def metrics(self) -> dict:
+        """Returns the current state of the limiter, for logging."""
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "baseline_latency": self.baseline_latency,
+            "last_throughput": self._last_throughput,
+            "error_rate": (
+                self.total_failures / self.total_calls if self.total_calls else 0.0
+            ),
+        }
+
+
+def is_congestion_error(exception: BaseException) -> bool:
+    """Whether an exception of an LLM call means that the model is overloaded: a timeout, a connection problem
+    or an answer like "too many requests". Invalid answers of the model don't count.
+    """
+    if isinstance(exception, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code in (429, 503)
+    # The openai client (used by the mcp_agent library) wraps the httpx errors, but its exceptions carry the name of the problem.
+    return type(exception).__name__ in (
+        "APIConnectionError",
+        "APITimeoutError",
+        "RateLimitError",
+    )
+
+
+# The limiter in front of all LLM calls, see MCP.agents.base.
+llm_limiter = AdaptiveLimiter()
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def run_concurrently(
+    items: Iterable[T],
+    fn: Callable[[T], Awaitable[R]],
+    on_result: Optional[Callable[[T, R], None]] = None,
+) -> list[R | BaseException]:
+    """Runs fn on all items concurrently and returns the results in order, like asyncio.gather(..., return_exceptions=True).
+    Only as many calls as the limiter could ever allow are started at once, so e.g. the prompts for thousands of papers
+    are not all built (and held in memory) up front.
+    If on_result is given, it is called with every item and its result as soon as that item is done (not for exceptions).
+    The stages use it to write each result into the request status right away, so if the stage is cancelled
+    (e.g. by the deadline of the request), the items that were done are kept.
+    """
+    items = list(items)
+    results: list[R | BaseException] = [None] * len(items)  # type: ignore
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(items):
+            index = next_index
+            next_index += 1
+            try:
+                results[index] = await fn(items[index])
+            except Exception as e:
+                results[index] = e
+                continue
+            if on_result is not None:
+                on_result(items[index], results[index])
+
+    await asyncio.gather(
+        *(worker() for _ in range(min(llm_limiter.max_limit, len(items))))
+    )
+    return results
@@ -0,0 +1,167 @@
+# Relevance scores from the token probabilities of the model, instead of a generated number.
+
+# Asking the model to write a score gives slow, noisy answers that sometimes don't even parse.
+# Here the model is asked for a single digit from 0 (not relevant) to 9 (highly relevant), only one token is decoded,
+# and the score is the expected digit under the probabilities of the digit tokens. That always gives a number,
+# and it is smoother than the digit the model would have written (a model torn between 3 and 7 gives 0.56, not 0.33).
+# The raw scores of a small model are often squeezed into a narrow range, so they can be calibrated per agent
+# against a small labelled set (Platt scaling, see MCP.calibrate_relevance).
+
+import json
+import math
+import os
+from typing import Optional
+
+import numpy as np
+
+from MCP.limiter import is_congestion_error
+from MCP.ollama import DEFAULT_MODEL, backend_pool, llm_http_client
+
+CALIBRATION_FILE = "MCP/cache/relevance_calibration.json"
+
+grade_tokens = [str(grade) for grade in range(10)]
+top_logprobs = 20  # How many of the most likely tokens Ollama returns. The digits are almost always among them.
+
+
+def expected_grade(candidates: list[dict]) -> Optional[float]:
+    """Returns the expected grade (scaled to 0-1) under the probabilities of the digit tokens among the candidates,
+    each a {"token": ..., "logprob": ...} dict. Returns None if no digit is among them.
+    """
+    probabilities = [0.0] * len(grade_tokens)
+    for candidate in candidates:
+        token = candidate.get("token", "").strip()
+        if token in grade_tokens:
+            # The same digit can come as several tokens (e.g. with a leading space), so they are summed up.
+            probabilities[int(token)] += math.exp(candidate["logprob"])
+    total = sum(probabilities)
+    if total == 0:
+        return None
+    return sum(grade * p for grade, p in enumerate(probabilities)) / total / 9
+
+
+class Calibration:
+    """Platt scaling of the raw scores of one agent: calibrated = sigmoid(a * logit(raw) + b)."""
+
+    def __init__(self, a: float = 1.0, b: float = 0.0):
+        self.a = a
+        self.b = b
+
+    def __call__(self, raw: float) -> float:
+        return float(1 / (1 + np.exp(-(self.a * _logit(raw) + self.b))))
+
+    @classmethod
+    def fit(
+        cls, raw_scores: list[float], labels: list[float], l2: float = 1e-3
+    ) -> "Calibration":
+        """Fits the scaling to labelled scores (labels between 0 and 1) by Newton's method on the log loss.
+        The small L2 penalty keeps it finite if the labelled set is perfectly separated.
+        """
+        x = np.array([_logit(raw) for raw in raw_scores])
+        y = np.asarray(labels, dtype=float)
+        features = np.column_stack([x, np.ones_like(x)])
+        weights = np.array([1.0, 0.0])
+        for _ in range(100):
+            predictions = 1 / (1 + np.exp(-(features @ weights)))
+            gradient = features.T @ (predictions - y) + l2 * weights
+            hessian = features.T @ (
+                features * (predictions * (1 - predictions))[:, np.newaxis]
+            ) + l2 * np.eye(2)
+            step = np.linalg.solve(hessian, gradient)
+            weights -= step
+            if np.max(np.abs(step)) < 1e-8:
+                break
+        return cls(float(weights[0]), float(weights[1]))
+
+
+def _logit(p: float) -> float:
+    p = min(max(p, 1e-4), 1 - 1e-4)
+    return math.log(p / (1 - p))
+
+
+_calibrations: Optional[dict[str, Calibration]] = None
+
+
+def load_calibrations(path: str = CALIBRATION_FILE) -> dict[str, Calibration]:
+    """Loads the calibrations of all agents, once per process. Agents without one use the raw scores."""
+    global _calibrations
+    if _calibrations is None:
+        _calibrations = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for agent_name, params in json.load(file).items():
+                    _calibrations[agent_name] = Calibration(params["a"], params["b"])
+    return _calibrations
+
+
+def save_calibration(
+    agent_name: str, calibration: Calibration, path: str = CALIBRATION_FILE
+):
+    """Stores the calibration of an agent, next to those of the other agents."""
+    calibrations = load_calibrations(path)
+    calibrations[agent_name] = calibration
+    with open(path, "w") as file:
+        json.dump(
+            {name: {"a": c.a, "b": c.b} for name, c in calibrations.items()},
+            file,
+            indent=2,
+        )
+
+
+def engine_fingerprint(engine: str, agent_name: str) -> list:
+    """Returns what the scores of the engine depend on besides the prompt, for the keys of the stage memo (see MCP.memo).
+    With the logprob engine, that is the calibration of the agent, so the scores are not reused once it is refitted.
+    """
+    if engine != "logprob":
+        return [engine]
+    calibration = load_calibrations().get(agent_name)
+    if calibration is None:
+        return [engine, None]
+    return [engine, calibration.a, calibration.b]
+
+
+async def raw_logprob_score(
+    agent_name: str, prompt: str, model: Optional[str] = None
+) -> Optional[float]:
+    """Asks the model for a single token and returns the expected grade of the prompt, uncalibrated.
+    Returns None if Ollama gives no probabilities or none of the likely tokens is a digit.
+    """
+    model = model or DEFAULT_MODEL
+    request = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": False,
+        "think": False,
+        "logprobs": True,
+        "top_logprobs": top_logprobs,
+        "options": {"num_predict": 1},
+    }
+    async with backend_pool.backend(model) as backend:
+        response = await llm_http_client(agent_name).post(
+            backend.base_url + "/api/chat", json=request
+        )
+        response.raise_for_status()
+    tokens = response.json().get("logprobs") or []
+    if not tokens:
+        return None
+    # The probabilities of the first (and only) decoded token.
+    return expected_grade(tokens[0].get("top_logprobs") or [tokens[0]])
+
+
+async def logprob_score(
+    agent_name: str, prompt: str, model: Optional[str] = None
+) -> Optional[float]:
+    """Returns the calibrated relevance score of the prompt (see the top of the file), or None if the call failed.
+    Timeouts and connection problems are raised instead, so the limiter can count them (see MCP.limiter).
+    """
+    try:
+        raw = await raw_logprob_score(agent_name, prompt, model)
+    except Exception as e:
+        if is_congestion_error(e):
+            raise
+        print(f"Error running agent {agent_name}: {e}")
+        return None
+    if raw is None:
+        print(f"Error running agent {agent_name}: no digit among the likely tokens.")
+        return None
+    calibration = load_calibrations().get(agent_name)
+    return calibration(raw) if calibration is not None else raw
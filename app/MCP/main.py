@@ -1,9 +1,9 @@
+import argparse
 import asyncio
+import os
 import time
 from typing import Awaitable, Callable, TypeVar
 
-import httpx
-
 from mcp_agent.app import MCPApp
 from mcp_agent.config import (
     LoggerSettings,
@@ -22,8 +22,20 @@ from MCP.agents.create_questions_from_article import (
 from MCP.agents.create_survey_question import run_create_survey_question_agent
 from MCP.agents.relevant_literature import run_relevant_literature_agent
 
+from MCP.cassette import is_replaying
+from MCP.limiter import llm_limiter
+from MCP.memo import stage_memo
+from MCP.ollama import (
+    DEFAULT_MODEL,
+    OLLAMA_BASE_URL,
+    backend_pool,
+    close_llm_http_clients,
+)
+from MCP.prompt import flush_token_usage, load_tokenizer
+from MCP.semantic_cache import remember_request
 from MCP.types import RequestStages, RequestStatus
-from MCP.steps import next_step, run_single_stage
+from MCP.steps import next_step, run_single_stage, run_step_function
+from MCP.work_queue import QUEUE_ENV, WorkQueue, run_stage_on_queue
 
 # The mcp_agent.config.yaml file is not working correctly for whatever reason, so instead, it's getting coded here.
 
@@ -41,14 +53,12 @@ mcp_settings = MCPSettings(
 )
 
 openai_settings = OpenAISettings(
-    # base_url="http://10.89.0.3:11434/v1", # The ollama virtual machine
-    base_url="http://host.docker.internal:11434/v1",  # The local ollama server (native is faster on my machine)
+    base_url=OLLAMA_BASE_URL + "/v1",  # The Ollama server is chosen in MCP.ollama.
     api_key="ollama",
     # The setting of the model using kwargs isn't documented, but it works.
-    # default_model="qwen3", # 8b Model
-    default_model="qwen3:0.6b",  # My memory isn't large enough for 8b, sorry :(
-    # default_model="llama3.2", # Trying out a non-reasoning model
-    http_client=httpx.Client(timeout=30.0),
+    default_model=DEFAULT_MODEL,  # The model is chosen in MCP.ollama.
+    # No http_client here: every call gets the shared async client of its agent (see MCP.ollama.llm_http_client).
+    # A synchronous client would block the event loop and serialize all agents.
 )
 
 logger = LoggerSettings(
@@ -93,12 +103,15 @@ app = MCPApp(
 
 T = TypeVar("T")
 
+retry_delay = 1.0  # Seconds between the tries of try_run_agent.
+
 
 async def try_run_agent(
     agent_func: Callable[..., Awaitable[T]], num_tries=3, *args, **kwargs
 ) -> T | None:
     """This function tries to run an agent function a number of times and returns the result if successful.
-    If it fails, it returns None.
+    If it fails, it returns None. The wait between the tries doesn't block the event loop, so the other items of the
+    stage keep running meanwhile.
     """
     result = None
     for i in range(num_tries):
@@ -106,7 +119,8 @@ async def try_run_agent(
             result = await agent_func(*args, **kwargs)
         except Exception as e:
             print(f"Error in try_run_agent: {e}")
-            time.sleep(1)
+            if i < num_tries - 1:
+                await asyncio.sleep(retry_delay)
         else:
             break  # Breaking is a fucking exception in Python, so we need the try-except-else block; breaking inside the try block will not work.
 
@@ -114,7 +128,7 @@ async def try_run_agent(
 
 
 paper_relevance_threshold = 0.5
-question_relevance_threshold = 0.5
+# The threshold for questions is a setting of the request, see StatusSetting.question_relevance_threshold.
 
 
 async def old_main_loop(research_question: str):
@@ -208,10 +222,11 @@ async def old_main_loop(research_question: str):
                     continue
 
             # Now we have a list of questions and their relevance scores. Let's filter them.
+        threshold = status.settings.question_relevance_threshold or 0.0
         status.questions = [
             question
             for question in status.questions
-            if question[1] is not None and question[1] > question_relevance_threshold
+            if question[1] is not None and question[1] >= threshold
         ]
 
         # Done for now!
@@ -219,47 +234,196 @@ async def old_main_loop(research_question: str):
         return status
 
 
-async def main_loop(research_question: str):
+async def main_loop(
+    research_question: str,
+    article_store: str | None = None,
+    timeout: float | None = None,
+    queue_path: str | None = None,
+    **settings,
+):
     """This is the main loop of a request. It takes in the research question and does all the steps to create the survey.
-    This time, it uses the stepping system to run the agents."""
+    This time, it uses the stepping system to run the agents.
+    If article_store is given, the request runs in large-run mode and keeps the article bodies in that SQLite file.
+    If timeout is given, the request is stopped after that many seconds and returns the questions that are complete by then.
+    If queue_path is given, the stages are not run here but handed to the workers of that work queue (see MCP.worker).
+    Any other keyword argument is a setting of the request (see StatusSetting), e.g. use_full_text=True.
+    """
 
     # Initializing the app
     async with app.run() as mcp_agent_app:
         logger = mcp_agent_app.logger
         logger.info("Starting main loop")
 
-        # The state is an object of type RequestStatus.
-        status = RequestStatus(
-            research_question,
-            2,  # For testing, we limit the number of papers to 2.
-            trace_file="MCP/traces/request-" + str(int(time.time())) + ".txt",
-        )  # The trace file is named with the current timestamp, so it is unique.
+        # Everything opened below is cleaned up in the finally block, even if a stage raises,
+        # so no SQLite handle, background task or connection pool is left behind.
+        health_checks = None
+        queue = None
+        status = None
+        try:
+            # Find out which Ollama backends are up and which models they have, then keep checking in the background.
+            # When replaying a cassette, no model is needed, so the backends are left alone.
+            if not is_replaying():
+                await backend_pool.check_health()
+                health_checks = asyncio.create_task(backend_pool.run_health_checks())
+            # The prompts are budgeted with the tokenizer of the model, which may have to be downloaded first.
+            await load_tokenizer()
+
+            # The state is an object of type RequestStatus.
+            status = RequestStatus(
+                research_question,
+                2,  # For testing, we limit the number of papers to 2.
+                trace_file="MCP/traces/request-" + str(int(time.time())) + ".txt",
+                article_store=article_store,
+                deadline=time.time() + timeout if timeout is not None else None,
+                **settings,
+            )  # The trace file is named with the current timestamp, so it is unique.
+
+            if queue_path is not None and article_store is not None:
+                # The papers of the large-run mode are in a local file that the workers might not see, so the stages are run here.
+                print(
+                    "Warning: requests in large-run mode can't be run by workers, running the stages in this process instead."
+                )
+            elif queue_path is not None:
+                queue = WorkQueue(queue_path)
 
-        stage = next_step(status)
-        while stage is not None and stage[3] != RequestStages.FINISHED:
-            print(
-                stage[0]
-            )  # The first element is a human-readable string describing the step.
-            # Run a single stage of the request.
-            status, step_info = await run_single_stage(status)
-            logger.debug(f"Finished stage: {stage[3]}")
-            logger.debug(f"Current status: {status}")
-            step_info.print_warnings_and_errors()
-            # DEBUG
-            print(f"Current status: {status}")
-
-            # Lastly, update the stage to the next step.
             stage = next_step(status)
-
-            # We could also run a single step instead.
-
-        # Result:
-        print(f"Relevant questions: {status.questions}")
-        if stage is None or stage[3] == RequestStages.FINISHED:
-            print("All stages finished successfully.")
-        else:
-            print(f"Last stage: {stage[3]}")
+            while (
+                stage is not None
+                and stage[3] != RequestStages.FINISHED
+                and not status.should_stop()
+            ):
+                print(
+                    stage[0]
+                )  # The first element is a human-readable string describing the step.
+                # Run a single stage of the request.
+                if queue is not None:
+                    # Let a worker run it. The deadline still applies here: if it passes, the job is cancelled.
+                    status, step_info = await run_step_function(
+                        status, lambda s: run_stage_on_queue(queue, s, stage[3])
+                    )
+                else:
+                    status, step_info = await run_single_stage(status)
+                logger.debug(f"Finished stage: {stage[3]}")
+                logger.debug(f"Current status: {status}")
+                step_info.print_warnings_and_errors()
+                logger.info(f"LLM concurrency: {llm_limiter.metrics()}")
+                memo = stage_memo(status)
+                if memo is not None:
+                    logger.info(f"Stage memo: {memo.hits} hits, {memo.misses} misses")
+                # DEBUG
+                print(f"Current status: {status}")
+
+                # Lastly, update the stage to the next step.
+                stage = next_step(status)
+
+                # We could also run a single step instead.
+
+            # Result:
+            if status.should_stop():
+                # The deadline passed or the request was cancelled, so finish gracefully with whatever is done.
+                print(f"Request stopped early in stage: {stage[3] if stage else None}")
+                print(f"Complete questions: {status.complete_questions()}")
+            elif stage is None or stage[3] == RequestStages.FINISHED:
+                print(f"Relevant questions: {status.questions}")
+                print("All stages finished successfully.")
+                # Let later requests with a similar research question reuse the papers of this one.
+                await remember_request(status)
+            else:
+                print(f"Relevant questions: {status.questions}")
+                print(f"Last stage: {stage[3]}")
+        finally:
+            if queue is not None:
+                queue.close()
+            if status is not None:
+                status.close()
+            if health_checks is not None:
+                health_checks.cancel()
+            await close_llm_http_clients()
+            flush_token_usage()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Creates a survey for a research question."
+    )
+    parser.add_argument(
+        "research_question",
+        nargs="?",
+        default="What is the impact of social media on mental health?",
+    )
+    parser.add_argument("--timeout", type=float, default=None, help="Deadline in s")
+    parser.add_argument(
+        "--article-store",
+        default=None,
+        help="Run in large-run mode, with the articles in this SQLite file",
+    )
+    parser.add_argument(
+        "--queue",
+        default=os.getenv(QUEUE_ENV),
+        help="Hand the stages to the workers of this work queue (see MCP.worker)",
+    )
+    # The optional features of the request, see StatusSetting.
+    parser.add_argument(
+        "--reuse-similar-requests",
+        action="store_true",
+        help="Reuse the papers of an earlier request with a similar research question",
+    )
+    parser.add_argument(
+        "--reuse-relevance-scores",
+        action="store_true",
+        help="Also reuse the relevance scores of that request",
+    )
+    parser.add_argument(
+        "--full-text",
+        action="store_true",
+        help="Give excerpts of the full texts to the question generation",
+    )
+    parser.add_argument(
+        "--articles-per-batch",
+        type=int,
+        default=1,
+        help="Create the questions of this many articles in one call",
+    )
+    parser.add_argument(
+        "--fuse-question-stages",
+        action="store_true",
+        help="Score and format a question in one call",
+    )
+    parser.add_argument(
+        "--cluster-papers",
+        action="store_true",
+        help="Only check the relevance of a few papers per topic cluster",
+    )
+    parser.add_argument(
+        "--relevance-engine",
+        choices=["generate", "logprob"],
+        default="generate",
+        help="How relevance scores are made",
+    )
+    parser.add_argument(
+        "--memoize-stages",
+        action="store_true",
+        help="Reuse the stage outputs of earlier requests with the same inputs",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        main_loop(
+            args.research_question,
+            article_store=args.article_store,
+            timeout=args.timeout,
+            queue_path=args.queue,
+            reuse_similar_requests=args.reuse_similar_requests,
+            reuse_relevance_scores=args.reuse_relevance_scores,
+            use_full_text=args.full_text,
+            articles_per_batch=args.articles_per_batch,
+            fuse_question_stages=args.fuse_question_stages,
+            cluster_papers=args.cluster_papers,
+            relevance_engine=args.relevance_engine,
+            memoize_stages=args.memoize_stages,
+        )
+    )
 
 
 if __name__ == "__main__":
-    asyncio.run(main_loop("What is the impact of social media on mental health?"))
+    main()
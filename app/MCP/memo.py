@@ -0,0 +1,192 @@
+# Memoization of the stage outputs, so a request that is run again with changed settings only does the new work.
+
+# Users often tweak a request and run it again: a higher paper_limit, more questions per article, another threshold.
+# Every stage stores the output of every item it works on (the score of a paper, the questions of an article, ...)
+# under a key derived from exactly the inputs of that item. A new request with the same inputs gets the stored output
+# instead of an LLM call; only items with new inputs are computed. E.g. with a higher question_per_article,
+# the papers keep their scores, and only the additional questions are generated for each article.
+#
+# The invalidation follows the RequestStages chain. The inputs of a stage contain the outputs of the earlier stages
+# (the question text, the article), so when those change, the keys change. When a stage itself changes
+# (e.g. a new prompt), its version in stage_versions is bumped. Every key contains the versions of its stage
+# and of all earlier ones, so that invalidates the outputs of the stage and of everything computed from them.
+#
+# The SQLite calls are blocking, and the stages look up many items at once, so memoized runs them in a thread.
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, Type, TypeVar
+
+from pydantic import TypeAdapter, ValidationError
+
+from MCP.ollama import DEFAULT_MODEL
+from MCP.types import RequestStages, RequestStatus
+
+MEMO_FILE = "MCP/cache/stage_memo.sqlite"
+
+# Bump the version of a stage whenever its outputs would be different for the same inputs (prompt, model or parsing changes).
+stage_versions: dict[RequestStages, int] = {
+    RequestStages.FINDING_LITERATURE: 1,
+    RequestStages.CLUSTERING_LITERATURE: 1,
+    RequestStages.CHECKING_LITERATURE_RELEVANCE: 1,
+    RequestStages.RETRIEVING_FULL_TEXT: 1,
+    RequestStages.CREATING_SURVEY_QUESTIONS: 1,
+    RequestStages.CHECKING_QUESTION_RELEVANCE: 1,
+    RequestStages.SCORING_AND_FORMATTING_SURVEY_QUESTIONS: 1,
+    RequestStages.FORMATTING_SURVEY_QUESTIONS: 1,
+    RequestStages.FINISHED: 1,
+}
+
+T = TypeVar("T")
+
+
+def chain_versions(stage: RequestStages) -> list[tuple[str, int]]:
+    """Returns the versions of the stage and of all stages before it, which are part of every key of the stage."""
+    return [
+        (earlier.name, stage_versions.get(earlier, 1))
+        for earlier in RequestStages
+        if earlier.value <= stage.value
+    ]
+
+
+class StageMemo:
+    """The memoized outputs of the stages, in a single SQLite file."""
+
+    def __init__(self, path: str = MEMO_FILE):
+        """Opens (or creates) the memo at the given path. ":memory:" gives a memo that is forgotten at the end of the process."""
+        self.path = path
+        # The connection is used from the threads of memoized, one at a time.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS outputs "
+                "(key TEXT PRIMARY KEY, stage TEXT NOT NULL, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+        self.hits = 0
+        self.misses = 0
+
+    def key(
+        self, stage: RequestStages, inputs: Any, model: Optional[str] = None
+    ) -> str:
+        """Returns the key of an output of the stage. The inputs must be JSON-serializable (e.g. article.model_dump()).
+        The model that computed the output (None for the default model) is part of the key as well,
+        another model gives other outputs.
+        """
+        data = json.dumps(
+            [chain_versions(stage), model or DEFAULT_MODEL, inputs],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(
+        self,
+        stage: RequestStages,
+        inputs: Any,
+        output_type: Type[T],
+        model: Optional[str] = None,
+    ) -> Optional[T]:
+        """Returns the memoized output of the stage for the inputs, or None if there is none.
+        An output that doesn't fit the output type anymore (e.g. the type changed without a version bump) counts as missing,
+        it is overwritten once the output is computed again.
+        """
+        key = self.key(stage, inputs, model)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM outputs WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            try:
+                value = TypeAdapter(output_type).validate_json(row[0])
+            except ValidationError as e:
+                print(
+                    f"Ignoring a memoized output of {stage.name} that doesn't validate: {e}"
+                )
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def put(
+        self,
+        stage: RequestStages,
+        inputs: Any,
+        output_type: Type[T],
+        value: T,
+        model: Optional[str] = None,
+    ):
+        """Memoizes the output of the stage for the inputs."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO outputs (key, stage, value, created) VALUES (?, ?, ?, ?)",
+                (
+                    self.key(stage, inputs, model),
+                    stage.name,
+                    TypeAdapter(output_type).dump_json(value).decode(),
+                    time.time(),
+                ),
+            )
+
+    def forget_from(self, stage: RequestStages):
+        """Deletes the outputs of the stage and of all later stages, e.g. to free space after their versions were bumped."""
+        later = [other.name for other in RequestStages if other.value >= stage.value]
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"DELETE FROM outputs WHERE stage IN ({', '.join('?' * len(later))})",
+                later,
+            )
+
+    def close(self):
+        """Closes the connection to the memo."""
+        with self._lock:
+            self._connection.close()
+
+
+_memo: Optional[StageMemo] = None
+
+
+def set_memo(memo: Optional[StageMemo]):
+    """Replaces the memo of this process, e.g. with an in-memory one so nothing is reused across runs."""
+    global _memo
+    _memo = memo
+
+
+def stage_memo(request_status: RequestStatus) -> Optional[StageMemo]:
+    """Returns the memo of this process (opening it on first use), or None if the request doesn't use memoization."""
+    global _memo
+    if not request_status.settings.memoize_stages:
+        return None
+    if _memo is None:
+        _memo = StageMemo()
+    return _memo
+
+
+async def memoized(
+    request_status: RequestStatus,
+    stage: RequestStages,
+    inputs: Any,
+    output_type: Type[T],
+    call: Callable[[], Awaitable[Optional[T]]],
+    model: Optional[str] = None,
+) -> Optional[T]:
+    """Returns the memoized output of the stage for the inputs, or runs the call and memoizes its result.
+    The model is the one the call uses (None for the default model).
+    Failed calls (None) are not memoized, so they are tried again next time.
+    """
+    memo = stage_memo(request_status)
+    if memo is None:
+        return await call()
+    value = await asyncio.to_thread(memo.get, stage, inputs, output_type, model)
+    if value is not None:
+        return value
+    value = await call()
+    if value is not None and not isinstance(value, Exception):
+        await asyncio.to_thread(memo.put, stage, inputs, output_type, value, model)
+    return value
@@ -0,0 +1,341 @@
+# Direct access to the Ollama server, for everything that doesn't go through an agent.
+
+# The agents themselves talk to Ollama over the mcp_agent library, which only needs the OpenAI-compatible base URL.
+# Some features (like embeddings) are not covered by the library, so they call the Ollama API directly from here.
+# Both kinds of calls are spread over a pool of Ollama backends, see OllamaBackendPool below.
+
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from MCP.cassette import get_cassette
+
+OLLAMA_BASE_URL = "http://host.docker.internal:11434"  # The local ollama server (native is faster on my machine)
+# OLLAMA_BASE_URL = "http://10.89.0.3:11434" # The ollama virtual machine
+
+# All Ollama servers that calls can be spread over. To raise the throughput, just add more machines here.
+# Backends that don't have a model pulled are never used for it, so listing the (often empty) container is harmless.
+OLLAMA_BACKENDS = [
+    OLLAMA_BASE_URL,
+    "http://10.89.0.3:11434",  # The ollama container from the docker-compose file
+]
+
+# The model used by all agents, unless they ask for a specific one.
+# DEFAULT_MODEL = "qwen3" # 8b Model
+DEFAULT_MODEL = "qwen3:0.6b"  # My memory isn't large enough for 8b, sorry :(
+# DEFAULT_MODEL = "llama3.2" # Trying out a non-reasoning model
+
+EMBEDDING_MODEL = (
+    "nomic-embed-text"  # Small and fast, good enough for comparing research questions.
+)
+
+
+# All HTTP traffic to Ollama goes over one connection pool, with explicit limits and keep-alive,
+# so connections are reused across agents and requests instead of being opened for every call.
+llm_pool_limits = httpx.Limits(
+    max_connections=64, max_keepalive_connections=32, keepalive_expiry=120.0
+)
+
+# The timeouts per agent. Connecting should always be quick, but reading differs a lot:
+# generating questions can take minutes on a CPU, while a score should come back in seconds.
+default_llm_timeout = httpx.Timeout(connect=5.0, read=300.0, write=30.0, pool=None)
+agent_timeouts: dict[str, httpx.Timeout] = {
+    "check_literature_relevance_agent": httpx.Timeout(
+        connect=5.0, read=60.0, write=30.0, pool=None
+    ),
+    "check_question_relevance_agent": httpx.Timeout(
+        connect=5.0, read=60.0, write=30.0, pool=None
+    ),
+    "score_and_format_question_agent": httpx.Timeout(
+        connect=5.0, read=60.0, write=30.0, pool=None
+    ),
+    # Only one token is decoded, so these are answered as soon as the prompt is read.
+    "check_literature_relevance_logprob_agent": httpx.Timeout(
+        connect=5.0, read=30.0, write=30.0, pool=None
+    ),
+    "check_question_relevance_logprob_agent": httpx.Timeout(
+        connect=5.0, read=30.0, write=30.0, pool=None
+    ),
+    "ollama_api": httpx.Timeout(connect=5.0, read=30.0, write=30.0, pool=None),
+}
+
+# Agents that are run over the streaming API of Ollama instead of the mcp_agent library (see MCP.agents.base).
+# Their answer is a short structured value, so the stream is closed as soon as a complete answer has been read.
+# The value says whether the model may think before answering. The qwen3 models think for hundreds of tokens by default,
+# which is wasted on a single score.
+streaming_agents: dict[str, bool] = {
+    "check_literature_relevance_agent": False,
+    "check_question_relevance_agent": False,
+    "score_and_format_question_agent": False,
+}
+
+# Agents whose answer is a relevance score read from the token probabilities of a single digit (see MCP.logprob_scoring).
+logprob_agents = {
+    "check_literature_relevance_logprob_agent",
+    "check_question_relevance_logprob_agent",
+}
+
+
+class _SharedAsyncClient(httpx.AsyncClient):
+    """An AsyncClient that can be handed to libraries which close their client after every call (like the openai client).
+    Closing it does nothing, the shared connection pool is only closed by close_llm_http_clients.
+    """
+
+    async def aclose(self) -> None:
+        pass
+
+    async def close_for_real(self):
+        await super().aclose()
+
+
+_transport: Optional[httpx.AsyncHTTPTransport] = None
+_transport_loop: Optional[asyncio.AbstractEventLoop] = None
+_clients: dict[str, _SharedAsyncClient] = {}
+
+
+def llm_http_client(agent_name: str) -> httpx.AsyncClient:
+    """Returns the async HTTP client for the calls of an agent.
+    Every agent gets its own timeouts, but all clients share the same transport, so there is only one connection pool.
+    """
+    global _transport, _transport_loop
+    loop = asyncio.get_running_loop()
+    if _transport is None or _transport_loop is not loop:
+        # The connections of a pool belong to an event loop, so a new loop needs a new pool.
+        _transport = httpx.AsyncHTTPTransport(limits=llm_pool_limits)
+        _transport_loop = loop
+        _clients.clear()
+    if agent_name not in _clients:
+        _clients[agent_name] = _SharedAsyncClient(
+            transport=_transport,
+            timeout=agent_timeouts.get(agent_name, default_llm_timeout),
+        )
+    return _clients[agent_name]
+
+
+async def close_llm_http_clients():
+    """Closes the shared connection pool. Meant to be called once, when the app shuts down."""
+    global _transport
+    for client in _clients.values():
+        await client.close_for_real()
+    _clients.clear()
+    if _transport is not None:
+        await _transport.aclose()
+        _transport = None
+
+
+class NoBackendAvailable(Exception):
+    """Raised when no healthy Ollama backend can serve the requested model."""
+
+
+class OllamaBackend:
+    """The state of a single Ollama server in the pool."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.outstanding = 0  # The number of calls currently running on this backend.
+        self.available_models: Optional[set[str]] = (
+            None  # The models pulled on this backend. None until the first health probe.
+        )
+        self.loaded_models: set[str] = set()  # The models currently loaded in memory.
+        self.consecutive_failures = 0
+        self.ejected_until: Optional[float] = (
+            None  # If set, the backend is ejected and only probed again after this time.
+        )
+
+    def can_serve(self, model: str) -> bool:
+        """Whether calls for the model may be routed to this backend right now.
+        Once the ejection time of an ejected backend is over, it is half-open: a single call may try it,
+        and if that call works, the backend is readmitted (see OllamaBackendPool.release).
+        So backends come back even where no health checks are running (e.g. in the calibration script).
+        """
+        if self.ejected_until is not None:
+            if self.ejected_until > time.monotonic() or self.outstanding > 0:
+                return False
+        # Before the first probe, we don't know the models, so we optimistically allow everything.
+        return (
+            self.available_models is None or model_tag(model) in self.available_models
+        )
+
+
+def model_tag(model: str) -> str:
+    """Returns the full name of a model as Ollama lists it, e.g. "nomic-embed-text" is listed as "nomic-embed-text:latest"."""
+    return model if ":" in model else model + ":latest"
+
+
+class OllamaBackendPool:
+    """Spreads calls over several Ollama backends.
+    A call goes to the healthy backend with the fewest outstanding requests. Backends that already have the model loaded
+    are preferred as long as they are not much busier than the others (model affinity), so models aren't swapped in and out.
+    Backends that fail repeatedly are ejected and readmitted once a health probe succeeds again.
+    """
+
+    def __init__(
+        self,
+        base_urls: list[str],
+        max_failures: int = 3,
+        ejection_time: float = 30.0,
+        affinity_slack: int = 2,
+    ):
+        self.backends = [OllamaBackend(base_url) for base_url in base_urls]
+        self.max_failures = (
+            max_failures  # Consecutive failures before a backend is ejected.
+        )
+        self.ejection_time = (
+            ejection_time  # Seconds before an ejected backend is probed again.
+        )
+        self.affinity_slack = affinity_slack  # How many more outstanding calls a backend with the model loaded may have.
+
+    def acquire(self, model: str) -> OllamaBackend:
+        """Picks the backend for a call with the given model and counts the call as outstanding on it."""
+        candidates = [backend for backend in self.backends if backend.can_serve(model)]
+        if not candidates:
+            raise NoBackendAvailable(f"No healthy Ollama backend can serve {model}.")
+
+        least_loaded = min(candidates, key=lambda backend: backend.outstanding)
+        warm = [
+            backend
+            for backend in candidates
+            if model_tag(model) in backend.loaded_models
+            and backend.outstanding <= least_loaded.outstanding + self.affinity_slack
+        ]
+        backend = (
+            min(warm, key=lambda backend: backend.outstanding) if warm else least_loaded
+        )
+
+        backend.outstanding += 1
+        return backend
+
+    def release(
+        self, backend: OllamaBackend, model: str, failed: bool, cancelled: bool = False
+    ):
+        """Marks a call on the backend as finished. Ejects the backend if it failed too often in a row.
+        A cancelled call only gives its place back: it didn't show that the backend works, nor that it doesn't.
+        """
+        backend.outstanding -= 1
+        if cancelled:
+            return
+        if not failed:
+            if backend.ejected_until is not None:
+                print(f"Readmitting Ollama backend {backend.base_url}.")
+                backend.ejected_until = None
+            backend.consecutive_failures = 0
+            backend.loaded_models.add(model_tag(model))
+            return
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= self.max_failures:
+            print(
+                f"Ejecting Ollama backend {backend.base_url} after {backend.consecutive_failures} failures."
+            )
+            backend.ejected_until = time.monotonic() + self.ejection_time
+            backend.loaded_models.clear()
+
+    @asynccontextmanager
+    async def backend(self, model: str) -> AsyncIterator[OllamaBackend]:
+        """Runs the body of the with statement on a backend of the pool.
+        Only connection problems count as failures of the backend, any other exception is the caller's problem.
+        Cancellations (speculative attempts that lost, deadlines, aborted requests) count as neither,
+        so a half-open backend is not readmitted by a call that never finished.
+        """
+        backend = self.acquire(model)
+        failed = False
+        cancelled = False
+        try:
+            yield backend
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            failed = is_backend_failure(e)
+            raise
+        finally:
+            self.release(backend, model, failed, cancelled)
+
+    async def probe(self, backend: OllamaBackend) -> bool:
+        """Asks the backend for its pulled and loaded models. Returns whether the backend answered."""
+        client = llm_http_client("ollama_api")
+        try:
+            tags = await client.get(backend.base_url + "/api/tags", timeout=5.0)
+            tags.raise_for_status()
+            running = await client.get(backend.base_url + "/api/ps", timeout=5.0)
+            running.raise_for_status()
+        except httpx.HTTPError:
+            return False
+        backend.available_models = {
+            model["name"] for model in tags.json().get("models", [])
+        }
+        backend.loaded_models = {
+            model["name"] for model in running.json().get("models", [])
+        }
+        return True
+
+    async def check_health(self):
+        """Probes all backends once. Healthy backends get their model lists refreshed, ejected ones are readmitted if they answer again."""
+        now = time.monotonic()
+        for backend in self.backends:
+            if backend.ejected_until is not None and backend.ejected_until > now:
+                continue  # Give it some time before trying again.
+            healthy = await self.probe(backend)
+            if healthy and backend.ejected_until is not None:
+                print(f"Readmitting Ollama backend {backend.base_url}.")
+            if healthy:
+                backend.ejected_until = None
+                backend.consecutive_failures = 0
+            else:
+                backend.ejected_until = now + self.ejection_time
+
+    async def run_health_checks(self, interval: float = 10.0):
+        """Probes the backends forever. Meant to be run as a background task for the lifetime of the app."""
+        while True:
+            await self.check_health()
+            await asyncio.sleep(interval)
+
+
+def is_backend_failure(exception: Exception) -> bool:
+    """Whether an exception means that the backend itself is unreachable or broken (as opposed to, e.g., a bad model output)."""
+    # The openai client wraps the httpx errors, but its exceptions carry the name of the problem.
+    return isinstance(exception, (httpx.TransportError, NoBackendAvailable)) or type(
+        exception
+    ).__name__ in ("APIConnectionError", "APITimeoutError", "InternalServerError")
+
+
+backend_pool = OllamaBackendPool(OLLAMA_BACKENDS)
+
+
+async def embed(
+    texts: list[str], model: str = EMBEDDING_MODEL
+) -> Optional[list[list[float]]]:
+    """Embeds the given texts with the embedding model of the Ollama server.
+    Returns one vector per text, or None if the server could not be reached or returned an error.
+    Like the agent calls, the embeddings are recorded to and replayed from the cassette (see MCP.cassette),
+    so the clustering, the semantic cache and the full-text excerpts don't need a model in a replay either.
+    """
+    cassette = get_cassette()
+    prompt = json.dumps(texts)
+    if cassette is not None and cassette.mode == "replay":
+        return await cassette.replay("embed", model, prompt, list[list[float]])
+
+    start = time.monotonic()
+    result = await _embed_live(texts, model)
+    if cassette is not None:
+        cassette.record(
+            "embed", model, prompt, list[list[float]], result, time.monotonic() - start
+        )
+    return result
+
+
+async def _embed_live(texts: list[str], model: str) -> Optional[list[list[float]]]:
+    """Does the embed call of embed against the Ollama server."""
+    try:
+        async with backend_pool.backend(model) as backend:
+            response = await llm_http_client("ollama_api").post(
+                backend.base_url + "/api/embed", json={"model": model, "input": texts}
+            )
+            response.raise_for_status()
+            return response.json()["embeddings"]
+    except (httpx.HTTPError, KeyError, NoBackendAvailable) as e:
+        print(f"Error embedding texts with {model}: {e}")
+        return None
@@ -0,0 +1,503 @@
+# Profiling mode for the stage engine.
+
+# With a real model, the LLM calls take so long that nothing else is visible. This runs main_loop with a profiler
+# attached to every stage and writes one report that splits the wall time of each stage into:
+# - LLM wait: the event loop is idle while at least one LLM call is running
+# - other wait: the event loop is idle without an LLM call (downloads, embeddings, ...)
+# - serialization: pydantic validation and dumping, and json
+# - trace and log I/O: writing files and printing
+# - blocking: calls that block the whole event loop, like time.sleep or a synchronous HTTP client
+# - orchestration: all other Python code, i.e. the stage engine itself
+# Besides that, it takes tracemalloc snapshots per stage, and measures how late the event loop wakes up (loop lag).
+# Whenever the loop is stuck for longer than block_threshold, a watchdog thread records what it is stuck in.
+#
+# The model can be real, replayed from a cassette (see MCP.cassette) or a stand-in that makes up answers after a delay:
+#     python -m MCP.profile "What is the impact of social media on mental health?" --stand-in --stand-in-latency 0.2
+#     python -m MCP.profile "..." --cassette MCP/traces/cassette.jsonl
+
+import argparse
+import asyncio
+import cProfile
+import hashlib
+import io
+import json
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from typing import Any, Optional
+
+import MCP.agents.base as agent_base
+import MCP.main as main
+from MCP.cassette import Cassette, set_cassette, use_cassette
+from MCP.memo import StageMemo, set_memo
+from MCP.steps import next_step
+from MCP.types import Article, ArticleQuestions, ScoredSurveyQuestion, SurveyQuestion
+
+REPORT_DIR = "MCP/traces"
+
+lag_interval = 0.05  # How often the loop lag is measured, in seconds.
+block_threshold = 0.1  # A loop that doesn't wake up for this long (on top of lag_interval) counts as blocked.
+stack_depth = 12  # How many frames of a blocking call are shown in the report.
+memory_frames = 10  # How many frames tracemalloc keeps per allocation.
+stand_in_embedding_size = (
+    64  # The length of the embeddings the stand-in model makes up.
+)
+
+CATEGORIES = [
+    "LLM wait",
+    "other wait",
+    "serialization",
+    "trace and log I/O",
+    "blocking",
+    "orchestration",
+]
+
+
+class StandInModel(Cassette):
+    """A cassette that makes up plausible answers instead of replaying recorded ones, for profiling without any model.
+    Every answer takes about `latency` seconds, like a call to a real model. The answers only depend on the prompt,
+    so two runs make the same calls.
+    """
+
+    def __init__(self, latency: float = 0.2, failure_rate: float = 0.0):
+        # No file is read, so Cassette.__init__ is not called.
+        self.path = "stand-in model"
+        self.mode = "replay"
+        self.recorded_latency = True
+        self.latency = latency
+        self.failure_rate = failure_rate  # The share of calls that return nothing usable, like a failed parse.
+
+    async def replay(
+        self, name: str, model: Optional[str], prompt: str, output_type: Any
+    ) -> Any:
+        rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+        await asyncio.sleep(self.latency * rng.uniform(0.5, 1.5))
+        if rng.random() < self.failure_rate:
+            return None
+        return self._make_up(name, prompt, output_type, rng)
+
+    def _make_up(
+        self, name: str, prompt: str, output_type: Any, rng: random.Random
+    ) -> Any:
+        question = re.search(r"Question: (.*)", prompt)
+        question = question.group(1).strip() if question else "How often do you ...?"
+        if output_type is float:
+            return round(rng.random(), 2)
+        if output_type == list[Article]:
+            limit = re.search(r"Limit the number of articles to (\d+)", prompt)
+            return [
+                Article(
+                    title=f"Stand-in article {i}",
+                    author=f"Author {i}",
+                    abstract="A made-up abstract. " * 20,
+                    url=f"https://example.org/stand-in/{i}",
+                )
+                for i in range(int(limit.group(1)) if limit else 5)
+            ]
+        if output_type == list[str]:
+            number = re.search(r"Create exactly (\d+)", prompt)
+            return [
+                f"Stand-in question {i} ({rng.randint(0, 10**6)})?"
+                for i in range(int(number.group(1)) if number else 3)
+            ]
+        if output_type == list[ArticleQuestions]:
+            return [
+                ArticleQuestions(
+                    article_id=int(article_id),
+                    questions=[
+                        f"Stand-in question {i} ({rng.randint(0, 10**6)})?"
+                        for i in range(int(number))
+                    ],
+                )
+                for article_id, number in re.findall(
+                    r"ARTICLE (\d+) \(create exactly (\d+)", prompt
+                )
+            ]
+        if output_type is SurveyQuestion:
+            return SurveyQuestion(
+                question=question, answer_type="Yes/No", options=["Yes", "No"]
+            )
+        if output_type is ScoredSurveyQuestion:
+            return ScoredSurveyQuestion(
+                relevance=round(rng.random(), 2),
+                answer_type="Yes/No",
+                options=["Yes", "No"],
+            )
+        if output_type == list[list[float]]:
+            # Embeddings (see MCP.ollama.embed): one made-up vector per text, the same text always gets the same one.
+            vectors = []
+            for text in json.loads(prompt):
+                text_rng = random.Random(text)
+                vectors.append(
+                    [text_rng.uniform(-1, 1) for _ in range(stand_in_embedding_size)]
+                )
+            return vectors
+        print(f"The stand-in model can't answer {name} with {output_type}.")
+        return None
+
+
+def _category(function: tuple, callers: dict) -> Optional[str]:
+    """Returns the category of the own time of a function in the profile, or None for orchestration."""
+    filename, _, name = function
+    if "select." in name and ("poll" in name or "select" in name or "control" in name):
+        return "idle"
+    if name == "<built-in method time.sleep>":
+        return "blocking"
+    # Socket calls from a synchronous HTTP client block the loop, the ones of asyncio itself don't.
+    if ("socket" in name or "_ssl." in name) and any(
+        "_sync" in caller[0] for caller in callers
+    ):
+        return "blocking"
+    if (
+        "pydantic" in filename
+        or "pydantic_core" in name
+        or "/json/" in filename
+        or "_json" in name
+    ):
+        return "serialization"
+    if "io.open" in name or "_io." in name or "posix.fsync" in name:
+        return "trace and log I/O"
+    return None
+
+
+class StageWindow:
+    """The measurements of one stage, from the moment it starts until the next stage starts.
+    That way, the work main_loop does between the stages (printing the status, finding the next step) is included.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.profile = cProfile.Profile()
+        self.start = time.perf_counter()
+        self.wall = 0.0
+        self.llm_busy = 0.0  # How long at least one LLM call was running.
+        self.llm_calls = 0
+        self.lags: list[float] = []
+        self.memory_current = 0
+        self.memory_peak = 0
+        self.memory_growth: list[str] = []
+
+
+class StageProfiler:
+    """Attaches to main_loop and measures every stage it runs. See the top of the file."""
+
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.windows: list[StageWindow] = []
+        self.current: Optional[StageWindow] = None
+        self.blocking_stacks: Counter = (
+            Counter()
+        )  # (stage, stack) -> how often the loop was found stuck there
+        self._llm_in_flight = 0
+        self._llm_since = 0.0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._last_tick = time.perf_counter()
+        self._reported_tick = 0.0
+        self._stop = threading.Event()
+        self._paused = False  # Set while the profiler itself blocks the loop (the memory snapshots), so that isn't reported.
+        self._main_thread = threading.get_ident()
+
+    # The hooks into the stage engine.
+
+    def attach(self):
+        """Wraps run_single_stage (as main_loop calls it) and the LLM calls of MCP.agents.base."""
+        original_stage = main.run_single_stage
+        original_call = agent_base._run_ollama_agent
+
+        async def profiled_stage(status):
+            step = next_step(status)
+            self.start_window(step[3] if step is not None else None)
+            return await original_stage(status)
+
+        async def timed_call(*args, **kwargs):
+            self._llm_started()
+            try:
+                return await original_call(*args, **kwargs)
+            finally:
+                self._llm_finished()
+
+        main.run_single_stage = profiled_stage
+        agent_base._run_ollama_agent = timed_call
+
+    def _llm_started(self):
+        if self._llm_in_flight == 0:
+            self._llm_since = time.perf_counter()
+        self._llm_in_flight += 1
+        if self.current is not None:
+            self.current.llm_calls += 1
+
+    def _llm_finished(self):
+        self._llm_in_flight -= 1
+        if self._llm_in_flight == 0 and self.current is not None:
+            self.current.llm_busy += time.perf_counter() - self._llm_since
+
+    def start_window(self, stage):
+        """Ends the running window and starts one for the given stage."""
+        self.end_window()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.current = StageWindow(stage)
+        self._llm_since = self.current.start
+        self.current.profile.enable()
+
+    def end_window(self):
+        window = self.current
+        if window is None:
+            return
+        window.profile.disable()
+        self._paused = True
+        now = time.perf_counter()
+        window.wall = now - window.start
+        if self._llm_in_flight > 0:
+            window.llm_busy += now - self._llm_since
+        if self.trace_memory:
+            window.memory_current, window.memory_peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if self._snapshot is not None:
+                # Filtering the differences is much faster than filtering every trace of the snapshots.
+                window.memory_growth = [
+                    str(difference)
+                    for difference in snapshot.compare_to(self._snapshot, "lineno")
+                    if "tracemalloc" not in difference.traceback[0].filename
+                    and "importlib" not in difference.traceback[0].filename
+                ][:5]
+            self._snapshot = snapshot
+        self.windows.append(window)
+        self.current = None
+        self._last_tick = time.perf_counter()
+        self._paused = False
+
+    # The loop lag and the watchdog for blocking calls.
+
+    async def watch_loop_lag(self):
+        """Measures how much later than asked the loop wakes up, every lag_interval seconds."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(lag_interval)
+            self._last_tick = time.perf_counter()
+            # A sleep that started in the previous window spans the memory snapshot in between, so it doesn't count.
+            if self.current is not None and start >= self.current.start:
+                self.current.lags.append(self._last_tick - start - lag_interval)
+
+    def _watchdog(self):
+        """Runs in a thread. If the loop didn't tick for too long, records the stack it is stuck in."""
+        while not self._stop.wait(block_threshold / 4):
+            tick = self._last_tick
+            if (
+                not self._paused
+                and time.perf_counter() - tick > lag_interval + block_threshold
+                and tick != self._reported_tick
+            ):
+                self._reported_tick = tick
+                frame = sys._current_frames().get(self._main_thread)
+                if frame is None:
+                    continue
+                stack = "".join(
+                    traceback.format_list(traceback.extract_stack(frame)[-stack_depth:])
+                )
+                stage = self.current.stage if self.current is not None else None
+                self.blocking_stacks[(stage, stack)] += 1
+
+    async def run(self, coroutine):
+        """Runs the coroutine (main_loop) with all measurements active."""
+        if self.trace_memory:
+            tracemalloc.start(memory_frames)
+        self.attach()
+        watchdog = threading.Thread(target=self._watchdog, daemon=True)
+        watchdog.start()
+        lag_task = asyncio.create_task(self.watch_loop_lag())
+        try:
+            self.start_window("setup")
+            await coroutine
+        finally:
+            self.end_window()
+            lag_task.cancel()
+            self._stop.set()
+            if self.trace_memory:
+                tracemalloc.stop()
+
+    # The report.
+
+    def _attribute(self, stats: pstats.Stats, wall: float, llm_busy: float) -> dict:
+        """Splits the wall time of a window into the categories, from the own time of the profiled functions."""
+        own = Counter()
+        for function, (_, _, own_time, _, callers) in stats.stats.items():  # type: ignore
+            own[_category(function, callers) or "orchestration"] += own_time
+        idle = own.pop("idle", 0.0)
+        times = {
+            "LLM wait": min(idle, llm_busy),
+            "other wait": max(0.0, idle - llm_busy),
+            "serialization": own["serialization"],
+            "trace and log I/O": own["trace and log I/O"],
+            "blocking": own["blocking"],
+        }
+        # Whatever is left (the profiler misses a bit of time between the calls) counts as orchestration.
+        times["orchestration"] = max(0.0, wall - sum(times.values()))
+        return times
+
+    def report(self, title: str, top: int = 15) -> str:
+        """Returns the report of all stages as text."""
+        # Windows of the same stage (e.g. a stage that had to run twice) are added up.
+        stages: dict[Any, dict] = {}
+        for window in self.windows:
+            name = getattr(window.stage, "name", window.stage)
+            entry = stages.setdefault(
+                name,
+                {
+                    "windows": 0,
+                    "wall": 0.0,
+                    "llm_busy": 0.0,
+                    "llm_calls": 0,
+                    "lags": [],
+                    "memory": (0, 0),
+                    "growth": [],
+                    "stats": None,
+                },
+            )
+            entry["windows"] += 1
+            entry["wall"] += window.wall
+            entry["llm_busy"] += window.llm_busy
+            entry["llm_calls"] += window.llm_calls
+            entry["lags"].extend(window.lags)
+            entry["memory"] = (
+                window.memory_current,
+                max(entry["memory"][1], window.memory_peak),
+            )
+            entry["growth"] = window.memory_growth or entry["growth"]
+            stats = pstats.Stats(window.profile)
+            if entry["stats"] is None:
+                entry["stats"] = stats
+            else:
+                entry["stats"].add(stats)
+
+        total = sum(entry["wall"] for entry in stages.values())
+        lines = [title, f"Total wall time: {total:.2f} s", ""]
+        header = f"{'stage':<42}{'runs':>5}{'wall s':>9}{'calls':>7}"
+        header += "".join(f"{category:>20}" for category in CATEGORIES)
+        header += f"{'memory MB (peak)':>20}{'loop lag ms p50/p99/max':>26}"
+        lines.append(header)
+        for name, entry in stages.items():
+            times = self._attribute(entry["stats"], entry["wall"], entry["llm_busy"])
+            lags = sorted(entry["lags"]) or [0.0]
+            line = f"{str(name):<42}{entry['windows']:>5}{entry['wall']:>9.2f}{entry['llm_calls']:>7}"
+            for category in CATEGORIES:
+                share = times[category] / entry["wall"] * 100 if entry["wall"] else 0
+                line += f"{times[category]:>11.2f} ({share:>4.0f}%)"
+            line += f"{entry['memory'][0] / 2**20:>11.1f} ({entry['memory'][1] / 2**20:>5.1f})"
+            line += f"{lags[len(lags) // 2] * 1000:>12.1f}/{lags[int(len(lags) * 0.99)] * 1000:.1f}/{lags[-1] * 1000:.1f}"
+            lines.append(line)
+
+        lines += [
+            "",
+            f"Event loop blocked for more than {block_threshold * 1000:.0f} ms:",
+        ]
+        if not self.blocking_stacks:
+            lines.append("  never")
+        for (stage, stack), count in self.blocking_stacks.most_common(10):
+            lines.append(f"  {count}x in stage {getattr(stage, 'name', stage)}:")
+            lines.append("    " + stack.rstrip().replace("\n", "\n    "))
+
+        for name, entry in stages.items():
+            lines += ["", f"=== {name} ==="]
+            if entry["growth"]:
+                lines.append("Memory growth (top lines):")
+                lines += [f"  {growth}" for growth in entry["growth"]]
+            output = io.StringIO()
+            entry["stats"].stream = output
+            entry["stats"].sort_stats("tottime").print_stats(top)
+            lines.append(output.getvalue().strip())
+        return "\n".join(lines) + "\n"
+
+    def dump_stats(self, path: str):
+        """Writes the combined profile of all stages in the pstats format (e.g. for snakeviz)."""
+        stats = None
+        for window in self.windows:
+            if stats is None:
+                stats = pstats.Stats(window.profile)
+            else:
+                stats.add(window.profile)
+        if stats is not None:
+            stats.dump_stats(path)
+
+
+async def profile_main_loop(
+    research_question: str,
+    profiler: StageProfiler,
+    timeout: Optional[float] = None,
+):
+    await profiler.run(main.main_loop(research_question, timeout=timeout))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Runs main_loop with profiling and writes a report per stage."
+    )
+    parser.add_argument(
+        "research_question",
+        nargs="?",
+        default="What is the impact of social media on mental health?",
+    )
+    model = parser.add_mutually_exclusive_group()
+    model.add_argument("--cassette", help="Replay the LLM calls from this cassette")
+    model.add_argument(
+        "--stand-in", action="store_true", help="Use a stand-in instead of a model"
+    )
+    parser.add_argument(
+        "--stand-in-latency",
+        type=float,
+        default=0.2,
+        help="Seconds per call of the stand-in",
+    )
+    parser.add_argument(
+        "--stand-in-failure-rate",
+        type=float,
+        default=0.0,
+        help="Share of failed calls of the stand-in",
+    )
+    parser.add_argument("--timeout", type=float, default=None, help="Deadline in s")
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Don't trace the memory (tracemalloc slows everything down)",
+    )
+    parser.add_argument("--report", default=None, help="Where to write the report")
+    parser.add_argument("--pstats", default=None, help="Also dump the profile here")
+    parser.add_argument("--top", type=int, default=15, help="Functions per stage")
+    args = parser.parse_args()
+
+    if args.cassette:
+        use_cassette(args.cassette, "replay")
+        model_name = f"cassette {args.cassette}"
+    elif args.stand_in:
+        # All LLM calls and embeddings go through the cassette, so nothing is sent to Ollama.
+        set_cassette(StandInModel(args.stand_in_latency, args.stand_in_failure_rate))
+        model_name = f"stand-in model, {args.stand_in_latency} s per call"
+    else:
+        model_name = "real model"
+
+    # Outputs memoized by earlier runs would skip the work that is supposed to be measured.
+    set_memo(StageMemo(":memory:"))
+
+    profiler = StageProfiler(trace_memory=not args.no_memory)
+    asyncio.run(profile_main_loop(args.research_question, profiler, args.timeout))
+
+    report = profiler.report(
+        f'Profile of "{args.research_question}" ({model_name})', args.top
+    )
+    path = args.report or f"{REPORT_DIR}/profile-{int(time.time())}.txt"
+    with open(path, "w") as file:
+        file.write(report)
+    if args.pstats:
+        profiler.dump_stats(args.pstats)
+    print(report.split("\n\n=== ")[0])
+    print(f"Full report written to {path}")
+
+
+if __name__ == "__main__":
+    main_cli()
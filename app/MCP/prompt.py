@@ -0,0 +1,230 @@
+# Token-budgeted prompt assembly for the agents.
+
+# Without a limit, a long abstract inflates the prefill time of every call and can silently overflow the context of a small model.
+# Every agent builds its prompt here instead: the tokens are counted with the tokenizer of the target model,
+# and if the prompt is over the budget of the agent, the trimmable fields (like abstracts) are shortened,
+# keeping their first and last sentences. The token count of every call is written to a log, so budgets can be tuned.
+# The log entries are buffered and written in batches off the event loop, and the rest at shutdown (see flush_token_usage).
+
+import asyncio
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Optional
+
+from MCP.ollama import DEFAULT_MODEL
+
+TOKEN_LOG_FILE = "MCP/traces/token_usage.jsonl"
+TOKEN_LOG_BATCH = 100  # The buffered entries are written once there are this many,
+TOKEN_LOG_FLUSH_INTERVAL = 10.0  # or once the oldest of them is this many seconds old.
+
+# The maximum number of prompt tokens per agent. Agents not listed here are not limited.
+agent_token_budgets: dict[str, int] = {
+    "relevant_literature_agent": 256,
+    "check_literature_relevance_agent": 768,
+    "check_literature_relevance_logprob_agent": 768,
+    "create_questions_from_article_agent": 1536,
+    "create_questions_from_articles_agent": 4096,
+    "check_question_relevance_agent": 256,
+    "check_question_relevance_logprob_agent": 256,
+    "create_survey_question_agent": 384,
+    "score_and_format_question_agent": 448,
+}
+
+# The Hugging Face tokenizers of the Ollama model families. All sizes of a family share the same tokenizer.
+# The tokenizers are downloaded once by load_tokenizer, which the entry points await at startup.
+# Until then, and whenever a tokenizer can't be loaded (the tokenizers library is not installed, there is no network,
+# or the repository is gated like the Llama ones and HF_TOKEN is not set), the tokens are estimated from the length.
+tokenizer_repositories = {
+    "qwen3": "Qwen/Qwen3-0.6B",
+    "llama3.2": "meta-llama/Llama-3.2-1B",
+}
+
+TRIM_MARKER = " [...] "
+
+
+# The loaded tokenizers by repository. None if the tokenizer could not be loaded, so it is not tried again.
+_tokenizers: dict[str, object] = {}
+
+
+def _download_tokenizer(repository: str):
+    """Loads a tokenizer from Hugging Face (or its local cache). Blocks, so it is only run in a thread."""
+    try:
+        from tokenizers import Tokenizer
+
+        return Tokenizer.from_pretrained(repository, token=os.getenv("HF_TOKEN"))
+    except Exception as e:
+        print(
+            f"Could not load the tokenizer {repository}, estimating tokens instead: {e}"
+        )
+        return None
+
+
+async def load_tokenizer(model: Optional[str] = None):
+    """Loads the tokenizer of the model (by default DEFAULT_MODEL) in a thread, so the event loop is not blocked by the download."""
+    repository = tokenizer_repositories.get((model or DEFAULT_MODEL).split(":")[0])
+    if repository is None or repository in _tokenizers:
+        return
+    _tokenizers[repository] = await asyncio.to_thread(_download_tokenizer, repository)
+    # The counts so far were estimated.
+    count_tokens.cache_clear()
+
+
+def _loaded_tokenizer(model: str):
+    """Returns the tokenizer of the model if it was loaded, without ever loading it here."""
+    repository = tokenizer_repositories.get(model.split(":")[0])
+    return _tokenizers.get(repository) if repository is not None else None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Counts the tokens of the text with the tokenizer of the model, or estimates them if it is not loaded (see load_tokenizer)."""
+    tokenizer = _loaded_tokenizer(model)
+    if tokenizer is None:
+        # Roughly four characters per token for English text.
+        return (len(text) + 3) // 4
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _split_sentences(text: str) -> list[str]:
+    return re.split(r"(?<=[.!?])\s+", text.strip())
+
+
+def trim_to_tokens(text: str, max_tokens: int, model: str = DEFAULT_MODEL) -> str:
+    """Shortens the text to at most max_tokens tokens.
+    Sentences are dropped from the middle first, so the first and last sentences (usually the topic and the conclusion) are kept.
+    Only if those two alone are still too long, the text is cut off.
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    sentences = _split_sentences(text)
+    head, tail = (
+        sentences[: (len(sentences) + 1) // 2],
+        sentences[(len(sentences) + 1) // 2 :],
+    )
+    while len(head) + len(tail) > 2:
+        # Drop the sentence closest to the middle.
+        if len(head) > len(tail):
+            head.pop()
+        else:
+            tail.pop(0)
+        trimmed = " ".join(head) + TRIM_MARKER + " ".join(tail)
+        if count_tokens(trimmed, model) <= max_tokens:
+            return trimmed
+
+    # Even the first and last sentence are too long, so cut off the end proportionally.
+    trimmed = " ".join(head) + TRIM_MARKER + " ".join(tail) if tail else " ".join(head)
+    tokens = count_tokens(trimmed, model)
+    return trimmed[: max(0, len(trimmed) * max_tokens // max(tokens, 1))]
+
+
+def build_prompt(
+    agent_name: str,
+    template: str,
+    trimmable: tuple[str, ...] = (),
+    model: Optional[str] = None,
+    **fields: Optional[str],
+) -> str:
+    """Fills the template (a str.format template) with the fields and keeps the prompt within the token budget of the agent.
+    The tokens are counted for the model the prompt is sent to (the custom_llm of the agent, or DEFAULT_MODEL).
+    The fields named in trimmable are shortened in that order (the first one is shortened first) until the prompt fits.
+    If the prompt still doesn't fit, it is returned anyway and a warning is printed.
+    """
+    model = model or DEFAULT_MODEL
+    values = {
+        name: "" if value is None else str(value) for name, value in fields.items()
+    }
+    prompt = template.format(**values)
+    budget = agent_token_budgets.get(agent_name)
+    if budget is None:
+        return prompt
+
+    for name in trimmable:
+        excess = count_tokens(prompt, model) - budget
+        if excess <= 0:
+            break
+        field_tokens = count_tokens(values[name], model)
+        values[name] = trim_to_tokens(
+            values[name], max(field_tokens - excess, 0), model
+        )
+        prompt = template.format(**values)
+
+    tokens = count_tokens(prompt, model)
+    if tokens > budget:
+        print(
+            f"Warning: the prompt of {agent_name} has {tokens} tokens, over its budget of {budget}."
+        )
+    return prompt
+
+
+def record_token_usage(
+    agent_name: str,
+    model: Optional[str],
+    prompt: str,
+    latency: float,
+    completion_tokens: Optional[int] = None,
+):
+    """Adds the token count and latency of a call to the token log, so the budgets can be tuned against the latency.
+    The generated tokens are only known for the streaming agents (see MCP.agents.base), otherwise they are logged as None.
+    """
+    model = model or DEFAULT_MODEL
+    entry = {
+        "time": time.time(),
+        "agent": agent_name,
+        "model": model,
+        "prompt_tokens": count_tokens(prompt, model),
+        "completion_tokens": completion_tokens,
+        "budget": agent_token_budgets.get(agent_name),
+        "latency": latency,
+    }
+    global _token_log_buffer_start
+    if not _token_log_buffer:
+        _token_log_buffer_start = time.monotonic()
+    _token_log_buffer.append(json.dumps(entry) + "\n")
+    if (
+        len(_token_log_buffer) >= TOKEN_LOG_BATCH
+        or time.monotonic() - _token_log_buffer_start >= TOKEN_LOG_FLUSH_INTERVAL
+    ):
+        lines = _take_token_log_buffer()
+        try:
+            # The agents call this on the event loop, so the batch is written from a thread.
+            # asyncio.run waits for the thread before it returns.
+            asyncio.get_running_loop().run_in_executor(None, _write_token_log, lines)
+        except RuntimeError:
+            _write_token_log(lines)
+
+
+def flush_token_usage():
+    """Writes the buffered token log entries. The entry points call this at shutdown, and it also runs at exit."""
+    lines = _take_token_log_buffer()
+    if lines:
+        _write_token_log(lines)
+
+
+# The entries that are not written yet, and when the first of them was buffered.
+_token_log_buffer: list[str] = []
+_token_log_buffer_start = 0.0
+# Batches can be written from several threads at once, so their lines don't get mixed.
+_token_log_lock = threading.Lock()
+
+
+def _take_token_log_buffer() -> list[str]:
+    lines = _token_log_buffer[:]
+    _token_log_buffer.clear()
+    return lines
+
+
+def _write_token_log(lines: list[str]):
+    # The log is only for tuning, so a call must never fail because it can't be written.
+    try:
+        with _token_log_lock, open(TOKEN_LOG_FILE, "a") as file:
+            file.writelines(lines)
+    except OSError as e:
+        print(f"Could not write the token log {TOKEN_LOG_FILE}: {e}")
+
+
+atexit.register(flush_token_usage)
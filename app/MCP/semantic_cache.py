@@ -0,0 +1,196 @@
+# A cache that lets a request reuse the literature of an earlier request with a similar research question.
+
+# Users often submit research questions that are paraphrases of each other.
+# Instead of searching for (and scoring) the same papers again, the research question is embedded and compared
+# to the questions of earlier requests. If one is within the similarity radius, its papers seed the new request.
+# Embeddings of different models can't be compared, so every row remembers the model and the dimension it was made with,
+# and only the rows of the current embedding model are searched.
+# The SQLite calls are blocking, so the async functions at the bottom run them in a thread.
+
+import asyncio
+import json
+import sqlite3
+from typing import Optional
+
+import numpy as np
+
+from MCP.ollama import EMBEDDING_MODEL, embed
+from MCP.types import Article, RequestStatus
+
+CACHE_FILE = "MCP/cache/semantic_cache.sqlite"
+
+similarity_radius = (
+    0.92  # Minimum cosine similarity for two research questions to count as the same.
+)
+
+
+class SemanticCache:
+    """Stores the papers (and their scores) of finished requests, keyed by the embedding of their research question.
+    The embeddings of the stored questions are kept in one normalized matrix per embedding model and dimension,
+    so a lookup is one matrix-vector product.
+    """
+
+    def __init__(self, path: str = CACHE_FILE):
+        self.path = path
+        connection = sqlite3.connect(self.path)
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS requests "
+                "(id INTEGER PRIMARY KEY, question TEXT NOT NULL, embedding BLOB NOT NULL, papers TEXT NOT NULL, "
+                "model TEXT, dimension INTEGER)"
+            )
+            # Caches from before the model was stored get the columns added. Their rows have no model, so they are never matched.
+            columns = [
+                row[1] for row in connection.execute("PRAGMA table_info(requests)")
+            ]
+            if "model" not in columns:
+                connection.execute("ALTER TABLE requests ADD COLUMN model TEXT")
+            if "dimension" not in columns:
+                connection.execute("ALTER TABLE requests ADD COLUMN dimension INTEGER")
+        connection.close()
+        # The indices are loaded on the first lookup, one per (model, dimension).
+        self._indices: dict[tuple[str, int], tuple[list[int], np.ndarray]] = {}
+
+    def _load_index(self, model: str, dimension: int) -> tuple[list[int], np.ndarray]:
+        """Loads the embeddings of the stored requests of the given model and dimension into an in-memory index."""
+        connection = sqlite3.connect(self.path)
+        rows = connection.execute(
+            "SELECT id, embedding FROM requests WHERE model = ? AND dimension = ?",
+            (model, dimension),
+        ).fetchall()
+        connection.close()
+        ids = [row[0] for row in rows]
+        if rows:
+            matrix = np.vstack(
+                [np.frombuffer(row[1], dtype=np.float32) for row in rows]
+            )
+        else:
+            matrix = np.empty((0, dimension), dtype=np.float32)
+        self._indices[(model, dimension)] = (ids, matrix)
+        return ids, matrix
+
+    def nearest(
+        self, embedding: np.ndarray, model: str = EMBEDDING_MODEL
+    ) -> Optional[tuple[str, float, list]]:
+        """Finds the stored request closest to the given (normalized) embedding, among the ones embedded with the same model.
+        Returns its research question, the similarity and its papers, or None if nothing is within the similarity radius.
+        """
+        key = (model, embedding.shape[0])
+        ids, matrix = self._indices.get(key) or self._load_index(*key)
+        if len(ids) == 0:
+            return None  # Nothing stored yet for this model.
+
+        similarities = matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < similarity_radius:
+            return None
+
+        connection = sqlite3.connect(self.path)
+        question, papers = connection.execute(
+            "SELECT question, papers FROM requests WHERE id = ?", (ids[best],)
+        ).fetchone()
+        connection.close()
+        return question, float(similarities[best]), json.loads(papers)
+
+    def add(
+        self,
+        question: str,
+        embedding: np.ndarray,
+        papers: list,
+        model: str = EMBEDDING_MODEL,
+    ):
+        """Stores the papers of a request under the (normalized) embedding of its research question."""
+        vector = embedding.astype(np.float32)
+        connection = sqlite3.connect(self.path)
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO requests (question, embedding, papers, model, dimension) VALUES (?, ?, ?, ?, ?)",
+                (
+                    question,
+                    vector.tobytes(),
+                    json.dumps(papers),
+                    model,
+                    vector.shape[0],
+                ),
+            )
+        connection.close()
+        # Keep the in-memory index up to date, if it is already loaded.
+        key = (model, vector.shape[0])
+        if key in self._indices:
+            ids, matrix = self._indices[key]
+            self._indices[key] = (
+                ids + [cursor.lastrowid],
+                np.vstack([matrix, vector[np.newaxis, :]]),
+            )
+
+
+_cache: Optional[SemanticCache] = None
+
+
+def get_cache() -> SemanticCache:
+    """Returns the semantic cache of this process, creating it on first use."""
+    global _cache
+    if _cache is None:
+        _cache = SemanticCache()
+    return _cache
+
+
+async def _embed_question(
+    research_question: str, model: str = EMBEDDING_MODEL
+) -> Optional[np.ndarray]:
+    """Embeds and normalizes a research question. Returns None if the embedding failed."""
+    embeddings = await embed([research_question], model)
+    if not embeddings:
+        return None
+    vector = np.asarray(embeddings[0], dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+
+async def seed_from_similar_request(
+    request_status: RequestStatus, use_scores: bool = False
+) -> Optional[str]:
+    """Seeds the papers of the request with the papers of an earlier request with a similar research question.
+    If use_scores is True, the relevance scores of the earlier request are reused as well, so they don't need to be checked again.
+    Returns the research question of the earlier request, or None if no similar request was found.
+    """
+    embedding = await _embed_question(request_status.settings.research_question)
+    if embedding is None:
+        return None
+
+    match = await asyncio.to_thread(get_cache().nearest, embedding, EMBEDDING_MODEL)
+    if match is None:
+        return None
+    question, _, papers = match
+
+    papers = papers[: request_status.settings.paper_limit]
+    request_status.add_papers(
+        [Article.model_validate(article) for article, _ in papers],
+        [score if use_scores else None for _, score in papers],
+    )
+    return question
+
+
+async def remember_request(request_status: RequestStatus):
+    """Stores the papers of the request in the semantic cache, so later similar requests can reuse them.
+    Like the lookup, this is only done for requests that opted in with reuse_similar_requests.
+    """
+    if (
+        not request_status.settings.reuse_similar_requests
+        or request_status.num_papers() == 0
+    ):
+        return
+    embedding = await _embed_question(request_status.settings.research_question)
+    if embedding is None:
+        return
+    papers = [
+        (article.model_dump(), relevance)
+        for article, relevance in request_status.iter_papers()
+    ]
+    await asyncio.to_thread(
+        get_cache().add,
+        request_status.settings.research_question,
+        embedding,
+        papers,
+        EMBEDDING_MODEL,
+    )
@@ -0,0 +1,148 @@
+# Speculative attempts for the LLM calls of the stages.
+
+# A small model sometimes returns something that can't be parsed, or a single call gets stuck behind a long one in Ollama.
+# Retrying one attempt after the other means that such an item takes two or three times as long as the others,
+# and the slowest item decides when the whole stage is done.
+# Instead, a second attempt for the same item is started as soon as the first one fails, or as soon as it runs longer
+# than most calls of the same agent did (a latency percentile). The first valid result wins and the other attempts
+# are cancelled. Starting attempts only because of the latency costs extra LLM calls, so those are limited by a budget.
+
+import asyncio
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, TypeVar
+
+# A backup attempt is started once an attempt runs longer than this percentile of the latencies of its agent.
+speculation_percentile = 90
+# The latency trigger is only used once this many calls of the agent were measured.
+min_latency_samples = 10
+# How many latencies are kept per agent.
+latency_window = 200
+# Backup attempts started because of the latency may be at most this share of all first attempts...
+speculation_budget = 0.1
+# ... plus this many, so the first slow calls can already be backed up.
+speculation_burst = 2.0
+
+# The number of the attempt the current call belongs to. The single-flight of MCP.agents.base uses it,
+# so a backup attempt really is a new call instead of waiting for the attempt it is supposed to back up.
+current_attempt: ContextVar[int] = ContextVar("current_attempt", default=1)
+
+
+class LatencyTracker:
+    """Keeps the latencies of the latest successful calls of each agent."""
+
+    def __init__(self, window: int = latency_window):
+        self.window = window
+        self._latencies: dict[str, deque[float]] = {}
+
+    def record(self, name: str, latency: float):
+        self._latencies.setdefault(name, deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, name: str, percentile: float) -> Optional[float]:
+        """Returns the percentile (0-100) of the latencies of the agent, or None if there are too few to tell."""
+        latencies = self._latencies.get(name)
+        if latencies is None or len(latencies) < min_latency_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class SpeculationBudget:
+    """A token bucket for the backup attempts: every first attempt earns a share of a token, every backup costs one."""
+
+    def __init__(
+        self, share: float = speculation_budget, burst: float = speculation_burst
+    ):
+        self.share = share
+        self.burst = burst
+        self.tokens = burst
+        self.first_attempts = 0
+        self.backups = 0
+
+    def earn(self):
+        self.first_attempts += 1
+        self.tokens = min(self.burst, self.tokens + self.share)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        self.backups += 1
+        return True
+
+
+latency_tracker = LatencyTracker()
+budget = SpeculationBudget()
+
+T = TypeVar("T")
+
+
+async def run_speculatively(
+    name: str, attempt: Callable[[], Awaitable[Optional[T]]], max_attempts: int = 2
+) -> Optional[T]:
+    """Runs attempt() until it returns a valid result (not None and not an exception), with at most max_attempts attempts.
+    A new attempt is started when an attempt fails, or (within the budget) when the running one is slower than
+    the speculation_percentile of the agent called name. Returns the first valid result, or None if all attempts failed.
+    With max_attempts=1, this is just a single call.
+    """
+    if max_attempts <= 1:
+        return await attempt()
+
+    started: dict[asyncio.Task, float] = {}
+    attempts = 0
+
+    def start_attempt():
+        nonlocal attempts
+        attempts += 1
+        # The task copies the context here, so it sees its own attempt number.
+        token = current_attempt.set(attempts)
+        try:
+            started[asyncio.create_task(attempt())] = time.monotonic()
+        finally:
+            current_attempt.reset(token)
+
+    budget.earn()
+    start_attempt()
+    try:
+        while started:
+            # If the newest attempt gets slower than usual, another one is started (if there are attempts left).
+            timeout = None
+            threshold = latency_tracker.percentile(name, speculation_percentile)
+            if attempts < max_attempts and threshold is not None:
+                newest = max(started.values())
+                timeout = max(0.0, newest + threshold - time.monotonic())
+
+            done, _ = await asyncio.wait(
+                started, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                if budget.try_spend():
+                    start_attempt()
+                    continue
+                # Without budget, just wait for what is running.
+                done, _ = await asyncio.wait(
+                    started, return_when=asyncio.FIRST_COMPLETED
+                )
+
+            for task in done:
+                start = started.pop(task)
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    print(f"Error in attempt of {name}: {task.exception()}")
+                    continue
+                result = task.result()
+                if result is not None:
+                    latency_tracker.record(name, time.monotonic() - start)
+                    return result
+
+            # The attempts that finished all failed. They are replaced right away, like a retry,
+            # but without waiting for the attempts that are still running.
+            if attempts < max_attempts:
+                start_attempt()
+        return None
+    finally:
+        # The first valid result wins (or the caller was cancelled), the other attempts are not needed anymore.
+        for task in started:
+            task.cancel()
@@ -1,12 +1,18 @@
 # File that determines what steps to do next in the agent workflow.
 
 # It depends on all the agents, so you should pretty much only import it in the main file
+import asyncio
 from typing import Awaitable, Callable
+from MCP.clustering import min_papers_to_cluster
 from MCP.types import RequestStages, RequestStatus, StepInformation
 from MCP.agents.check_literature_relevance import (
     run_single_check_literature_relevance_agent,
     run_all_check_literature_relevance_agent,
 )
+from MCP.agents.cluster_literature import (
+    run_all_cluster_literature,
+    run_single_cluster_literature,
+)
 from MCP.agents.check_question_relevance import (
     run_all_check_question_relevance_agent,
     run_single_check_question_relevance_agent,
@@ -15,10 +21,18 @@ from MCP.agents.create_survey_question import (
     run_single_create_survey_question_agent,
     run_all_create_survey_questions_agent,
 )
+from MCP.agents.score_and_format_question import (
+    run_all_score_and_format_question_agent,
+    run_single_score_and_format_question_agent,
+)
 from MCP.agents.relevant_literature import (
     run_all_relevant_literature_agent,
     run_single_relevant_literature_agent,
 )
+from MCP.agents.retrieve_full_text import (
+    run_all_retrieve_full_text,
+    run_single_retrieve_full_text,
+)
 from MCP.agents.create_questions_from_article import (
     run_all_create_questions_from_article_agent,
     run_single_create_questions_from_article_agent,
@@ -46,7 +60,7 @@ def next_step(
 
     # The very first step is to run the relevant literature agent.
     # This is dependent on whether there are already papers in the request status.
-    if not status.papers:
+    if status.num_papers() == 0:
         return (
             "Finding relevant literature",
             run_single_relevant_literature_agent,
@@ -54,8 +68,24 @@ def next_step(
             RequestStages.FINDING_LITERATURE,
         )
 
+    # If enabled, large candidate sets are clustered by topic first, so only a few papers per cluster need to be checked.
+    unscored = any(relevance is None for relevance in status.paper_relevances())
+    if (
+        status.settings.cluster_papers
+        and unscored
+        and not status.paper_clusters
+        and status.num_papers() >= min_papers_to_cluster
+    ):
+        return (
+            "Clustering literature by topic",
+            run_single_cluster_literature,
+            run_all_cluster_literature,
+            RequestStages.CLUSTERING_LITERATURE,
+        )
+
     # Next, we check if there are any papers that need to be checked for relevance.
-    if any(relevance is None for _, relevance in status.papers):
+    # This only looks at the scores, so in large-run mode no article needs to be loaded.
+    if unscored:
         return (
             "Checking relevance of literature",
             run_single_check_literature_relevance_agent,
@@ -63,6 +93,18 @@ def next_step(
             RequestStages.CHECKING_LITERATURE_RELEVANCE,
         )
 
+    # If enabled, the full texts of the papers are retrieved, so the question generation gets more than the abstract.
+    if (
+        status.settings.use_full_text
+        and len(status.paper_contexts) < status.num_papers()
+    ):
+        return (
+            "Retrieving full texts of literature",
+            run_single_retrieve_full_text,
+            run_all_retrieve_full_text,
+            RequestStages.RETRIEVING_FULL_TEXT,
+        )
+
     # If we have papers, we can move on to the next step.
     # If there are no questions or not enough questions, we need to create them.
     # TODO: If ever a question reworker agent is implemented, we need to make sure we don't revert back to this step.
@@ -79,7 +121,20 @@ def next_step(
         )
 
     # If we have questions, but some of them need to be checked for relevance, we need to do that.
+    # With fuse_question_stages, they are formatted in the same call, so both fields are filled together.
+    # The logprob engine reads the score from a single decoded digit, so it can't format in the same call.
+    # Then the relevance is checked on its own (with logprob scores), and the formatting stage follows as usual.
     if any(relevance is None for _, relevance in status.questions):
+        if (
+            status.settings.fuse_question_stages
+            and status.settings.relevance_engine != "logprob"
+        ):
+            return (
+                "Scoring and formatting survey questions",
+                run_single_score_and_format_question_agent,
+                run_all_score_and_format_question_agent,
+                RequestStages.SCORING_AND_FORMATTING_SURVEY_QUESTIONS,
+            )
         return (
             "Checking relevance of survey questions",
             run_single_check_question_relevance_agent,
@@ -88,10 +143,11 @@ def next_step(
         )
 
     # Lastly, we need to format all the questions to be survey questions.
-    # This means that all questions should have an answer type and options.
+    # This means that all questions should have an answer type and options,
+    # except for the ones below the question_relevance_threshold, which won't be used anyway.
     if any(
-        question.answer_type is None or question.options is None
-        for question, _ in status.questions
+        status.needs_formatting(question, relevance)
+        for question, relevance in status.questions
     ):
         return (
             "Formatting survey questions",
@@ -105,6 +161,45 @@ def next_step(
 
 
 # Some functions to make running the agents easier.
+async def run_step_function(
+    request_status: RequestStatus,
+    step_fn: Callable[
+        [RequestStatus], Awaitable[tuple[RequestStatus, StepInformation]]
+    ],
+) -> tuple[RequestStatus, StepInformation]:
+    """Run a step function, but cancel it if the deadline of the request passes or the request is cancelled.
+    Cancelling the step cancels all of its outstanding agent calls, so their concurrency slots are released right away.
+    The stages write the result of every item into the request status as soon as it is done (see run_concurrently),
+    so a cancelled step keeps the items it finished, and the request ends with whatever is complete by then.
+    """
+    step_info = StepInformation()
+    if request_status.should_stop():
+        step_info.add_error("The request was cancelled or its deadline passed.")
+        return request_status, step_info
+
+    step_task = asyncio.ensure_future(step_fn(request_status))
+    cancel_task = asyncio.ensure_future(request_status.wait_cancelled())
+    try:
+        await asyncio.wait(
+            {step_task, cancel_task},
+            timeout=request_status.remaining_time(),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if step_task.done():
+            return step_task.result()
+    finally:
+        # If we were cancelled ourselves, the step has to go as well.
+        cancel_task.cancel()
+        if not step_task.done():
+            step_task.cancel()
+            await asyncio.wait({step_task})
+
+    step_info.add_error(
+        "The request was cancelled or its deadline passed, the running step was stopped."
+    )
+    return request_status, step_info
+
+
 async def run_single_next_step(
     request_status: RequestStatus,
 ) -> tuple[RequestStatus, StepInformation]:
@@ -117,7 +212,7 @@ async def run_single_next_step(
         return request_status, step_info  # No more steps to take.
 
     name, single_step_fn, all_step_fn, _ = step
-    request_status, step_info = await single_step_fn(request_status)
+    request_status, step_info = await run_step_function(request_status, single_step_fn)
 
     return request_status, step_info
 
@@ -134,7 +229,7 @@ async def run_single_stage(
         return request_status, step_info  # No more steps to take.
 
     name, single_step_fn, all_step_fn, _ = step
-    request_status, step_info = await all_step_fn(request_status)
+    request_status, step_info = await run_step_function(request_status, all_step_fn)
 
     return request_status, step_info
 
@@ -152,8 +247,14 @@ async def run_until_before_stage(
         if step is None or step[3] == stage:
             break  # No more steps to take or we reached the specified stage.
 
+        if request_status.should_stop():
+            step_info.add_error("The request was cancelled or its deadline passed.")
+            break
+
         name, single_step_fn, all_step_fn, _ = step
-        request_status, step_info2 = await all_step_fn(request_status)
+        request_status, step_info2 = await run_step_function(
+            request_status, all_step_fn
+        )
         # Add the step info to the step information.
         step_info.merge(step_info2)
 
@@ -1,9 +1,12 @@
 import asyncio
+import json
 from enum import Enum
 import time
-from typing import Awaitable, Callable, Literal, Optional, Self, TypeVar
+from typing import Awaitable, Callable, Iterator, Literal, Optional, Self, TypeVar
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, TypeAdapter, model_serializer
+
+from MCP.article_store import ArticleStore, PaperTable
 
 
 # Try to get it to create an article
@@ -30,6 +33,31 @@ class SurveyQuestion(BaseModel):
     )  # The options for the answer, if applicable. For example, ["yes", "no"] for a yes/no question.
 
 
+class ArticleQuestions(BaseModel):
+    """The questions for one article, in the answer of the batched create_questions_from_articles agent."""
+
+    article_id: int  # The number the article was given in the prompt.
+    questions: list[str]
+
+
+class ScoredSurveyQuestion(BaseModel):
+    """The answer of the fused score_and_format_question agent: the relevance of a question and its format in one response."""
+
+    relevance: float  # The relevance of the question to the research question, between 0 and 1.
+    answer_type: (
+        (
+            Literal["Text"]
+            | Literal["Multiple choice"]
+            | Literal["Yes/No"]
+            | Literal["Range"]
+        )
+        | None
+    )  # Like in SurveyQuestion. Can be None if the question is not relevant enough to be formatted.
+    options: (
+        (list[str] | tuple[int, int] | Literal["Text field"]) | None
+    )  # Like in SurveyQuestion.
+
+
 class StatusSetting(BaseModel):
     research_question: str  # The research question for which the survey is created.
     paper_limit: int = (
@@ -38,6 +66,45 @@ class StatusSetting(BaseModel):
     question_per_article: int = (
         3  # The number of questions to create per article. Defaults to 3.
     )
+    article_store: Optional[str] = (
+        None  # Path of a SQLite file for the large-run mode. If set, the article bodies are kept there instead of in memory.
+    )
+    reuse_similar_requests: bool = (
+        False  # Whether to reuse the papers of an earlier request with a similar research question. See MCP.semantic_cache.
+    )
+    reuse_relevance_scores: bool = (
+        False  # Whether to also reuse the relevance scores of that request, instead of checking the papers again.
+    )
+    deadline: Optional[float] = (
+        None  # The time (as a UNIX timestamp) after which the request is stopped. If None, the request can run forever.
+    )
+    use_full_text: bool = (
+        False  # Whether to download the full texts of the papers and give the most relevant excerpts to the question generation.
+    )
+    articles_per_batch: int = (
+        1  # How many articles the questions are created from in a single LLM call. With more than one, the agent sees the other articles and is asked to avoid overlapping questions.
+    )
+    fuse_question_stages: bool = (
+        False  # Whether to check the relevance of a question and format it in a single LLM call, instead of one call each. Has no effect with the logprob relevance_engine.
+    )
+    question_relevance_threshold: Optional[float] = (
+        0.5  # Questions with a lower relevance score are not formatted, since they won't end up in the survey. If None, all are formatted.
+    )
+    max_attempts: int = (
+        2  # How many LLM calls may be made for a single item of a stage. Failed or unusually slow calls are backed up by another one, see MCP.speculation.
+    )
+    cluster_papers: bool = (
+        False  # Whether to cluster the papers by topic and only check the relevance of a few per cluster, see MCP.clustering.
+    )
+    representatives_per_cluster: int = (
+        2  # How many papers of each cluster are checked by the LLM. The others get the mean of their scores.
+    )
+    relevance_engine: Literal["generate", "logprob"] = (
+        "generate"  # How relevance scores are made: generated as a number, or read from the token probabilities of a single digit (see MCP.logprob_scoring).
+    )
+    memoize_stages: bool = (
+        False  # Whether to reuse the stage outputs of earlier requests with the same inputs, see MCP.memo.
+    )
 
 
 class RequestStatus(BaseModel):
@@ -53,6 +120,14 @@ class RequestStatus(BaseModel):
         default_factory=list
     )  # The list of questions and their relevance scores
 
+    paper_contexts: dict[int, list[str]] = Field(
+        default_factory=dict
+    )  # The most relevant excerpts of the full text of each paper, keyed by the index of the paper. Only used with use_full_text.
+
+    paper_clusters: list[list[int]] = Field(
+        default_factory=list
+    )  # The topic clusters of the papers, as lists of paper indices with the representatives first. Only used with cluster_papers.
+
     settings: StatusSetting  # The settings for the request, such as the research question and paper limit.
     # Does not change over the lifetime of the request.
 
@@ -62,21 +137,188 @@ class RequestStatus(BaseModel):
     # Any time the status is updated, a new line with the updated status is written to the file.
     # In Python, holding a file handle is not recommended, so we will open and close the file each time we write to it.
 
+    _paper_table: Optional[PaperTable] = PrivateAttr(
+        default=None
+    )  # In large-run mode, the papers are kept here instead of in the papers field. See MCP.article_store.
+
+    _cancelled: bool = PrivateAttr(
+        default=False
+    )  # Set if the client aborted the request. Like the deadline, this stops the request after its running stage is cancelled.
+    _cancel_event: Optional[asyncio.Event] = PrivateAttr(default=None)
+
     def __init__(
         self,
         research_question: str,
         paper_limit: int | None = None,
         trace_file: str | None = None,
+        article_store: str | None = None,
+        deadline: float | None = None,
+        **settings,
     ):
         """Initializes the RequestStatus object.
         If trace_file is given, the status will be saved to that file.
+        If article_store is given, the request runs in large-run mode and the article bodies are stored in that SQLite file.
+        If deadline is given (as a UNIX timestamp), the request is stopped once it passes.
+        Any other field of StatusSetting can be given as a keyword argument as well, e.g. use_full_text=True.
         """
+        unknown = set(settings) - set(StatusSetting.model_fields)
+        if unknown:
+            # StatusSetting would just ignore them, so a typo would silently turn a feature off.
+            raise TypeError(f"Unknown settings: {', '.join(sorted(unknown))}")
         settings = StatusSetting(
-            research_question=research_question, paper_limit=paper_limit or 5
+            research_question=research_question,
+            paper_limit=paper_limit or 5,
+            article_store=article_store,
+            deadline=deadline,
+            **settings,
         )
         super().__init__(
             papers=[], questions=[], settings=settings, trace_file=trace_file
         )
+        if article_store is not None:
+            self._paper_table = PaperTable(ArticleStore(article_store))
+
+    @model_serializer(mode="wrap")
+    def _serialize(self, handler):
+        """Adds the paper table of the large-run mode to the dumps: the IDs of the articles in the store and their scores.
+        The article bodies stay in the store, so a status loaded with from_json reads them from there again.
+        """
+        data = handler(self)
+        if self._paper_table is not None and isinstance(data, dict):
+            data["__paper_table__"] = {
+                "ids": list(self._paper_table.ids),
+                "scores": list(self._paper_table.iter_scores()),
+            }
+        return data
+
+    @classmethod
+    def from_json(cls, text: str) -> Self:
+        """Loads a status that was saved with model_dump_json(by_alias=True), e.g. to hand it to another process.
+        model_validate_json can't be used for this, because it would call the custom __init__ above.
+        In large-run mode, the article store at settings.article_store is opened again, so it has to be reachable from here.
+        """
+        data = json.loads(text)
+        values = {}
+        for name, field in cls.model_fields.items():
+            key = field.alias or name
+            if key in data:
+                values[name] = TypeAdapter(field.annotation).validate_python(data[key])
+        status = cls.model_construct(**values)
+        table = data.get("__paper_table__")
+        if status.settings.article_store is not None and table is not None:
+            status._paper_table = PaperTable(ArticleStore(status.settings.article_store))
+            status._paper_table.restore(table["ids"], table["scores"])
+        return status
+
+    def close(self):
+        """Closes the article store of the large-run mode. Call it when the request is done."""
+        if self._paper_table is not None:
+            self._paper_table.store.close()
+
+    # The papers should only be accessed over the following methods, so the agents don't need to know whether
+    # the request runs in large-run mode or not.
+
+    def num_papers(self) -> int:
+        """Returns the number of papers of the request."""
+        if self._paper_table is not None:
+            return len(self._paper_table)
+        return len(self.papers)
+
+    def get_paper(self, index: int) -> Article:
+        """Returns the article at the given position. In large-run mode, it is loaded from the store."""
+        if self._paper_table is not None:
+            return Article.model_validate_json(self._paper_table.get_body(index))
+        return self.papers[index][0]
+
+    def get_paper_relevance(self, index: int) -> float | None:
+        """Returns the relevance score of the paper at the given position, or None if it is not known yet."""
+        if self._paper_table is not None:
+            return self._paper_table.get_score(index)
+        return self.papers[index][1]
+
+    def set_paper_relevance(self, index: int, relevance: float | None):
+        """Sets the relevance score of the paper at the given position."""
+        if self._paper_table is not None:
+            self._paper_table.set_score(index, relevance)
+        else:
+            self.papers[index] = (self.papers[index][0], relevance)
+
+    def paper_relevances(self) -> list[float | None]:
+        """Returns the relevance scores of all papers. This never loads an article."""
+        if self._paper_table is not None:
+            return list(self._paper_table.iter_scores())
+        return [relevance for _, relevance in self.papers]
+
+    def iter_papers(self) -> Iterator[tuple[Article, float | None]]:
+        """Iterates over the papers and their relevance scores.
+        In large-run mode, every article is only loaded when the iteration reaches it."""
+        for i in range(self.num_papers()):
+            yield self.get_paper(i), self.get_paper_relevance(i)
+
+    def add_papers(
+        self, articles: list[Article], relevances: list[float | None] | None = None
+    ):
+        """Adds articles to the request. If no relevance scores are given, they are set to None."""
+        if relevances is None:
+            relevances = [None] * len(articles)
+        if self._paper_table is not None:
+            self._paper_table.append_many(
+                [article.model_dump_json() for article in articles], relevances
+            )
+        else:
+            self.papers.extend(zip(articles, relevances))
+
+    def clear_papers(self):
+        """Removes all papers from the request."""
+        if self._paper_table is not None:
+            self._paper_table.clear()
+        else:
+            self.papers = []
+        self.paper_contexts = {}  # The excerpts are keyed by the index of the paper, so they don't fit anymore.
+        self.paper_clusters = []  # The same goes for the clusters.
+
+    def cancel(self):
+        """Cancels the request, e.g. because the client aborted it. The running stage is cancelled as soon as possible."""
+        self._cancelled = True
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+
+    async def wait_cancelled(self):
+        """Waits until the request is cancelled."""
+        if self._cancel_event is None:
+            self._cancel_event = asyncio.Event()
+        if self._cancelled:
+            self._cancel_event.set()
+        await self._cancel_event.wait()
+
+    def remaining_time(self) -> float | None:
+        """Returns the seconds until the deadline, or None if the request has no deadline."""
+        if self.settings.deadline is None:
+            return None
+        return max(0.0, self.settings.deadline - time.time())
+
+    def should_stop(self) -> bool:
+        """Whether the request was cancelled or its deadline passed, so no more work should be started."""
+        return self._cancelled or self.remaining_time() == 0.0
+
+    def needs_formatting(
+        self, question: SurveyQuestion, relevance: float | None
+    ) -> bool:
+        """Whether the question still has to be formatted. Questions below the question_relevance_threshold are never formatted."""
+        if question.answer_type is not None and question.options is not None:
+            return False
+        threshold = self.settings.question_relevance_threshold
+        return threshold is None or relevance is None or relevance >= threshold
+
+    def complete_questions(self) -> list[tuple[SurveyQuestion, float]]:
+        """Returns the questions that are completely done, i.e. they have a relevance score, an answer type and options."""
+        return [
+            (question, relevance)
+            for question, relevance in self.questions
+            if relevance is not None
+            and question.answer_type is not None
+            and question.options is not None
+        ]
 
     def pretty_print(self):
         """Prints the status of the request in a human-readable format."""
@@ -137,8 +379,11 @@ class RequestStages(Enum):
     # Note: These values are used to determine the order of the steps, so they should be unique and in ascending order.
     # However, they should not be used directly, only ever over the enum.
     FINDING_LITERATURE = 100
+    CLUSTERING_LITERATURE = 150
     CHECKING_LITERATURE_RELEVANCE = 200
+    RETRIEVING_FULL_TEXT = 250
     CREATING_SURVEY_QUESTIONS = 300
     CHECKING_QUESTION_RELEVANCE = 400
+    SCORING_AND_FORMATTING_SURVEY_QUESTIONS = 450  # Replaces the stages around it if fuse_question_stages is set.
     FORMATTING_SURVEY_QUESTIONS = 500
     FINISHED = 999
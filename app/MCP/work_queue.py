@@ -0,0 +1,295 @@
+# A durable work queue for running the stages of requests in separate worker processes.
+
+# A single asyncio process can only orchestrate so many requests, and all the CPU-side work (parsing, validation,
+# the vector math) shares one core. In worker mode, the process that owns a request only publishes its next stage
+# to this queue, and any number of workers (see MCP.worker) take the stages from it, run them and send back the result.
+#
+# The queue is a single SQLite file, so it survives restarts and can be shared by processes on the same host
+# (or on several hosts through a shared directory, as long as its file system supports locking properly; NFS often doesn't).
+# A worker leases a job for a limited time and has to extend the lease while it works. If it crashes, the lease expires
+# and the job is delivered to another worker, until it has been tried max_deliveries times.
+# The result is only accepted from the worker that holds the lease, so a job that was redelivered is never applied twice.
+# A job is a whole stage, but the stages write every finished item into the request status right away, and the worker
+# saves that status with every lease extension. So a worker that takes over after a crash only redoes the items that
+# were not finished by the last extension, not the whole stage.
+# The SQLite calls block (and may wait for the lock of another process), so the async code runs them in a thread.
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+from MCP.types import RequestStages, RequestStatus, StepInformation
+
+# Example: SURVEY_MACHINE_QUEUE=MCP/cache/work_queue.sqlite uv run -m MCP.main, with workers started by uv run -m MCP.worker
+QUEUE_ENV = "SURVEY_MACHINE_QUEUE"  # If set, main_loop hands its stages to the workers of this queue.
+DEFAULT_QUEUE_PATH = "MCP/cache/work_queue.sqlite"
+
+default_lease_seconds = (
+    300.0  # How long a worker may hold a job without extending its lease.
+)
+max_deliveries = 3  # How often a job is handed out before it counts as failed.
+poll_interval = 0.2  # How often the owner of a request checks whether its job is done.
+
+
+class Job:
+    """A leased job, as a worker sees it."""
+
+    def __init__(self, job_id: int, stage: str, payload: str, deliveries: int):
+        self.id = job_id
+        self.stage = RequestStages[stage]
+        self.payload = (
+            payload  # The request status, as saved by model_dump_json(by_alias=True).
+        )
+        self.deliveries = (
+            deliveries  # How often the job was handed out, including this time.
+        )
+
+
+class WorkQueue:
+    """The queue of stage jobs, backed by a single SQLite file.
+    Every process opens its own WorkQueue on the same file. All state changes happen in immediate transactions,
+    so two workers can never lease the same job.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH):
+        """Opens (or creates) the queue at the given path."""
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # isolation_level=None turns off the implicit transactions of the sqlite3 module, they are started by hand.
+        # The timeout makes a process wait for the lock of another one instead of failing right away.
+        # The connection is used from the threads of run_stage_on_queue and the worker, one at a time.
+        self._connection = sqlite3.connect(
+            path, timeout=30.0, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, stage TEXT NOT NULL, payload TEXT NOT NULL, "
+            "state TEXT NOT NULL DEFAULT 'queued', "  # queued, leased, done, failed or cancelled
+            "owner TEXT, lease_expires REAL, deliveries INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, step_info TEXT, created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the body in an immediate transaction, which takes the write lock right away."""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            with self._connection:  # Commits, or rolls back on an exception.
+                yield self._connection
+
+    def publish(self, stage: RequestStages, status: RequestStatus) -> int:
+        """Adds a job for running the stage on the request status and returns its ID."""
+        if status.settings.article_store is not None:
+            # The papers of the large-run mode live in a local file, a worker could not see them.
+            # main_loop runs those requests in-process instead, so this is only hit by other callers.
+            raise ValueError("Requests in large-run mode can't be run by workers.")
+        now = time.time()
+        with self._transaction():
+            cursor = self._connection.execute(
+                "INSERT INTO jobs (stage, payload, created, updated) VALUES (?, ?, ?, ?)",
+                (stage.name, status.model_dump_json(by_alias=True), now, now),
+            )
+        return cursor.lastrowid
+
+    def lease(
+        self, owner: str, lease_seconds: float = default_lease_seconds
+    ) -> Optional[Job]:
+        """Hands the oldest available job to the worker called owner, or returns None if there is none.
+        A job is available if it is queued, or if it was leased but the lease expired (the worker probably died).
+        """
+        now = time.time()
+        with self._transaction():
+            # Jobs that expired too often are given up, so a job that kills every worker can't go around forever.
+            given_up = StepInformation(
+                errors=["The job was delivered too often without a result."]
+            )
+            self._connection.execute(
+                "UPDATE jobs SET state = 'failed', step_info = ?, updated = ? "
+                "WHERE state = 'leased' AND lease_expires < ? AND deliveries >= ?",
+                (given_up.model_dump_json(), now, now, max_deliveries),
+            )
+            row = self._connection.execute(
+                "SELECT id, stage, payload, deliveries FROM jobs "
+                "WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, stage, payload, deliveries = row
+            self._connection.execute(
+                "UPDATE jobs SET state = 'leased', owner = ?, lease_expires = ?, deliveries = ?, updated = ? "
+                "WHERE id = ?",
+                (owner, now + lease_seconds, deliveries + 1, now, job_id),
+            )
+        return Job(job_id, stage, payload, deliveries + 1)
+
+    def extend(
+        self,
+        job_id: int,
+        owner: str,
+        lease_seconds: float = default_lease_seconds,
+        progress: Optional[str] = None,
+    ) -> bool:
+        """Extends the lease of a job. Returns False if the worker doesn't hold the lease anymore
+        (it expired and the job went to another worker, or the job was cancelled), so it should stop working on it.
+        If progress is given (the request status with the items finished so far, saved like the payload),
+        it replaces the payload, so the next delivery starts from there.
+        """
+        now = time.time()
+        with self._transaction():
+            cursor = self._connection.execute(
+                "UPDATE jobs SET lease_expires = ?, payload = COALESCE(?, payload), updated = ? "
+                "WHERE id = ? AND owner = ? AND state = 'leased'",
+                (now + lease_seconds, progress, now, job_id, owner),
+            )
+        return cursor.rowcount == 1
+
+    def ack(
+        self,
+        job_id: int,
+        owner: str,
+        status: RequestStatus,
+        step_info: StepInformation,
+    ) -> bool:
+        """Stores the result of a job. Returns False (and stores nothing) if the worker doesn't hold the lease anymore."""
+        now = time.time()
+        with self._transaction():
+            cursor = self._connection.execute(
+                "UPDATE jobs SET state = 'done', result = ?, step_info = ?, updated = ? "
+                "WHERE id = ? AND owner = ? AND state = 'leased'",
+                (
+                    status.model_dump_json(by_alias=True),
+                    step_info.model_dump_json(),
+                    now,
+                    job_id,
+                    owner,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def nack(self, job_id: int, owner: str, error: str):
+        """Gives a job back after an error, so another worker can try it. After max_deliveries, it counts as failed."""
+        now = time.time()
+        with self._transaction():
+            self._connection.execute(
+                "UPDATE jobs SET state = CASE WHEN deliveries >= ? THEN 'failed' ELSE 'queued' END, "
+                "owner = NULL, lease_expires = NULL, step_info = ?, updated = ? "
+                "WHERE id = ? AND owner = ? AND state = 'leased'",
+                (
+                    max_deliveries,
+                    StepInformation(errors=[error]).model_dump_json(),
+                    now,
+                    job_id,
+                    owner,
+                ),
+            )
+
+    def cancel(self, job_id: int):
+        """Cancels a job that is not done yet. A worker running it notices on its next lease extension."""
+        with self._transaction():
+            self._connection.execute(
+                "UPDATE jobs SET state = 'cancelled', updated = ? "
+                "WHERE id = ? AND state IN ('queued', 'leased')",
+                (time.time(), job_id),
+            )
+
+    def result(
+        self, job_id: int
+    ) -> Optional[tuple[Optional[RequestStatus], StepInformation]]:
+        """Returns the result of a finished job (the status is None if it failed), or None while it is still running."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state, result, step_info FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"Job {job_id} is not in the queue at {self.path}.")
+        state, result, step_info = row
+        if state in ("queued", "leased"):
+            return None
+        info = (
+            StepInformation.model_validate_json(step_info)
+            if step_info
+            else StepInformation()
+        )
+        if state != "done":
+            info.add_error(f"The job of this stage was {state}.")
+            return None, info
+        return RequestStatus.from_json(result), info
+
+    def forget(self, job_id: int):
+        """Deletes a job, once its result was merged back into the request."""
+        with self._transaction():
+            self._connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def counts(self) -> dict[str, int]:
+        """Returns how many jobs are in each state, for logging."""
+        with self._lock:
+            return dict(
+                self._connection.execute(
+                    "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+                ).fetchall()
+            )
+
+    def close(self):
+        """Closes the connection to the queue."""
+        with self._lock:
+            self._connection.close()
+
+
+def new_worker_id() -> str:
+    """Returns a name for a worker that is unique across processes and hosts."""
+    return f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def merge_stage_result(status: RequestStatus, result: RequestStatus):
+    """Merges the request status returned by a worker into the status of the owner of the request.
+    The stages only ever change the papers, the questions, the excerpts and the clusters, so those are taken over.
+    The rest (the settings, the cancellation, the trace file) stays as the owner has it.
+    """
+    status.papers = result.papers
+    status.questions = result.questions
+    status.paper_contexts = result.paper_contexts
+    status.paper_clusters = result.paper_clusters
+
+
+async def run_stage_on_queue(
+    queue: WorkQueue, status: RequestStatus, stage: RequestStages
+) -> tuple[RequestStatus, StepInformation]:
+    """Publishes the stage as a job, waits until a worker has run it and merges the result into the status.
+    If this is cancelled (e.g. by the deadline of the request, see MCP.steps.run_step_function), the job is cancelled too.
+    """
+    # The job is published even if this is cancelled in the meantime, so it has to be awaited to get its ID for cancelling.
+    publishing = asyncio.ensure_future(asyncio.to_thread(queue.publish, stage, status))
+    try:
+        job_id = await asyncio.shield(publishing)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(queue.cancel, await publishing)
+        raise
+    try:
+        while True:
+            result = await asyncio.to_thread(queue.result, job_id)
+            if result is not None:
+                break
+            await asyncio.sleep(poll_interval)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(queue.cancel, job_id)
+        raise
+
+    await asyncio.to_thread(queue.forget, job_id)
+    result_status, step_info = result
+    if result_status is not None:
+        merge_stage_result(status, result_status)
+    return status, step_info
@@ -0,0 +1,171 @@
+# A worker for the work queue (see MCP.work_queue).
+
+# Takes stage jobs from the queue, runs them like main_loop would, and sends the result back.
+# Start as many as the machine (or the Ollama backends) can handle, on any host that can open the queue file:
+#     uv run -m MCP.worker --queue MCP/cache/work_queue.sqlite --processes 4 --jobs-per-process 2
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+
+from MCP.cassette import is_replaying
+from MCP.main import app
+from MCP.ollama import backend_pool, close_llm_http_clients
+from MCP.prompt import flush_token_usage, load_tokenizer
+from MCP.steps import next_step, run_step_function
+from MCP.types import RequestStatus, StepInformation
+from MCP.work_queue import (
+    DEFAULT_QUEUE_PATH,
+    QUEUE_ENV,
+    Job,
+    WorkQueue,
+    default_lease_seconds,
+    new_worker_id,
+)
+
+idle_poll_interval = 0.5  # How long a worker waits before asking an empty queue again.
+
+
+async def run_job(queue: WorkQueue, job: Job, owner: str, lease_seconds: float):
+    """Runs the stage of a job and acks it. The lease is extended while the stage runs;
+    if that fails (the job was cancelled or given to another worker), the stage is cancelled.
+    Every extension saves the items the stage finished so far, so a redelivery doesn't redo them (see MCP.work_queue).
+    All queue calls run in a thread, since they may have to wait for the lock of another process.
+    """
+    status = RequestStatus.from_json(job.payload)
+    try:
+        await run_job_stage(queue, job, owner, lease_seconds, status)
+    finally:
+        status.close()  # A large-run status has its article store open.
+
+
+async def run_job_stage(
+    queue: WorkQueue, job: Job, owner: str, lease_seconds: float, status: RequestStatus
+):
+    step = next_step(status)
+    if step is None or step[3] != job.stage:
+        # An earlier delivery already got this far, but its result was lost. Nothing to do for this stage.
+        step_info = StepInformation()
+        step_info.add_warning(f"Stage {job.stage.name} was already done.")
+        await asyncio.to_thread(queue.ack, job.id, owner, status, step_info)
+        return
+
+    # run_step_function also stops the stage at the deadline of the request.
+    stage = asyncio.create_task(run_step_function(status, step[2]))
+    while True:
+        done, _ = await asyncio.wait({stage}, timeout=lease_seconds / 3)
+        if done:
+            break
+        # The stage writes its finished items into the status right away. It is saved here, on the loop,
+        # since the stage keeps changing it while the thread writes it.
+        progress = status.model_dump_json(by_alias=True)
+        if not await asyncio.to_thread(queue.extend, job.id, owner, lease_seconds, progress):
+            print(f"Lost the lease of job {job.id}, stopping it.")
+            stage.cancel()
+            await asyncio.wait({stage})
+            return
+
+    try:
+        status, step_info = stage.result()
+    except Exception as e:
+        print(f"Error running job {job.id} ({job.stage.name}): {e}")
+        await asyncio.to_thread(queue.nack, job.id, owner, f"Error running stage {job.stage.name}: {e}")
+        return
+    if not await asyncio.to_thread(queue.ack, job.id, owner, status, step_info):
+        print(f"Lost the lease of job {job.id} just before it was done.")
+
+
+async def worker_loop(
+    queue_path: str, jobs_per_process: int = 1, lease_seconds: float = default_lease_seconds
+):
+    """Takes jobs from the queue and runs up to jobs_per_process of them at the same time, until it is stopped."""
+    queue = WorkQueue(queue_path)
+    owner = new_worker_id()
+    print(f"Worker {owner} is waiting for jobs in {queue_path}.")
+
+    async with app.run():
+        health_checks = None
+        if not is_replaying():
+            await backend_pool.check_health()
+            health_checks = asyncio.create_task(backend_pool.run_health_checks())
+        # The prompts are budgeted with the tokenizer of the model, which may have to be downloaded first.
+        await load_tokenizer()
+
+        async def take_jobs():
+            while True:
+                job = await asyncio.to_thread(queue.lease, owner, lease_seconds)
+                if job is None:
+                    await asyncio.sleep(idle_poll_interval)
+                    continue
+                print(f"Running job {job.id}: {job.stage.name} (delivery {job.deliveries})")
+                await run_job(queue, job, owner, lease_seconds)
+
+        try:
+            await asyncio.gather(*(take_jobs() for _ in range(jobs_per_process)))
+        finally:
+            if health_checks is not None:
+                health_checks.cancel()
+            await close_llm_http_clients()
+            flush_token_usage()
+            queue.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs stage jobs from the work queue.")
+    parser.add_argument(
+        "--queue",
+        default=os.getenv(QUEUE_ENV, DEFAULT_QUEUE_PATH),
+        help="Path of the queue file",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of worker processes to start",
+    )
+    parser.add_argument(
+        "--jobs-per-process",
+        type=int,
+        default=1,
+        help="Number of jobs each process runs at the same time",
+    )
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=default_lease_seconds,
+        help="Seconds a job stays leased without an extension",
+    )
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        # Every process is a worker of its own, with its own event loop and its own lease owner name.
+        command = [
+            sys.executable,
+            "-m",
+            "MCP.worker",
+            "--queue",
+            args.queue,
+            "--jobs-per-process",
+            str(args.jobs_per_process),
+            "--lease",
+            str(args.lease),
+        ]
+        processes = [subprocess.Popen(command) for _ in range(args.processes)]
+        try:
+            for process in processes:
+                process.wait()
+        finally:
+            for process in processes:
+                process.terminate()
+        return
+
+    try:
+        asyncio.run(worker_loop(args.queue, args.jobs_per_process, args.lease))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# This file is here so that main.py can import the other modules of literature_access,
+# both with "fastapi run literature_access/main.py" and with "uvicorn literature_access.main:app".
@@ -0,0 +1,312 @@
+# A persistent cache for the OpenAlex responses of literature_access.
+
+# Without it, every /works and /search call went to OpenAlex, even for a query that was answered a minute before.
+# The responses are stored compressed in a SQLite file, keyed by the normalized query parameters, together with their
+# ETag and Last-Modified headers. A fresh entry is answered from the cache directly. An expired entry is still answered
+# immediately, and refreshed in the background with a conditional request (which is cheap if nothing changed).
+# Only entries that are very old or missing make the caller wait for OpenAlex.
+# All requests to OpenAlex go through one client and one rate limiter, to stay inside the limits of the polite pool.
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
+from urllib.parse import urlencode
+
+import httpx
+
+CACHE_PATH = os.getenv(
+    "OPEN_ALEX_CACHE_PATH", "literature_access/cache/openalex.sqlite"
+)
+
+# How long a response is answered from the cache without asking OpenAlex again. Works rarely change within a day.
+fresh_seconds = float(os.getenv("OPEN_ALEX_CACHE_FRESH_SECONDS", str(24 * 3600)))
+# How long after that an expired response is still answered immediately while it is refreshed in the background.
+stale_seconds = float(os.getenv("OPEN_ALEX_CACHE_STALE_SECONDS", str(7 * 24 * 3600)))
+# When the stored (compressed) responses grow over this size, the least recently used ones are deleted.
+max_cache_bytes = int(float(os.getenv("OPEN_ALEX_CACHE_MAX_MB", "256")) * 1024 * 1024)
+# The polite pool of OpenAlex allows 10 requests per second.
+requests_per_second = float(os.getenv("OPEN_ALEX_MAX_RPS", "10"))
+
+# Parameters that don't change the response, so they are not part of the cache key.
+_ignored_params = {"mailto", "api_key"}
+
+
+def cache_key(base_url: str, params: dict) -> str:
+    """Returns the cache key of a request: the URL with the parameters sorted, without the ones that don't change the
+    response, and with the search text in lower case and without extra whitespace (the search of OpenAlex ignores both).
+    """
+    normalized = {}
+    for name, value in params.items():
+        name = name.strip().lower()
+        if name in _ignored_params or value is None:
+            continue
+        value = " ".join(str(value).split())
+        if name == "search":
+            value = value.lower()
+        normalized[name] = value
+    return base_url.rstrip("?") + "?" + urlencode(sorted(normalized.items()))
+
+
+class RateLimiter:
+    """Spaces out the requests so that at most `rate` are started per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_slot = 0.0
+
+    async def wait(self):
+        """Waits until the next request may be started.
+        The slot is reserved before sleeping, so concurrent callers queue up one interval apart.
+        """
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        """No request is started for the given time, e.g. after OpenAlex answered with 429 Too Many Requests."""
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+class CachedResponse:
+    """A response from the cache, with what is needed to revalidate it."""
+
+    def __init__(
+        self,
+        data: dict,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        fetched_at: float,
+    ):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+class ResponseCache:
+    """The on-disk part of the cache: zlib-compressed JSON bodies with their validators, in a single SQLite file."""
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = max_cache_bytes):
+        """Opens (or creates) the cache at the given path."""
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # CachedOpenAlex uses the cache from worker threads, so the disk I/O doesn't block the server.
+        # They share the connection, one at a time.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Every cache hit updates last_used, with WAL that is an append instead of a rewrite plus fsync.
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, body BLOB NOT NULL, etag TEXT, last_modified TEXT, "
+            "fetched_at REAL NOT NULL, last_used REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._connection.commit()
+        # The total size is tracked in memory, so it doesn't have to be summed up after every insert.
+        self._total_bytes = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Returns the cached response for the key, or None if there is none."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT body, etag, last_modified, fetched_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+        body, etag, last_modified, fetched_at = row
+        return CachedResponse(
+            json.loads(zlib.decompress(body)), etag, last_modified, fetched_at
+        )
+
+    def put(
+        self,
+        key: str,
+        data: dict,
+        etag: Optional[str],
+        last_modified: Optional[str],
+    ):
+        """Stores a response, replacing the previous one for the key, and evicts old entries if the cache is too big."""
+        body = zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 6)
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                previous = self._connection.execute(
+                    "SELECT size FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, body, etag, last_modified, now, now, len(body)),
+                )
+            self._total_bytes += len(body) - (previous[0] if previous else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def mark_fresh(self, key: str):
+        """Resets the age of an entry, after OpenAlex confirmed with 304 Not Modified that it is still valid."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE responses SET fetched_at = ?, last_used = ? WHERE key = ?",
+                (now, now, key),
+            )
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache is 10% under its size limit,
+        so that not every single insert has to evict something. Called by put, with the lock held.
+        """
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            if self._total_bytes <= target:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        with self._connection:
+            self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def close(self):
+        """Closes the connection to the cache."""
+        with self._lock:
+            self._connection.close()
+
+
+class CachedOpenAlex:
+    """The OpenAlex client of literature_access: answers from the cache where possible, and sends the remaining
+    requests through one shared connection pool and the rate limiter.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        mail: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.base_url = base_url
+        self.mail = mail
+        self.cache = cache or ResponseCache()
+        self.limiter = limiter or RateLimiter(requests_per_second)
+        self._client: Optional[httpx.AsyncClient] = None
+        # The requests to OpenAlex that are running right now, by cache key.
+        # Concurrent requests for the same key (and background refreshes) share one call instead of sending several.
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created on first use, so it belongs to the event loop of the server.
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=30.0)
+        return self._client
+
+    async def get(self, params: dict) -> dict:
+        """Returns the OpenAlex response for the parameters.
+        Raises an httpx.HTTPError if OpenAlex could not be reached and there is nothing in the cache to fall back on.
+        """
+        key = cache_key(self.base_url, params)
+        # The cache reads from disk and decompresses, so it runs in a thread (like all cache calls here).
+        entry = await asyncio.to_thread(self.cache.get, key)
+        if entry is not None:
+            age = entry.age()
+            if age < fresh_seconds:
+                return entry.data
+            if age < fresh_seconds + stale_seconds:
+                # Stale-while-revalidate: answer now, refresh for the next caller.
+                self._start_fetch(key, params, entry)
+                return entry.data
+
+        try:
+            return await asyncio.shield(self._start_fetch(key, params, entry))
+        except httpx.HTTPError as e:
+            if entry is None:
+                raise
+            # A very old answer is still better than none.
+            print(f"Error refreshing {key}, answering from the cache: {e}")
+            return entry.data
+
+    def _start_fetch(
+        self, key: str, params: dict, entry: Optional[CachedResponse]
+    ) -> asyncio.Task:
+        """Returns the running request for the key, or starts a new one."""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, params, entry))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._fetch_done(key, done))
+        return task
+
+    def _fetch_done(self, key: str, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        # Nobody awaits a background refresh, so its errors are reported here.
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error fetching {key} from OpenAlex: {task.exception()}")
+
+    async def _fetch(
+        self, key: str, params: dict, entry: Optional[CachedResponse]
+    ) -> dict:
+        """Sends the request to OpenAlex, as a conditional request if there is a cached entry, and updates the cache."""
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        if self.mail:
+            params = {**params, "mailto": self.mail}
+
+        await self.limiter.wait()
+        response = await self._get_client().get(
+            self.base_url, params=params, headers=headers
+        )
+        if response.status_code == 429:
+            # Over the limit anyway (e.g. other clients with the same mail), so back off as long as OpenAlex asks.
+            retry_after = response.headers.get("Retry-After", "1")
+            self.limiter.pause(float(retry_after) if retry_after.isdigit() else 1.0)
+        if response.status_code == 304 and entry is not None:
+            await asyncio.to_thread(self.cache.mark_fresh, key)
+            return entry.data
+        response.raise_for_status()
+
+        data = response.json()
+        await asyncio.to_thread(
+            self.cache.put,
+            key,
+            data,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+        return data
+
+    async def close(self):
+        """Waits for the running refreshes, then closes the connection pool and the cache."""
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight.values(), return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        await asyncio.to_thread(self.cache.close)
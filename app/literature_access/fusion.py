@@ -0,0 +1,48 @@
+# Merging the results of several searches into one ranked list, for /search/multi.
+
+# The ranks of different queries can't be compared by their scores (OpenAlex's relevance scores depend on the query),
+# so the lists are merged by reciprocal-rank fusion: every work gets 1 / (k + rank) from every list it appears in,
+# and the works are sorted by the sum. A work that several queries find near the top wins over one that a single
+# query puts first. The same work found by several queries is only returned once.
+
+from typing import Optional
+
+# The k of reciprocal-rank fusion. 60 is the usual value from the original paper (Cormack et al., 2009);
+# larger values flatten the difference between the top ranks.
+rrf_k = 60
+
+
+def work_key(work: dict) -> Optional[str]:
+    """Returns the key that identifies a work across searches: its OpenAlex ID, or its DOI or title if that is missing."""
+    if work.get("id"):
+        return str(work["id"]).rsplit("/", 1)[-1].upper()
+    if work.get("doi"):
+        return "doi:" + str(work["doi"]).lower().removeprefix("https://doi.org/")
+    title = work.get("display_name") or work.get("title")
+    if title:
+        return "title:" + " ".join(str(title).lower().split())
+    return None
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: dict[str, list[dict]], k: float = rrf_k
+) -> list[dict]:
+    """Fuses the ranked results of several queries (by query) into one list, best first.
+    Every work is a copy of the first result seen for it, with the fused score and the queries that found it added.
+    """
+    fused: dict[str, dict] = {}
+    for query, works in ranked_lists.items():
+        for rank, work in enumerate(works, start=1):
+            key = work_key(work)
+            if key is None:
+                continue  # Nothing to recognize it by, so it can't be merged with anything.
+            if key not in fused:
+                fused[key] = {**work, "fusion_score": 0.0, "matched_queries": []}
+            entry = fused[key]
+            if query in entry["matched_queries"]:
+                continue  # Duplicates within one list only count with their best rank.
+            entry["fusion_score"] += 1.0 / (k + rank)
+            entry["matched_queries"].append(query)
+
+    # Sorted by score; ties keep the order in which the works were first seen.
+    return sorted(fused.values(), key=lambda work: work["fusion_score"], reverse=True)
@@ -0,0 +1,372 @@
+"""Bulk ingestion of the OpenAlex works snapshot into a local literature store.
+
+For large deployments, asking OpenAlex for every request is too slow and runs into the rate limit.
+Instead, the works snapshot (https://docs.openalex.org/download-all-data/openalex-snapshot) can be loaded
+into a local SQLite file once, and refreshed from the newer snapshot files later.
+
+The snapshot is a folder of gzipped JSONL files (data/works/updated_date=.../part_000.gz).
+They are read line by line, and the lines are parsed in a process pool, since parsing the (large) JSON records
+is what takes the time. Every work is cut down to what the agents need: the fields of an Article, the IDs,
+the concepts and the year. The abstract is rebuilt from the inverted index OpenAlex stores it as.
+The rows are written in large transactions, together with a checkpoint of how far each file got,
+so an interrupted ingestion continues where it stopped. A work that appears in several files keeps its newest version.
+At the end, the full-text index over the titles and abstracts is rebuilt, which /search uses (see main.py).
+
+Run it from the app folder:
+    python -m literature_access.ingest path/to/openalex-snapshot/data/works --workers 8
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional
+
+STORE_PATH = os.getenv("OPEN_ALEX_STORE_PATH", "literature_access/cache/works.sqlite")
+
+chunk_lines = 2000  # How many lines are sent to a worker at once.
+transaction_rows = 50000  # How many works are written in one transaction (and between two checkpoints).
+report_interval = 10.0  # Seconds between two progress reports.
+max_authors = 10  # Works can have thousands of authors, only the first ones are kept.
+max_concepts = 10  # The concepts with the highest scores that are kept.
+
+
+def rebuild_abstract(inverted_index: Optional[dict]) -> Optional[str]:
+    """Rebuilds the text of an abstract from the inverted index OpenAlex stores it as ({word: [positions]})."""
+    if not inverted_index:
+        return None
+    positions = [
+        (position, word)
+        for word, word_positions in inverted_index.items()
+        for position in word_positions
+    ]
+    positions.sort()
+    return " ".join(word for _, word in positions)
+
+
+def project_work(work: dict) -> Optional[tuple]:
+    """Cuts a work of the snapshot down to a row of the works table. Returns None for works that are useless to the agents."""
+    title = work.get("display_name") or work.get("title")
+    if not work.get("id") or not title:
+        return None
+
+    authors = [
+        authorship.get("author", {}).get("display_name")
+        for authorship in work.get("authorships") or []
+    ]
+    authors = [author for author in authors if author]
+    author = ", ".join(authors[:max_authors])
+    if len(authors) > max_authors:
+        author += " et al."
+
+    concepts = sorted(
+        work.get("concepts") or [], key=lambda concept: -(concept.get("score") or 0)
+    )
+    location = work.get("primary_location") or {}
+    return (
+        work["id"].rsplit("/", 1)[-1],  # Only the W... part of the URL.
+        work.get("doi"),
+        title,
+        author or None,
+        rebuild_abstract(work.get("abstract_inverted_index")),
+        work.get("doi") or location.get("landing_page_url") or work["id"],
+        work.get("publication_year"),
+        json.dumps(
+            [
+                concept["display_name"]
+                for concept in concepts[:max_concepts]
+                if concept.get("display_name")
+            ]
+        ),
+        work.get("updated_date") or "",
+    )
+
+
+def parse_lines(lines: list[bytes]) -> tuple[list[tuple], int]:
+    """Parses a chunk of snapshot lines in a worker process. Returns the rows and the number of skipped lines."""
+    rows = []
+    skipped = 0
+    for line in lines:
+        try:
+            row = project_work(json.loads(line))
+        except (ValueError, AttributeError, KeyError, TypeError):
+            row = None
+        if row is None:
+            skipped += 1
+        else:
+            rows.append(row)
+    return rows, skipped
+
+
+class WorkStore:
+    """The local literature store: the works table and the checkpoints of the ingestion, in a single SQLite file.
+    The search index over the titles and abstracts is only rebuilt after an ingestion, keeping it up to date
+    row by row would slow the bulk writes down a lot.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The service searches the store from worker threads (several at once for /search/multi),
+        # so the connection is shared with them, one at a time.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # The ingestion writes millions of rows, so the journal is kept cheap. A crash loses at most the open transaction,
+        # and the checkpoints are part of it, so the ingestion repeats exactly what was lost.
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS works ("
+                "id TEXT PRIMARY KEY, doi TEXT, title TEXT NOT NULL, author TEXT, abstract TEXT, url TEXT, "
+                "year INTEGER, concepts TEXT NOT NULL, updated TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS ingest_checkpoints ("
+                "file TEXT PRIMARY KEY, lines INTEGER NOT NULL, done INTEGER NOT NULL, updated REAL NOT NULL)"
+            )
+            # An external-content index: it only holds the search terms, the text stays in the works table.
+            self._connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS works_search USING fts5("
+                "title, abstract, content='works', content_rowid='rowid')"
+            )
+
+    def checkpoint(self, file: str) -> tuple[int, bool]:
+        """Returns how many lines of the file were ingested already, and whether it is done."""
+        row = self._connection.execute(
+            "SELECT lines, done FROM ingest_checkpoints WHERE file = ?", (file,)
+        ).fetchone()
+        return (row[0], bool(row[1])) if row else (0, False)
+
+    def write(self, rows: list[tuple], file: str, lines: int, done: bool):
+        """Writes the rows and the checkpoint of the file in one transaction.
+        An existing work is only replaced by a version that was updated at the same time or later.
+        """
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO works (id, doi, title, author, abstract, url, year, concepts, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET doi = excluded.doi, title = excluded.title, "
+                "author = excluded.author, abstract = excluded.abstract, url = excluded.url, year = excluded.year, "
+                "concepts = excluded.concepts, updated = excluded.updated "
+                "WHERE excluded.updated >= works.updated",
+                rows,
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO ingest_checkpoints (file, lines, done, updated) VALUES (?, ?, ?, ?)",
+                (file, lines, int(done), time.time()),
+            )
+
+    def count(self) -> int:
+        """Returns the number of works in the store."""
+        return self._connection.execute("SELECT COUNT(*) FROM works").fetchone()[0]
+
+    def rebuild_search_index(self):
+        """Rebuilds the search index from the works table, after the works were written."""
+        with self._connection:
+            self._connection.execute(
+                "INSERT INTO works_search (works_search) VALUES ('rebuild')"
+            )
+
+    def search(self, query: str, limit: int = 25) -> list[dict]:
+        """Returns the works that best match the words of the query (by BM25 over the titles and abstracts),
+        shaped like the works of the OpenAlex API, so /search can answer with them instead.
+        """
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        # Every word is quoted, so nothing in the query is read as FTS5 syntax. A work has to match one of them.
+        match = " OR ".join(f'"{word}"' for word in words)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT works.id, works.doi, works.title, works.author, works.abstract, works.url, works.year, works.concepts "
+                "FROM works_search JOIN works ON works.rowid = works_search.rowid "
+                "WHERE works_search MATCH ? ORDER BY bm25(works_search) LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        return [
+            {
+                "id": "https://openalex.org/" + work_id,
+                "doi": doi,
+                "display_name": title,
+                "title": title,
+                "authorships": [
+                    {"author": {"display_name": name.strip()}}
+                    for name in (author or "").removesuffix(" et al.").split(",")
+                    if name.strip()
+                ],
+                "abstract": abstract,
+                "primary_location": {"landing_page_url": url},
+                "publication_year": year,
+                "concepts": [{"display_name": name} for name in json.loads(concepts)],
+            }
+            for work_id, doi, title, author, abstract, url, year, concepts in rows
+        ]
+
+    def close(self):
+        """Closes the connection to the store."""
+        self._connection.close()
+
+
+def snapshot_files(paths: list[str]) -> list[str]:
+    """Returns the .gz files in the given paths (files or folders, searched recursively), sorted by path.
+    The folders of the snapshot are named by their update date, so this also puts older updates first.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                files.extend(
+                    os.path.join(directory, name)
+                    for name in names
+                    if name.endswith(".gz")
+                )
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def read_chunks(path: str, skip_lines: int) -> Iterator[list[bytes]]:
+    """Reads the lines of a gzipped JSONL file in chunks, skipping the lines that were ingested already."""
+    with gzip.open(path, "rb") as file:
+        for _ in range(skip_lines):
+            if not file.readline():
+                return
+        chunk = []
+        for line in file:
+            chunk.append(line)
+            if len(chunk) == chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+class Progress:
+    """Counts the ingested works and reports the rate, so refresh windows can be planned."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.works = 0
+        self.skipped = 0
+        self.bytes = 0  # Compressed bytes of the finished files.
+
+    def add(self, works: int, skipped: int):
+        self.works += works
+        self.skipped += skipped
+        now = time.monotonic()
+        if now - self.last_report >= report_interval:
+            self.last_report = now
+            self.report("Ingested")
+
+    def report(self, prefix: str):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        print(
+            f"{prefix} {self.works} works in {elapsed:.0f} s ({self.works / elapsed:.0f} works/s), "
+            f"{self.skipped} lines skipped, {self.bytes / elapsed / 1e6:.1f} MB/s of finished files"
+        )
+
+
+def ingest_file(
+    store: WorkStore,
+    path: str,
+    pool: ProcessPoolExecutor,
+    workers: int,
+    progress: Progress,
+):
+    """Ingests a single snapshot file, continuing from its checkpoint."""
+    lines, done = store.checkpoint(path)
+    if done:
+        print(f"Skipping {path}, it was ingested already.")
+        return
+    if lines:
+        print(f"Continuing {path} after line {lines}.")
+
+    # The chunks are parsed in order, with a few more in flight than there are workers, so no worker waits
+    # and the memory stays bounded (unlike Pool.imap, which reads the whole file ahead).
+    in_flight: deque = deque()
+    rows: list[tuple] = []
+    pending_lines = 0
+
+    def collect():
+        nonlocal lines, pending_lines
+        chunk_size, future = in_flight.popleft()
+        chunk_rows, skipped = future.result()
+        rows.extend(chunk_rows)
+        pending_lines += chunk_size
+        progress.add(len(chunk_rows), skipped)
+        if len(rows) >= transaction_rows:
+            lines += pending_lines
+            store.write(rows, path, lines, False)
+            rows.clear()
+            pending_lines = 0
+
+    for chunk in read_chunks(path, lines):
+        in_flight.append((len(chunk), pool.submit(parse_lines, chunk)))
+        if len(in_flight) >= 2 * workers:
+            collect()
+    while in_flight:
+        collect()
+    store.write(rows, path, lines + pending_lines, True)
+    progress.bytes += os.path.getsize(path)
+
+
+def ingest(
+    paths: list[str], store_path: str = STORE_PATH, workers: Optional[int] = None
+):
+    """Ingests all snapshot files in the given paths into the store at store_path."""
+    workers = workers or os.cpu_count() or 1
+    files = snapshot_files(paths)
+    print(f"Ingesting {len(files)} files into {store_path} with {workers} workers.")
+    store = WorkStore(store_path)
+    progress = Progress()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path in files:
+                ingest_file(store, path, pool, workers, progress)
+        progress.report("Done:")
+        print("Rebuilding the search index.")
+        store.rebuild_search_index()
+        print(f"The store now has {store.count()} works.")
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Loads the OpenAlex works snapshot into the local literature store."
+    )
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help="Snapshot files (.gz) or folders containing them, e.g. openalex-snapshot/data/works",
+    )
+    parser.add_argument(
+        "--store", default=STORE_PATH, help="Path of the SQLite file of the store"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of parser processes (default: number of CPUs)",
+    )
+    args = parser.parse_args()
+    try:
+        ingest(args.paths, args.store, args.workers)
+    except KeyboardInterrupt:
+        print(
+            "Stopped. Run the same command again to continue from the last checkpoint."
+        )
+
+
+if __name__ == "__main__":
+    main()
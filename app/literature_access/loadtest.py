@@ -0,0 +1,266 @@
+"""Load test for the literature_access service.
+
+Sends /search and /works requests at a fixed rate (open loop, so a slow server can't slow down the load)
+and reports the latency percentiles, the throughput, the errors and how often OpenAlex was called.
+With --start-servers, the service and the mock OpenAlex (see mock_openalex.py) are started as well,
+so nothing goes to the real OpenAlex and the memory of the service can be measured.
+
+Run from the app folder:
+    python -m literature_access.loadtest --start-servers --rps 50 --duration 30
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+QUERIES = [
+    "social media mental health",
+    "remote work productivity",
+    "climate change anxiety",
+    "sleep quality students",
+    "loneliness elderly",
+    "video games aggression",
+    "mindfulness stress",
+    "screen time children",
+]
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Returns the p-th percentile (0-100) of the values."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def memory_of(pid: int) -> tuple[int, int]:
+    """Returns the current and peak resident memory of a process in kB (Linux only)."""
+    current, peak = 0, 0
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+    except OSError:
+        pass
+    return current, peak
+
+
+async def wait_until_up(url: str, timeout: float = 30.0):
+    """Waits until the server at url answers."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start.")
+
+
+def start_servers(
+    port: int, mock_port: int, latency_ms: float, error_rate: float
+) -> list[subprocess.Popen]:
+    """Starts the mock OpenAlex and the service pointed at it. Returns the processes (service last)."""
+    env = dict(
+        os.environ,
+        OPEN_ALEX_BASE_URL=f"http://127.0.0.1:{mock_port}/works?",
+        # Every run starts with an empty response cache, so the results are comparable.
+        OPEN_ALEX_CACHE_PATH=os.path.join(tempfile.mkdtemp(), "openalex.sqlite"),
+        MOCK_LATENCY_MS=str(latency_ms),
+        MOCK_ERROR_RATE=str(error_rate),
+    )
+    uvicorn = [sys.executable, "-m", "uvicorn", "--log-level", "warning"]
+    mock = subprocess.Popen(
+        uvicorn + ["literature_access.mock_openalex:app", "--port", str(mock_port)],
+        env=env,
+    )
+    service = subprocess.Popen(
+        uvicorn + ["literature_access.main:app", "--port", str(port)], env=env
+    )
+    return [mock, service]
+
+
+async def run_load(
+    target: str,
+    rps: float,
+    duration: float,
+    search_share: float,
+    max_in_flight: int,
+    transport: httpx.AsyncBaseTransport | None = None,
+) -> tuple[dict[str, list[float]], Counter, float]:
+    """Sends requests at the given rate for the given time.
+    Returns the latencies per endpoint, the counts of the outcomes and the total time it took.
+    The transport is for the tests, to send the requests to an app in the same process.
+    """
+    latencies: dict[str, list[float]] = {"/search": [], "/works": []}
+    outcomes: Counter = Counter()
+    in_flight = asyncio.Semaphore(max_in_flight)
+    limits = httpx.Limits(max_connections=max_in_flight)
+
+    async with httpx.AsyncClient(
+        base_url=target, timeout=60.0, limits=limits, transport=transport
+    ) as client:
+
+        async def one_request():
+            if random.random() < search_share:
+                endpoint, params = "/search", {"q": random.choice(QUERIES)}
+            else:
+                endpoint, params = "/works", {}
+            async with in_flight:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(endpoint, params=params)
+                    # The service reports upstream errors in the body, not in the status code.
+                    failed = response.status_code >= 400 or "error" in response.json()
+                except (httpx.HTTPError, ValueError):
+                    failed = True
+                latencies[endpoint].append(time.perf_counter() - start)
+                outcomes["errors" if failed else "ok"] += 1
+
+        tasks = []
+        start = time.perf_counter()
+        total = int(rps * duration)
+        for i in range(total):
+            # Open loop: the requests are started on schedule, no matter how long the earlier ones take.
+            delay = start + i / rps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if in_flight.locked():
+                outcomes["dropped (too many in flight)"] += 1
+                continue
+            tasks.append(asyncio.create_task(one_request()))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return latencies, outcomes, elapsed
+
+
+def report(
+    latencies: dict[str, list[float]],
+    outcomes: Counter,
+    elapsed: float,
+    upstream: dict | None,
+    memory: tuple[int, int] | None,
+):
+    """Prints the results of a load test."""
+    print(f"\nFinished {sum(outcomes.values())} requests in {elapsed:.1f} s")
+    completed = outcomes["ok"] + outcomes["errors"]
+    print(f"Throughput: {completed / elapsed:.1f} requests/s")
+    for name, count in outcomes.items():
+        print(f"  {name}: {count}")
+    for endpoint, values in latencies.items():
+        if not values:
+            continue
+        print(
+            f"{endpoint}: n={len(values)} "
+            f"p50={percentile(values, 50) * 1000:.1f} ms "
+            f"p95={percentile(values, 95) * 1000:.1f} ms "
+            f"p99={percentile(values, 99) * 1000:.1f} ms "
+            f"mean={statistics.mean(values) * 1000:.1f} ms"
+        )
+    if upstream is not None:
+        print(f"Upstream (OpenAlex) calls: {upstream}")
+    if memory is not None:
+        print(
+            f"Service memory: {memory[0] / 1024:.1f} MB now, {memory[1] / 1024:.1f} MB peak"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--target",
+        default="http://127.0.0.1:8000",
+        help="URL of the literature_access service",
+    )
+    parser.add_argument("--rps", type=float, default=20.0, help="Requests per second")
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="Duration in seconds"
+    )
+    parser.add_argument(
+        "--search-share",
+        type=float,
+        default=0.8,
+        help="Share of /search requests, the rest go to /works",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=200,
+        help="Requests over this are dropped instead of queued",
+    )
+    parser.add_argument(
+        "--start-servers",
+        action="store_true",
+        help="Start the service and the mock OpenAlex",
+    )
+    parser.add_argument(
+        "--mock-url",
+        default=None,
+        help="URL of a running mock OpenAlex, for the upstream call counts",
+    )
+    parser.add_argument(
+        "--mock-latency-ms",
+        type=float,
+        default=50.0,
+        help="Latency of the mock OpenAlex",
+    )
+    parser.add_argument(
+        "--mock-error-rate",
+        type=float,
+        default=0.0,
+        help="Share of failing mock OpenAlex responses",
+    )
+    args = parser.parse_args()
+
+    processes: list[subprocess.Popen] = []
+    mock_url = args.mock_url
+    try:
+        if args.start_servers:
+            port = int(httpx.URL(args.target).port or 8000)
+            mock_port = port + 100
+            processes = start_servers(
+                port, mock_port, args.mock_latency_ms, args.mock_error_rate
+            )
+            mock_url = f"http://127.0.0.1:{mock_port}"
+            await wait_until_up(mock_url + "/_stats")
+            await wait_until_up(args.target + "/")
+
+        if mock_url:
+            async with httpx.AsyncClient() as client:
+                await client.post(mock_url + "/_reset")
+
+        latencies, outcomes, elapsed = await run_load(
+            args.target, args.rps, args.duration, args.search_share, args.max_in_flight
+        )
+
+        upstream = None
+        if mock_url:
+            async with httpx.AsyncClient() as client:
+                upstream = (await client.get(mock_url + "/_stats")).json()
+        memory = memory_of(processes[-1].pid) if processes else None
+        report(latencies, outcomes, elapsed, upstream, memory)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,52 +1,136 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
+
 import httpx
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 from dotenv import load_dotenv
 
-
-app = FastAPI()
+from literature_access.cache import CachedOpenAlex
+from literature_access.fusion import reciprocal_rank_fusion
+from literature_access.ingest import STORE_PATH, WorkStore
 
 load_dotenv()
 
 OPEN_ALEX_MAIL = os.getenv("OPEN_ALEX_MAIL")
-OPEN_ALEX_BASE_URL = "https://api.openalex.org/works?"
+# Can be pointed at a local stand-in for load tests (see mock_openalex.py).
+OPEN_ALEX_BASE_URL = os.getenv("OPEN_ALEX_BASE_URL", "https://api.openalex.org/works?")
+
+# All requests to OpenAlex go through the cache (see cache.py), which also adds the mail for the polite pool.
+openalex = CachedOpenAlex(OPEN_ALEX_BASE_URL, OPEN_ALEX_MAIL)
+
+# If the works snapshot was ingested (see ingest.py), searches are answered from the local store first.
+OPEN_ALEX_STORE_PATH = os.getenv("OPEN_ALEX_STORE_PATH", STORE_PATH)
+local_store = (
+    WorkStore(OPEN_ALEX_STORE_PATH) if os.path.exists(OPEN_ALEX_STORE_PATH) else None
+)
+
+# Limits of /search/multi, so a single call can't use up the rate limit of OpenAlex for everyone else.
+MAX_QUERIES = 20
+MAX_PER_PAGE = 200
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await openalex.close()
+    if local_store is not None:
+        local_store.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def search_works(params: dict) -> dict:
+    """Runs a search on the local store, or on OpenAlex if there is no store or it can't fill a whole page of results.
+    A store with only a few matches usually just shares a common word with the query, while the works that are really
+    about it are missing from the snapshot (e.g. because they are newer). If OpenAlex can't be reached, the few
+    local matches are still returned. The answer looks like the one of OpenAlex either way.
+    """
+    local = None
+    if local_store is not None:
+        results = await asyncio.to_thread(
+            local_store.search, params["search"], params.get("per_page", 25)
+        )
+        local = {
+            "meta": {"count": len(results), "source": "local store"},
+            "results": results,
+        }
+        if len(results) >= params.get("per_page", 25):
+            return local
+    try:
+        return await openalex.get(params)
+    except httpx.HTTPError as e:
+        if not local or not local["results"]:
+            raise
+        print(f"Error searching OpenAlex, answering from the local store: {e}")
+        return local
+
 
 @app.get("/")
 async def root():
     return {"message": OPEN_ALEX_MAIL}
 
+
 @app.get("/works")
 async def works():
-    params = {
-        "mailto": OPEN_ALEX_MAIL
-    }
-
-    async with httpx.AsyncClient() as client:
-        try:
-            if OPEN_ALEX_MAIL:
-                response = await client.get(OPEN_ALEX_BASE_URL, params = params)
-            else:
-                response = await client.get(OPEN_ALEX_BASE_URL)
-            response.raise_for_status()
-        except httpx.HTTPError as exc:
-            return {"error": str(exc)}
-
-    data = response.json()
+    try:
+        data = await openalex.get({})
+    except httpx.HTTPError as exc:
+        return {"error": str(exc)}
 
     return data
 
+
 @app.get("/search")
 async def search_openalex(q: str):
-    params = {
-        "search": q
-    }
-
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(OPEN_ALEX_BASE_URL, params = params)
-            response.raise_for_status()
-        except httpx.HTTPError as exc:
-            return {"error": str(exc)}
-
-    data = response.json()
-    return {"query":q,"results":data}
+    params = {"search": q}
+
+    try:
+        data = await search_works(params)
+    except httpx.HTTPError as exc:
+        return {"error": str(exc)}
+
+    return {"query": q, "results": data}
+
+
+@app.get("/search/multi")
+async def search_openalex_multi(
+    q: list[str] = Query(...), per_page: int = 25, limit: int | None = None
+):
+    """Runs several searches at once (e.g. synonyms or sub-questions of a research question) and returns their results
+    as one ranked list, merged by reciprocal-rank fusion and without duplicates (see fusion.py).
+    Queries that fail are listed in "errors", the results of the others are still returned.
+    """
+    # The same query twice would only count its works twice. Like the cache, this ignores case and extra whitespace.
+    queries = []
+    seen = set()
+    for query in q:
+        query = " ".join(query.split())
+        if query and query.lower() not in seen:
+            seen.add(query.lower())
+            queries.append(query)
+    if len(queries) > MAX_QUERIES:
+        return {"error": f"At most {MAX_QUERIES} queries are allowed per call."}
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+
+    # All searches run concurrently over the shared client; the cache and the rate limiter still apply to each of them.
+    responses = await asyncio.gather(
+        *(search_works({"search": query, "per_page": per_page}) for query in queries),
+        return_exceptions=True,
+    )
+
+    ranked_lists = {}
+    errors = {}
+    for query, response in zip(queries, responses):
+        if isinstance(response, httpx.HTTPError):
+            errors[query] = str(response)
+        elif isinstance(response, BaseException):
+            raise response
+        else:
+            ranked_lists[query] = response.get("results", [])
+
+    results = reciprocal_rank_fusion(ranked_lists)
+    if limit is not None:
+        results = results[:limit]
+    return {"queries": queries, "results": results, "errors": errors}
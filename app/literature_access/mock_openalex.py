@@ -0,0 +1,93 @@
+"""A local stand-in for the OpenAlex /works endpoint, for load tests.
+
+The behaviour can be configured with environment variables:
+- MOCK_LATENCY_MS: the latency of every response (default 50)
+- MOCK_JITTER_MS: random extra latency, up to this value (default 0)
+- MOCK_ERROR_RATE: the share of requests that fail with a 503 (default 0)
+- MOCK_TOTAL_RESULTS: how many works a search finds in total, for the pagination (default 500)
+
+Responses carry an ETag, and a request with a matching If-None-Match is answered with 304 Not Modified (like OpenAlex).
+/_stats returns how often each endpoint was called, /_reset resets the counters.
+"""
+
+import asyncio
+import hashlib
+import os
+import random
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+app = FastAPI()
+
+LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "50"))
+JITTER_MS = float(os.getenv("MOCK_JITTER_MS", "0"))
+ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+TOTAL_RESULTS = int(os.getenv("MOCK_TOTAL_RESULTS", "500"))
+
+calls: Counter = Counter()
+
+
+def fake_work(query: str, index: int) -> dict:
+    """Builds a deterministic work in the OpenAlex format, so responses for the same query are always the same."""
+    work_id = hashlib.sha1(f"{query}:{index}".encode()).hexdigest()[:10]
+    words = f"A study of {query or 'everything'} number {index} and its effects".split()
+    return {
+        "id": f"https://openalex.org/W{work_id}",
+        "doi": f"https://doi.org/10.0000/{work_id}",
+        "title": " ".join(words),
+        "display_name": " ".join(words),
+        "publication_year": 2000 + index % 25,
+        "authorships": [{"author": {"display_name": f"Author {index}"}}],
+        "abstract_inverted_index": {word: [i] for i, word in enumerate(words)},
+        "cited_by_count": index,
+    }
+
+
+@app.get("/works")
+async def works(request: Request):
+    calls["/works"] += 1
+    params = request.query_params
+    if params.get("search"):
+        calls["/works?search"] += 1
+
+    await asyncio.sleep((LATENCY_MS + random.uniform(0, JITTER_MS)) / 1000)
+    if random.random() < ERROR_RATE:
+        calls["errors"] += 1
+        return JSONResponse({"error": "Injected error"}, status_code=503)
+
+    # Like OpenAlex, the search ignores case and extra whitespace.
+    query = " ".join(params.get("search", "").lower().split())
+    per_page = min(int(params.get("per_page", "25")), 200)
+    page = int(params.get("page", "1"))
+    # The results only depend on these, so they make a stable ETag.
+    etag = '"' + hashlib.sha1(f"{query}:{page}:{per_page}".encode()).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        calls["not modified"] += 1
+        return Response(status_code=304, headers={"ETag": etag})
+
+    start = (page - 1) * per_page
+    results = [
+        fake_work(query, i) for i in range(start, min(start + per_page, TOTAL_RESULTS))
+    ]
+    body = {
+        "meta": {
+            "count": TOTAL_RESULTS,
+            "page": page,
+            "per_page": per_page,
+        },
+        "results": results,
+    }
+    return JSONResponse(body, headers={"ETag": etag})
+
+
+@app.get("/_stats")
+async def stats():
+    return dict(calls)
+
+
+@app.post("/_reset")
+async def reset():
+    calls.clear()
+    return {"message": "reset"}
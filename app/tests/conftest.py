@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+# The tests import the app packages (MCP, literature_access) like the app does, from the app folder.
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+
+class FakeOllama:
+    """A tiny Ollama server on localhost for the tests. /api/chat answers with `answer` after `latency` seconds,
+    streamed or not like the request asks, and counts the requests that are running at the same time.
+    A streamed answer can be followed by `trailing_chunks` whitespace chunks, one every `chunk_delay` seconds,
+    like a constrained model that doesn't stop after its answer. The stream stops if the client closes it.
+    """
+
+    def __init__(self):
+        self.latency = 0.0
+        self.answer: dict = {"value": 0.5}
+        self.content: str | None = (
+            None  # If set, sent as the answer text instead of `answer` as JSON.
+        )
+        self.logprobs: list[dict] | None = None
+        self.requests: list[dict] = []
+        self.running = 0
+        self.peak_running = 0
+        self.trailing_chunks = 0
+        self.chunk_delay = 0.0
+        self.chunks_sent = 0
+        self.closed_early = False
+        self.base_url = ""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        request = json.loads(body or b"{}")
+        self.requests.append(request)
+        self.running += 1
+        self.peak_running = max(self.peak_running, self.running)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.running -= 1
+
+        content = self.content if self.content is not None else json.dumps(self.answer)
+        if request.get("stream", True):
+            chunks = [
+                {"message": {"role": "assistant", "content": content}, "done": False}
+            ]
+            chunks += [
+                {"message": {"role": "assistant", "content": " "}, "done": False}
+            ] * self.trailing_chunks
+            chunks.append(
+                {
+                    "message": {"role": "assistant", "content": ""},
+                    "done": True,
+                    "eval_count": 1 + self.trailing_chunks,
+                }
+            )
+            await self._stream(chunks, receive, send)
+            return
+
+        response = {"message": {"role": "assistant", "content": content}, "done": True}
+        if self.logprobs is not None:
+            response["logprobs"] = self.logprobs
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send(
+            {"type": "http.response.body", "body": json.dumps(response).encode()}
+        )
+
+    async def _stream(self, chunks: list[dict], receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/x-ndjson")],
+            }
+        )
+        for chunk in chunks:
+            body = (json.dumps(chunk) + "\n").encode()
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+            self.chunks_sent += 1
+            if self.chunk_delay:
+                try:
+                    message = await asyncio.wait_for(receive(), self.chunk_delay)
+                except asyncio.TimeoutError:
+                    continue
+                if message["type"] == "http.disconnect":
+                    self.closed_early = True
+                    return
+        await send({"type": "http.response.body", "body": b""})
+
+
+@pytest.fixture
+def fake_ollama():
+    """Runs a FakeOllama in a background thread for the duration of a test."""
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    fake = FakeOllama()
+    fake.base_url = f"http://127.0.0.1:{port}"
+    server = uvicorn.Server(
+        uvicorn.Config(fake, host="127.0.0.1", port=port, log_level="error")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not server.started and time.monotonic() < deadline:
+        time.sleep(0.01)
+    yield fake
+    server.should_exit = True
+    thread.join(timeout=5)
@@ -0,0 +1,53 @@
+from MCP.article_store import ArticleStore, PaperTable
+from MCP.types import Article, RequestStatus
+
+
+def _articles(n: int) -> list[Article]:
+    return [
+        Article(
+            title=f"Paper {i}", author="A", abstract="Long abstract. " * 50, url=f"u{i}"
+        )
+        for i in range(n)
+    ]
+
+
+def test_paper_table_keeps_only_ids_and_scores(tmp_path):
+    table = PaperTable(ArticleStore(str(tmp_path / "store.sqlite")))
+    table.append_many(['{"a": 1}', '{"a": 2}'], [None, 0.5])
+    assert len(table) == 2
+    assert table.get_body(1) == '{"a": 2}'
+    assert list(table.iter_scores()) == [None, 0.5]
+    table.set_score(0, 0.25)
+    assert table.get_score(0) == 0.25
+    table.store.close()
+
+
+def test_large_run_status_survives_a_json_round_trip(tmp_path):
+    store = str(tmp_path / "store.sqlite")
+    status = RequestStatus("Why do cats purr?", article_store=store)
+    status.add_papers(_articles(3))
+    status.set_paper_relevance(1, 0.75)
+    assert status.papers == []  # The papers are only in the store.
+
+    loaded = RequestStatus.from_json(status.model_dump_json(by_alias=True))
+    status.close()
+
+    assert loaded.num_papers() == 3
+    assert loaded.get_paper(2).title == "Paper 2"
+    assert loaded.paper_relevances() == [None, 0.75, None]
+    loaded.set_paper_relevance(0, 0.1)
+    assert loaded.get_paper_relevance(0) == 0.1
+    loaded.close()
+
+
+def test_in_memory_status_survives_a_json_round_trip():
+    status = RequestStatus("Why do cats purr?")
+    status.add_papers(_articles(2), [0.5, None])
+    dumped = status.model_dump_json(by_alias=True)
+    assert "__paper_table__" not in dumped
+
+    loaded = RequestStatus.from_json(dumped)
+    assert loaded.num_papers() == 2
+    assert loaded.paper_relevances() == [0.5, None]
+    assert loaded.settings.research_question == "Why do cats purr?"
+    loaded.close()  # Nothing to close, but it must not fail.
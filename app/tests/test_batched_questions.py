@@ -0,0 +1,191 @@
+import asyncio
+import time
+
+import MCP.agents.create_questions_from_article as create_questions
+import MCP.speculation as speculation
+from MCP.memo import StageMemo, set_memo
+from MCP.types import Article, ArticleQuestions, RequestStatus
+
+
+def _status(n: int, wanted: int) -> RequestStatus:
+    status = RequestStatus("How do people sleep?", paper_limit=n)
+    status.settings.question_per_article = wanted
+    status.settings.articles_per_batch = n
+    status.settings.max_attempts = 2
+    status.add_papers(
+        [
+            Article(title=f"Paper {i}", author="A", abstract="...", url=f"u{i}")
+            for i in range(n)
+        ],
+        [0.9] * n,
+    )
+    return status
+
+
+def test_only_the_articles_missing_from_the_answer_are_asked_again(monkeypatch):
+    calls = []
+    answers = [
+        [
+            ArticleQuestions(article_id=1, questions=["Q a", "Q b"]),
+            # Repeats a question of article 1 (up to case and punctuation), so only one counts.
+            ArticleQuestions(article_id=2, questions=["q A?", "Q c"]),
+            ArticleQuestions(
+                article_id=1, questions=["Q z", "Q y"]
+            ),  # Duplicate entry.
+            ArticleQuestions(article_id=7, questions=["Q out of range"]),
+            ArticleQuestions(article_id=0, questions=["Q zero"]),
+            # Articles 3 and 4 are missing.
+        ],
+        [
+            ArticleQuestions(article_id=1, questions=["Q d"]),
+            ArticleQuestions(article_id=2, questions=["Q e", "Q f"]),
+            ArticleQuestions(article_id=3, questions=["Q g", "Q h"]),
+        ],
+    ]
+
+    async def scripted_agent(articles, research_question, custom_llm=None):
+        calls.append(
+            [
+                (article.title, number, list(existing))
+                for article, number, _, existing in articles
+            ]
+        )
+        return answers[len(calls) - 1]
+
+    monkeypatch.setattr(
+        create_questions, "run_create_questions_from_articles_agent", scripted_agent
+    )
+    status = _status(4, 2)
+    status, step_info = asyncio.run(
+        create_questions.run_all_create_questions_from_article_agent(status)
+    )
+
+    assert calls[1] == [
+        ("Paper 1", 1, ["Q c"]),
+        ("Paper 2", 2, []),
+        ("Paper 3", 2, []),
+    ]
+    assert len(calls) == 2
+    assert [question.question for question, _ in status.questions] == [
+        "Q a",
+        "Q b",
+        "Q c",
+        "Q d",
+        "Q e",
+        "Q f",
+        "Q g",
+        "Q h",
+    ]
+    assert not step_info.errors and not step_info.warnings
+
+
+def test_a_stuck_batch_is_backed_up_by_another_call(monkeypatch):
+    """Without the backup, the stage would wait for the stuck call."""
+    tracker = speculation.LatencyTracker()
+    for _ in range(speculation.min_latency_samples):
+        tracker.record("create_questions_from_articles_agent", 0.01)
+    monkeypatch.setattr(speculation, "latency_tracker", tracker)
+    monkeypatch.setattr(
+        speculation, "budget", speculation.SpeculationBudget(share=1.0, burst=10.0)
+    )
+
+    async def stuck_agent(articles, research_question, custom_llm=None):
+        if speculation.current_attempt.get() == 1:
+            await asyncio.sleep(10)
+        return [
+            ArticleQuestions(article_id=i, questions=[f"Q {i}"])
+            for i in range(1, len(articles) + 1)
+        ]
+
+    monkeypatch.setattr(
+        create_questions, "run_create_questions_from_articles_agent", stuck_agent
+    )
+    status = _status(2, 1)
+    start = time.monotonic()
+    status, _ = asyncio.run(
+        create_questions.run_all_create_questions_from_article_agent(status)
+    )
+    assert time.monotonic() - start < 2
+    assert [question.question for question, _ in status.questions] == ["Q 1", "Q 2"]
+
+
+def test_batched_questions_are_memoized_apart_from_single_ones(monkeypatch):
+    async def batched_agent(articles, research_question, custom_llm=None):
+        return [
+            ArticleQuestions(article_id=i, questions=[f"Batched {i}"])
+            for i in range(1, len(articles) + 1)
+        ]
+
+    async def single_agent(article, research_question, number, *args, **kwargs):
+        return [f"Single {article.title}"]
+
+    monkeypatch.setattr(
+        create_questions, "run_create_questions_from_articles_agent", batched_agent
+    )
+    monkeypatch.setattr(
+        create_questions, "run_create_questions_from_article_agent", single_agent
+    )
+    memo = StageMemo(":memory:")
+    set_memo(memo)
+    try:
+        status = _status(2, 1)
+        status.settings.memoize_stages = True
+        asyncio.run(
+            create_questions.run_all_create_questions_from_article_agent(status)
+        )
+
+        status = _status(2, 1)
+        status.settings.memoize_stages = True
+        status.settings.articles_per_batch = 1
+        status, _ = asyncio.run(
+            create_questions.run_all_create_questions_from_article_agent(status)
+        )
+    finally:
+        set_memo(None)
+    # The per-article run did not reuse the batched questions.
+    assert sorted(question.question for question, _ in status.questions) == [
+        "Single Paper 0",
+        "Single Paper 1",
+    ]
+    assert memo.hits == 0
+
+
+def test_a_failing_batch_makes_at_most_max_attempts_calls(monkeypatch):
+    calls = []
+
+    async def failing_agent(articles, research_question, custom_llm=None):
+        calls.append(len(articles))
+        return None
+
+    monkeypatch.setattr(
+        create_questions, "run_create_questions_from_articles_agent", failing_agent
+    )
+    status = _status(2, 1)
+    status.settings.max_attempts = 3
+    results = asyncio.run(
+        create_questions._create_questions_in_batches(status, lambda i, q: None)
+    )
+    assert results == [None, None]
+    assert calls == [2, 2, 2]
+
+
+def test_the_custom_llm_is_used_for_the_calls(monkeypatch):
+    models = []
+
+    async def batched_agent(articles, research_question, custom_llm=None):
+        models.append(custom_llm)
+        return [
+            ArticleQuestions(article_id=i, questions=[f"Q {i}"])
+            for i in range(1, len(articles) + 1)
+        ]
+
+    monkeypatch.setattr(
+        create_questions, "run_create_questions_from_articles_agent", batched_agent
+    )
+    results = asyncio.run(
+        create_questions._create_questions_in_batches(
+            _status(2, 1), lambda i, q: None, custom_llm="llama3.2"
+        )
+    )
+    assert results == [["Q 1"], ["Q 2"]]
+    assert models == ["llama3.2"]
@@ -0,0 +1,52 @@
+import asyncio
+
+import MCP.ollama as ollama
+from MCP.cassette import Cassette, use_cassette
+from MCP.types import SurveyQuestion
+
+
+def test_recordings_are_replayed_in_order(tmp_path):
+    path = str(tmp_path / "cassette.jsonl")
+    recorder = Cassette(path, "record")
+    recorder.record("agent", None, "prompt", float, 0.1, 0.0)
+    recorder.record("agent", None, "prompt", float, 0.2, 0.0)
+    recorder.record("agent", None, "other prompt", float, None, 0.0)
+
+    player = Cassette(path, "replay", recorded_latency=False)
+
+    async def replay(prompt):
+        return await player.replay("agent", None, prompt, float)
+
+    assert asyncio.run(replay("prompt")) == 0.1
+    assert asyncio.run(replay("prompt")) == 0.2
+    assert asyncio.run(replay("prompt")) == 0.2  # The last recording is repeated.
+    assert asyncio.run(replay("other prompt")) is None
+    assert asyncio.run(replay("never recorded")) is None
+
+
+def test_a_recording_that_does_not_validate_is_a_failed_call(tmp_path):
+    path = str(tmp_path / "cassette.jsonl")
+    Cassette(path, "record").record("agent", None, "prompt", str, "not a question", 0.0)
+    player = Cassette(path, "replay", recorded_latency=False)
+    assert asyncio.run(player.replay("agent", None, "prompt", SurveyQuestion)) is None
+
+
+def test_embeddings_are_recorded_and_replayed_without_a_model(tmp_path, monkeypatch):
+    path = str(tmp_path / "cassette.jsonl")
+    live_calls = []
+
+    async def embed_live(texts, model):
+        live_calls.append(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    monkeypatch.setattr(ollama, "_embed_live", embed_live)
+    try:
+        use_cassette(path, "record")
+        recorded = asyncio.run(ollama.embed(["a", "bb"]))
+
+        use_cassette(path, "replay", recorded_latency=False)
+        assert asyncio.run(ollama.embed(["a", "bb"])) == recorded
+        assert asyncio.run(ollama.embed(["unknown"])) is None
+    finally:
+        use_cassette(None)
+    assert live_calls == [["a", "bb"]]  # The replay didn't touch the model.
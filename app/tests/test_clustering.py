@@ -0,0 +1,88 @@
+import asyncio
+
+import numpy as np
+
+import MCP.clustering as clustering
+from MCP.agents.cluster_literature import run_all_cluster_literature
+from MCP.clustering import (
+    cluster_vectors,
+    kmeans,
+    papers_to_score,
+    propagate_cluster_scores,
+)
+from MCP.types import Article, RequestStatus
+
+
+def _blobs(sizes: list[int], seed: int = 1) -> np.ndarray:
+    """Normalized vectors in tight groups around orthogonal directions, one group per size."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for group, size in enumerate(sizes):
+        centre = np.zeros(len(sizes), dtype=np.float32)
+        centre[group] = 1.0
+        rows.append(centre + rng.normal(0, 0.01, (size, len(sizes))))
+    vectors = np.vstack(rows).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_kmeans_finds_the_groups_and_is_deterministic():
+    vectors = _blobs([10, 10, 10])
+    labels, _ = kmeans(vectors, 3)
+    assert [len(set(labels[start : start + 10])) for start in (0, 10, 20)] == [1, 1, 1]
+    assert len(set(labels)) == 3
+    assert np.array_equal(labels, kmeans(vectors, 3)[0])
+
+
+def test_clusters_start_with_the_papers_closest_to_the_centre(monkeypatch):
+    monkeypatch.setattr(clustering, "papers_per_cluster", 4)
+    vectors = _blobs([4, 4])
+    vectors[0] = vectors[1] + np.array(
+        [0.3, 0.1], dtype=np.float32
+    )  # Far from its centre.
+    clusters = cluster_vectors(vectors)
+    assert sorted(sorted(cluster) for cluster in clusters) == [
+        [0, 1, 2, 3],
+        [4, 5, 6, 7],
+    ]
+    first = next(cluster for cluster in clusters if 0 in cluster)
+    assert first[-1] == 0
+
+
+def _clustered_status() -> RequestStatus:
+    status = RequestStatus("How do people sleep?")
+    status.settings.cluster_papers = True
+    status.settings.representatives_per_cluster = 2
+    status.add_papers(
+        [
+            Article(title=f"Paper {i}", author="A", abstract="...", url=f"u{i}")
+            for i in range(6)
+        ]
+    )
+    status.paper_clusters = [[0, 1, 2], [3, 4, 5]]
+    return status
+
+
+def test_only_representatives_are_scored_and_agreeing_scores_are_shared():
+    status = _clustered_status()
+    assert papers_to_score(status) == [0, 1, 3, 4]
+
+    for i, score in {0: 0.8, 1: 0.7, 3: 0.1, 4: 0.9}.items():
+        status.set_paper_relevance(i, score)
+    assert propagate_cluster_scores(status) == 1
+    assert status.get_paper_relevance(2) == 0.75
+    # The representatives of the second cluster disagree, so its last paper is scored on its own.
+    assert status.get_paper_relevance(5) is None
+    assert papers_to_score(status) == [5]
+
+
+def test_a_failed_embedding_turns_clustering_off(monkeypatch):
+    async def no_embeddings(texts):
+        return None
+
+    monkeypatch.setattr(clustering, "embed", no_embeddings)
+    status = _clustered_status()
+    status.paper_clusters = []
+    status, step_info = asyncio.run(run_all_cluster_literature(status))
+    assert step_info.errors
+    assert status.paper_clusters == [[i] for i in range(6)]
+    assert papers_to_score(status) == list(range(6))
@@ -0,0 +1,87 @@
+import hashlib
+
+import MCP.dedup as dedup
+from MCP.dedup import (
+    deduplicate_articles,
+    find_duplicates,
+    normalize_doi,
+    normalize_url,
+)
+from MCP.types import Article
+
+
+def _article(title: str, url: str = "", author: str = "Jane Doe", abstract: str = ""):
+    return Article(title=title, author=author, abstract=abstract, url=url)
+
+
+def test_links_to_the_same_work_are_normalized():
+    assert normalize_doi("https://dx.doi.org/10.1000/ABC.") == "10.1000/abc"
+    assert normalize_doi("https://doi.org/10.1000/abc?utm_source=x#top") == (
+        "10.1000/abc"
+    )
+    assert normalize_url("https://doi.org/10.1000/abc") == normalize_url(
+        "http://dx.doi.org/10.1000/ABC"
+    )
+    assert normalize_url("https://arxiv.org/abs/2101.00001v2") == normalize_url(
+        "http://arxiv.org/pdf/2101.00001"
+    )
+    assert normalize_url("https://www.example.org/paper/?utm_source=x&id=1#top") == (
+        normalize_url("http://example.org/paper?id=1")
+    )
+
+
+def test_versions_of_a_work_are_merged():
+    articles = [
+        _article(
+            "Sleep and social media use in adolescents",
+            "https://arxiv.org/abs/2101.00001v1",
+        ),
+        _article("Something else entirely, about cats", "https://example.org/cats"),
+        _article(
+            "Sleep and social-media use in adolescent",
+            "https://doi.org/10.1000/sleep",
+            abstract="The longer abstract.",
+        ),
+        _article("Unrelated", "https://arxiv.org/abs/2101.00001v2"),
+    ]
+    assert find_duplicates(articles) == [[0, 2, 3], [1]]
+
+    unique = deduplicate_articles(articles)
+    assert [article.url for article in unique] == [
+        "https://doi.org/10.1000/sleep",
+        "https://example.org/cats",
+    ]
+    assert unique[0].abstract == "The longer abstract."
+
+
+def test_similar_titles_by_different_authors_are_kept_apart():
+    articles = [
+        _article("A survey of deep learning for medical imaging", author="Jane Doe"),
+        _article(
+            "A survey of deep learning for medical imaging", author="Max Mustermann"
+        ),
+    ]
+    assert find_duplicates(articles) == [[0], [1]]
+
+
+def test_a_common_title_start_does_not_compare_every_pair(monkeypatch):
+    comparisons = []
+    same_title = dedup._same_title
+
+    def counting_same_title(a, b):
+        comparisons.append((a, b))
+        return same_title(a, b)
+
+    monkeypatch.setattr(dedup, "_same_title", counting_same_title)
+    n = 400
+    articles = [
+        # Different works whose titles only share the start, and no authors to tell them apart.
+        _article(
+            f"A survey of deep learning for {hashlib.sha256(str(i).encode()).hexdigest()}",
+            author="",
+        )
+        for i in range(n)
+    ]
+    assert len(find_duplicates(articles)) == n
+    assert len(comparisons) <= 2 * n * dedup.max_bucket_size
+    assert len(comparisons) < n * (n - 1) / 4
@@ -0,0 +1,119 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+
+import MCP.agents.retrieve_full_text as retrieve_full_text
+import MCP.fulltext as fulltext
+from MCP.fulltext import (
+    ChunkIndex,
+    _cache_text,
+    _cached_text,
+    _download,
+    extract_text,
+    fetch_full_texts,
+    split_into_chunks,
+)
+from MCP.types import Article, RequestStatus
+
+
+def test_html_text_skips_scripts_and_styles():
+    html = b"<html><style>p {}</style><p>Cats   purr.</p><script>alert(1)</script><p>Dogs bark.</p></html>"
+    assert extract_text(html, "text/html") == "Cats purr. Dogs bark."
+
+
+def test_chunks_overlap_and_cover_the_text(monkeypatch):
+    monkeypatch.setattr(fulltext, "chunk_words", 4)
+    monkeypatch.setattr(fulltext, "chunk_overlap", 1)
+    chunks = split_into_chunks(" ".join(str(i) for i in range(10)))
+    assert chunks == ["0 1 2 3", "3 4 5 6", "6 7 8 9"]
+    assert split_into_chunks("") == [""]
+
+
+def test_cached_texts_are_served_and_a_missing_file_is_a_miss(tmp_path, monkeypatch):
+    monkeypatch.setattr(fulltext, "FULLTEXT_CACHE_DIR", str(tmp_path))
+    assert _cached_text("https://example.org/a") is None
+
+    _cache_text("https://example.org/a", "The full text.")
+    _cache_text("https://example.org/a?utm=1", "The full text.")
+    assert _cached_text("https://example.org/a") == "The full text."
+    text_files = [name for name in os.listdir(tmp_path) if name.endswith(".txt")]
+    assert len(text_files) == 1  # Both URLs share the stored copy.
+
+    os.remove(os.path.join(tmp_path, text_files[0]))
+    assert _cached_text("https://example.org/a") is None
+
+
+def test_cached_urls_are_not_downloaded_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(fulltext, "FULLTEXT_CACHE_DIR", str(tmp_path))
+    _cache_text("https://example.org/a", "The full text.")
+
+    async def no_download(*args, **kwargs):
+        raise AssertionError("a cached URL was downloaded")
+
+    monkeypatch.setattr(fulltext.httpx.AsyncClient, "stream", no_download)
+    texts = asyncio.run(fetch_full_texts(["https://example.org/a"] * 2))
+    assert texts == {"https://example.org/a": "The full text."}
+
+
+def test_the_index_returns_the_closest_chunks_per_paper(monkeypatch):
+    monkeypatch.setattr(fulltext, "chunk_words", 1)
+    monkeypatch.setattr(fulltext, "chunk_overlap", 0)
+    directions = {"cats": [1.0, 0.0], "dogs": [0.0, 1.0], "birds": [0.7, 0.7]}
+
+    async def embed(texts):
+        return [directions[text] for text in texts]
+
+    monkeypatch.setattr(fulltext, "embed", embed)
+
+    async def run():
+        index = ChunkIndex()
+        assert await index.build({0: "dogs cats", 1: "birds dogs"})
+        return await index.top_chunks("cats", 1)
+
+    assert asyncio.run(run()) == {0: ["cats"], 1: ["birds"]}
+
+
+def test_downloads_over_the_size_limit_are_rejected(monkeypatch):
+    monkeypatch.setattr(fulltext, "max_download_bytes", 1000)
+
+    def handler(request):
+        size = int(request.url.params["size"])
+        # A stream, so the server doesn't announce the length up front.
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/html"},
+            stream=httpx.ByteStream(b"x" * size),
+        )
+
+    async def download(size):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await _download(client, f"https://example.org/doc?size={size}")
+
+    assert asyncio.run(download(1000)) == (b"x" * 1000, "text/html")
+    with pytest.raises(ValueError, match="too large"):
+        asyncio.run(download(1001))
+
+
+def test_papers_are_tried_again_if_their_text_could_not_be_embedded(monkeypatch):
+    status = RequestStatus("Why do cats purr?")
+    status.papers = [
+        (Article(title=title, author=None, abstract=None, url=url), 0.5)
+        for title, url in [("With text", "https://example.org/a"), ("No URL", None)]
+    ]
+
+    async def fetch_full_texts(urls):
+        return {url: "Cats purr when they are happy." for url in urls}
+
+    async def embedding_down(texts):
+        return None
+
+    monkeypatch.setattr(retrieve_full_text, "fetch_full_texts", fetch_full_texts)
+    monkeypatch.setattr(fulltext, "embed", embedding_down)
+    status, step_info = asyncio.run(
+        retrieve_full_text.run_all_retrieve_full_text(status)
+    )
+    # The paper without a URL has no text for good, the other one is retried.
+    assert status.paper_contexts == {1: []}
+    assert step_info.errors
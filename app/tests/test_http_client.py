@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+import MCP.agents.base as agent_base
+from MCP.agents.check_literature_relevance import (
+    run_all_check_literature_relevance_agent,
+)
+from MCP.limiter import AdaptiveLimiter
+from MCP.ollama import OllamaBackendPool, close_llm_http_clients
+from MCP.types import Article, RequestStatus
+
+
+def test_concurrent_scoring_calls_overlap(fake_ollama, monkeypatch):
+    """N scoring calls against a model that takes `latency` per call finish in about one latency, not N of them."""
+    n = 8
+    latency = 0.5
+    fake_ollama.latency = latency
+    fake_ollama.answer = {"value": 0.7}
+    monkeypatch.setattr(
+        agent_base, "backend_pool", OllamaBackendPool([fake_ollama.base_url])
+    )
+    # The limiter would start with 2 calls at once, the test is about the HTTP client.
+    monkeypatch.setattr(agent_base, "llm_limiter", AdaptiveLimiter(initial_limit=n))
+    monkeypatch.setattr(agent_base, "record_token_usage", lambda *args: None)
+    monkeypatch.setattr(agent_base, "get_cassette", lambda: None)
+
+    status = RequestStatus("Does coffee help with studying?")
+    status.settings.memoize_stages = False
+    status.add_papers(
+        [
+            Article(
+                title=f"Paper {i}", author="A", abstract="About coffee.", url=f"u{i}"
+            )
+            for i in range(n)
+        ]
+    )
+
+    async def main():
+        try:
+            start = time.monotonic()
+            result = await run_all_check_literature_relevance_agent(status)
+            return result, time.monotonic() - start
+        finally:
+            await close_llm_http_clients()
+
+    (status, step_info), elapsed = asyncio.run(main())
+
+    assert status.paper_relevances() == [0.7] * n
+    assert len(fake_ollama.requests) == n
+    assert fake_ollama.peak_running == n
+    assert elapsed < 2 * latency, f"{n} calls took {elapsed:.2f} s"
@@ -0,0 +1,113 @@
+import gzip
+import json
+
+import httpx
+from fastapi.testclient import TestClient
+
+import literature_access.main as service
+from literature_access.ingest import WorkStore, ingest, rebuild_abstract
+
+
+def _work(i: int, title: str, abstract: str, updated: str = "2024-01-01") -> dict:
+    words = abstract.split()
+    return {
+        "id": f"https://openalex.org/W{i}",
+        "doi": f"https://doi.org/10.1000/{i}",
+        "display_name": title,
+        "authorships": [{"author": {"display_name": "Jane Doe"}}],
+        "abstract_inverted_index": {
+            word: [position for position, other in enumerate(words) if other == word]
+            for word in set(words)
+        },
+        "publication_year": 2020,
+        "concepts": [{"display_name": "Sleep", "score": 0.9}],
+        "updated_date": updated,
+    }
+
+
+def _snapshot(tmp_path, works: list[dict], name: str = "part_000.gz"):
+    folder = tmp_path / "works"
+    folder.mkdir(exist_ok=True)
+    with gzip.open(folder / name, "wt") as file:
+        for work in works:
+            file.write(json.dumps(work) + "\n")
+        file.write("not json\n")
+    return str(folder)
+
+
+def test_abstracts_are_rebuilt_from_the_inverted_index():
+    assert rebuild_abstract({"sleep": [0, 2], "well": [1]}) == "sleep well sleep"
+    assert rebuild_abstract(None) is None
+
+
+def test_ingested_works_can_be_searched(tmp_path):
+    folder = _snapshot(
+        tmp_path,
+        [
+            _work(1, "Sleep quality of students", "Students sleep less before exams"),
+            _work(2, "Coffee and productivity", "Coffee helps some people work"),
+            _work(3, "Sleep and coffee", "Coffee late in the day disturbs sleep"),
+        ],
+    )
+    store_path = str(tmp_path / "works.sqlite")
+    ingest([folder], store_path, workers=1)
+
+    store = WorkStore(store_path)
+    assert store.count() == 3
+    assert store.checkpoint(folder + "/part_000.gz") == (4, True)
+
+    results = store.search("sleep coffee", limit=10)
+    assert results[0]["display_name"] == "Sleep and coffee"  # Matches both words.
+    assert {work["id"] for work in results} == {
+        "https://openalex.org/W1",
+        "https://openalex.org/W2",
+        "https://openalex.org/W3",
+    }
+    assert results[0]["authorships"] == [{"author": {"display_name": "Jane Doe"}}]
+    assert results[0]["abstract"] == "Coffee late in the day disturbs sleep"
+    assert store.search('"unbalanced (quotes* NEAR') == []  # No FTS5 syntax errors.
+    store.close()
+
+
+def test_search_answers_from_the_local_store_first(tmp_path, monkeypatch):
+    folder = _snapshot(
+        tmp_path,
+        [
+            _work(1, "Sleep quality", "Students sleep less"),
+            _work(2, "Sleep and coffee", "Coffee disturbs sleep"),
+        ],
+    )
+    store_path = str(tmp_path / "works.sqlite")
+    ingest([folder], store_path, workers=1)
+    monkeypatch.setattr(service, "local_store", WorkStore(store_path))
+
+    asked_openalex = []
+    openalex_down = False
+
+    async def openalex_get(params):
+        asked_openalex.append(params)
+        if openalex_down:
+            raise httpx.ConnectError("down")
+        return {"meta": {"count": 0}, "results": []}
+
+    monkeypatch.setattr(service.openalex, "get", openalex_get)
+    client = TestClient(service.app)
+
+    # A full page from the store is enough.
+    local = client.get("/search/multi", params={"q": "sleep", "per_page": 2}).json()
+    assert {work["display_name"] for work in local["results"]} == {
+        "Sleep quality",
+        "Sleep and coffee",
+    }
+    assert asked_openalex == []
+
+    # Two matches can't fill the default page of 25, so OpenAlex is asked as well.
+    client.get("/search", params={"q": "sleep"})
+    assert asked_openalex == [{"search": "sleep"}]
+
+    # If OpenAlex is down, the few local matches are better than nothing.
+    openalex_down = True
+    fallback = client.get("/search", params={"q": "sleep"}).json()
+    assert fallback["results"]["meta"]["source"] == "local store"
+    assert "error" in client.get("/search", params={"q": "volcanoes"}).json()
+    service.local_store.close()
@@ -0,0 +1,109 @@
+import asyncio
+
+import httpx
+
+from MCP.limiter import AdaptiveLimiter, is_congestion_error, run_concurrently
+
+
+def test_failures_halve_the_limit():
+    async def main():
+        limiter = AdaptiveLimiter(initial_limit=8, window=8)
+        for _ in range(8):
+            async with limiter.slot() as mark_failed:
+                mark_failed()
+        return limiter
+
+    limiter = asyncio.run(main())
+    assert limiter.limit == 4
+    assert limiter.metrics()["error_rate"] == 1.0
+
+
+def test_cancelled_calls_do_not_lower_the_limit():
+    async def main():
+        limiter = AdaptiveLimiter(initial_limit=8, window=8)
+        started = asyncio.Event()
+
+        async def call():
+            async with limiter.slot():
+                started.set()
+                await asyncio.sleep(10)
+
+        for _ in range(8):
+            started.clear()
+            task = asyncio.create_task(call())
+            await started.wait()
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        return limiter
+
+    limiter = asyncio.run(main())
+    assert limiter.limit == 8
+    assert limiter.in_flight == 0
+    assert limiter.total_calls == 0
+    assert limiter.metrics()["error_rate"] == 0.0
+
+
+def test_limit_bounds_concurrency():
+    async def main():
+        limiter = AdaptiveLimiter(initial_limit=3, window=1000)
+        running = 0
+        peak = 0
+
+        async def call():
+            nonlocal running, peak
+            async with limiter.slot():
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*(call() for _ in range(10)))
+        return peak
+
+    assert asyncio.run(main()) == 3
+
+
+def test_run_concurrently_keeps_order_and_returns_exceptions():
+    async def fn(i: int) -> int:
+        await asyncio.sleep(0.01 * (5 - i))
+        if i == 2:
+            raise ValueError("two")
+        return i * 10
+
+    results = asyncio.run(run_concurrently(range(5), fn))
+    assert results[:2] == [0, 10]
+    assert isinstance(results[2], ValueError)
+    assert results[3:] == [30, 40]
+
+
+def test_a_single_failure_does_not_halve_the_limit():
+    async def main():
+        limiter = AdaptiveLimiter(initial_limit=8, window=8, max_error_rate=0.25)
+        for i in range(8):
+            async with limiter.slot() as mark_failed:
+                if i == 0:
+                    mark_failed()
+        return limiter
+
+    assert asyncio.run(main()).limit >= 8
+
+
+def test_only_timeouts_and_connection_problems_are_congestion():
+    request = httpx.Request("POST", "http://ollama/api/chat")
+    overloaded = httpx.Response(503, request=request)
+    bad_request = httpx.Response(400, request=request)
+    assert is_congestion_error(httpx.ReadTimeout("slow", request=request))
+    assert is_congestion_error(httpx.ConnectError("refused", request=request))
+    assert is_congestion_error(asyncio.TimeoutError())
+    assert is_congestion_error(
+        httpx.HTTPStatusError("busy", request=request, response=overloaded)
+    )
+    assert not is_congestion_error(
+        httpx.HTTPStatusError("bad", request=request, response=bad_request)
+    )
+    assert not is_congestion_error(
+        ValueError("The answer ended before it was complete")
+    )
@@ -0,0 +1,65 @@
+import asyncio
+import math
+from collections import Counter
+
+import httpx
+from fastapi.testclient import TestClient
+
+import literature_access.mock_openalex as mock_openalex
+from literature_access.loadtest import percentile, run_load
+
+
+def test_percentiles_pick_the_nearest_rank():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 51.0  # Rounds to the nearest index.
+    assert percentile(values, 99) == 99.0
+    assert percentile(values, 100) == 100.0
+    assert percentile(values, 0) == 1.0
+    assert percentile([3.0, 1.0, 2.0], 50) == 2.0  # The values don't need to be sorted.
+    assert math.isnan(percentile([], 95))
+
+
+def test_the_mock_answers_repeated_searches_with_not_modified(monkeypatch):
+    monkeypatch.setattr(mock_openalex, "LATENCY_MS", 0.0)
+    monkeypatch.setattr(mock_openalex, "calls", Counter())
+    client = TestClient(mock_openalex.app)
+
+    first = client.get("/works", params={"search": "Sleep  Quality", "per_page": 5})
+    assert first.status_code == 200
+    assert len(first.json()["results"]) == 5
+    # The same query with other case and whitespace has the same results and ETag.
+    again = client.get(
+        "/works",
+        params={"search": "sleep quality", "per_page": 5},
+        headers={"If-None-Match": first.headers["ETag"]},
+    )
+    assert again.status_code == 304
+    other_page = client.get("/works", params={"search": "sleep quality", "page": 2})
+    assert other_page.headers["ETag"] != first.headers["ETag"]
+
+    assert client.get("/_stats").json() == {
+        "/works": 3,
+        "/works?search": 3,
+        "not modified": 1,
+    }
+    client.post("/_reset")
+    assert client.get("/_stats").json() == {}
+
+
+def test_the_load_generator_counts_the_injected_errors(monkeypatch):
+    monkeypatch.setattr(mock_openalex, "LATENCY_MS", 0.0)
+    monkeypatch.setattr(mock_openalex, "ERROR_RATE", 0.5)
+    monkeypatch.setattr(mock_openalex, "calls", Counter())
+    transport = httpx.ASGITransport(app=mock_openalex.app)
+
+    # With no /search share, every request goes straight to the /works of the mock.
+    latencies, outcomes, elapsed = asyncio.run(
+        run_load("http://mock", 200, 0.5, 0.0, 50, transport=transport)
+    )
+
+    assert len(latencies["/works"]) == 100 and latencies["/search"] == []
+    assert outcomes["ok"] + outcomes["errors"] == 100
+    assert outcomes["errors"] == mock_openalex.calls["errors"] > 0
+    assert outcomes["ok"] > 0
+    assert mock_openalex.calls["/works"] == 100
+    assert elapsed >= 0.45  # Open loop: the requests are spread over the duration.
@@ -0,0 +1,92 @@
+import asyncio
+import math
+
+import pytest
+
+import MCP.logprob_scoring as logprob_scoring
+from MCP.logprob_scoring import (
+    Calibration,
+    engine_fingerprint,
+    expected_grade,
+    load_calibrations,
+    save_calibration,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_loaded_calibrations(monkeypatch):
+    # The calibrations are loaded once per process, so every test starts without them.
+    monkeypatch.setattr(logprob_scoring, "_calibrations", None)
+
+
+def test_the_grade_is_the_expected_digit():
+    candidates = [
+        {"token": "3", "logprob": math.log(0.5)},
+        {"token": "7", "logprob": math.log(0.25)},
+        # The same digit with a leading space.
+        {"token": " 7", "logprob": math.log(0.25)},
+        {"token": "maybe", "logprob": math.log(0.9)},
+    ]
+    assert expected_grade(candidates) == pytest.approx((3 * 0.5 + 7 * 0.5) / 9)
+    assert expected_grade([{"token": "no", "logprob": 0.0}]) is None
+
+
+def test_the_fitted_calibration_spreads_squeezed_scores():
+    raw = [0.40, 0.42, 0.45, 0.55, 0.58, 0.60]
+    labels = [0, 0, 0, 1, 1, 1]
+    calibration = Calibration.fit(raw, labels)
+
+    def squared_error(score):
+        return sum((score(r) - y) ** 2 for r, y in zip(raw, labels))
+
+    assert squared_error(calibration) < squared_error(Calibration())
+    assert calibration(0.40) < 0.5 < calibration(0.60)
+
+
+def test_calibrations_are_saved_next_to_each_other(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    save_calibration("a_agent", Calibration(2.0, -1.0), path)
+    save_calibration("b_agent", Calibration(0.5, 0.25), path)
+
+    logprob_scoring._calibrations = None  # A new process.
+    calibrations = load_calibrations(path)
+    assert (calibrations["a_agent"].a, calibrations["a_agent"].b) == (2.0, -1.0)
+    assert (calibrations["b_agent"].a, calibrations["b_agent"].b) == (0.5, 0.25)
+
+
+def test_the_fingerprint_changes_with_the_calibration(monkeypatch):
+    monkeypatch.setattr(logprob_scoring, "_calibrations", {})
+    assert engine_fingerprint("generate", "some_agent") == ["generate"]
+    assert engine_fingerprint("logprob", "some_agent") == ["logprob", None]
+    logprob_scoring._calibrations["some_agent"] = Calibration(2.0, 0.5)
+    assert engine_fingerprint("logprob", "some_agent") == ["logprob", 2.0, 0.5]
+
+
+def test_scores_are_calibrated_and_failures_give_none(monkeypatch):
+    monkeypatch.setattr(
+        logprob_scoring, "_calibrations", {"some_agent": Calibration(1.0, 1.0)}
+    )
+    raw_scores = {"fine": 0.5, "no digit": None}
+
+    async def fake_raw_logprob_score(agent_name, prompt, model=None):
+        if prompt == "broken":
+            raise RuntimeError("connection refused")
+        return raw_scores[prompt]
+
+    monkeypatch.setattr(logprob_scoring, "raw_logprob_score", fake_raw_logprob_score)
+
+    async def scores():
+        return [
+            await logprob_scoring.logprob_score(agent_name, prompt)
+            for agent_name, prompt in [
+                ("some_agent", "fine"),
+                ("uncalibrated_agent", "fine"),
+                ("some_agent", "no digit"),
+                ("some_agent", "broken"),
+            ]
+        ]
+
+    calibrated, raw, no_digit, broken = asyncio.run(scores())
+    assert calibrated == pytest.approx(1 / (1 + math.exp(-1)))
+    assert raw == 0.5
+    assert no_digit is None and broken is None
@@ -0,0 +1,108 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import MCP.main as main
+from MCP.types import RequestStatus
+
+
+class _FakeApp:
+    """Stands in for the MCPApp, which would start the MCP servers."""
+
+    @asynccontextmanager
+    async def run(self):
+        logger = SimpleNamespace(info=print, debug=lambda message: None)
+        yield SimpleNamespace(logger=logger)
+
+
+def test_settings_can_be_given_to_the_status():
+    status = RequestStatus(
+        "Why do cats purr?", use_full_text=True, articles_per_batch=4
+    )
+    assert status.settings.use_full_text is True
+    assert status.settings.articles_per_batch == 4
+    with pytest.raises(TypeError, match="use_fulltext"):
+        RequestStatus("Why do cats purr?", use_fulltext=True)
+
+
+def test_main_loop_cleans_up_when_a_stage_raises(monkeypatch):
+    closed = []
+    statuses = []
+
+    def make_status(research_question, paper_limit, **kwargs):
+        # No trace file, and the status is kept to check that it was closed.
+        kwargs.pop("trace_file")
+        status = RequestStatus(research_question, paper_limit, **kwargs)
+        statuses.append(status)
+        return status
+
+    async def broken_stage(status):
+        raise RuntimeError("the stage broke")
+
+    async def close_clients():
+        closed.append("clients")
+
+    async def no_tokenizer():
+        pass
+
+    monkeypatch.setattr(main, "app", _FakeApp())
+    monkeypatch.setattr(main, "is_replaying", lambda: True)
+    monkeypatch.setattr(main, "load_tokenizer", no_tokenizer)
+    monkeypatch.setattr(main, "RequestStatus", make_status)
+    monkeypatch.setattr(main, "run_single_stage", broken_stage)
+    monkeypatch.setattr(main, "close_llm_http_clients", close_clients)
+    monkeypatch.setattr(
+        RequestStatus, "close", lambda self: closed.append("status"), raising=False
+    )
+
+    with pytest.raises(RuntimeError, match="the stage broke"):
+        asyncio.run(
+            main.main_loop(
+                "Why do cats purr?", cluster_papers=True, relevance_engine="logprob"
+            )
+        )
+    assert len(statuses) == 1
+    # The settings of main_loop reach the request.
+    assert statuses[0].settings.cluster_papers is True
+    assert statuses[0].settings.relevance_engine == "logprob"
+    assert closed == ["status", "clients"]
+
+
+def test_try_run_agent_waits_without_blocking_the_loop(monkeypatch):
+    monkeypatch.setattr(main, "retry_delay", 0.2)
+    tries = []
+
+    async def flaky_agent(answer):
+        tries.append(answer)
+        if len(tries) < 3:
+            raise RuntimeError("connection refused")
+        return answer
+
+    async def failing_agent():
+        raise RuntimeError("connection refused")
+
+    async def run():
+        ticks = []
+
+        async def ticker():
+            # Runs only if the retries give the loop back.
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.create_task(ticker())
+        start = asyncio.get_running_loop().time()
+        result = await main.try_run_agent(flaky_agent, 3, "purring")
+        waited = asyncio.get_running_loop().time() - start
+        ticking.cancel()
+        return result, waited, len(ticks)
+
+    result, waited, ticks = asyncio.run(run())
+    assert result == "purring" and len(tries) == 3
+    assert waited >= 0.4 and ticks >= 10
+
+    # No wait after the last try.
+    monkeypatch.setattr(main, "retry_delay", 5.0)
+    assert asyncio.run(main.try_run_agent(failing_agent, 1)) is None
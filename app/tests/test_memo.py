@@ -0,0 +1,112 @@
+import asyncio
+
+import MCP.logprob_scoring as logprob_scoring
+import MCP.memo as memo_module
+from MCP.logprob_scoring import Calibration, engine_fingerprint
+from MCP.memo import StageMemo, memoized, set_memo
+from MCP.types import RequestStages, RequestStatus
+
+stage = RequestStages.CHECKING_LITERATURE_RELEVANCE
+
+
+def test_outputs_are_stored_per_inputs():
+    memo = StageMemo(":memory:")
+    memo.put(stage, ["question", "paper"], float, 0.5)
+    assert memo.get(stage, ["question", "paper"], float) == 0.5
+    assert memo.get(stage, ["question", "other paper"], float) is None
+    assert (memo.hits, memo.misses) == (1, 1)
+
+
+def test_an_output_that_does_not_validate_is_a_miss():
+    memo = StageMemo(":memory:")
+    memo.put(stage, "inputs", str, "not a number")
+    assert memo.get(stage, "inputs", float) is None
+    assert memo.misses == 1
+    memo.put(stage, "inputs", float, 0.5)  # The next computation overwrites it.
+    assert memo.get(stage, "inputs", float) == 0.5
+
+
+def test_bumping_a_stage_invalidates_it_and_later_stages(monkeypatch):
+    memo = StageMemo(":memory:")
+    later = RequestStages.FORMATTING_SURVEY_QUESTIONS
+    memo.put(stage, "inputs", float, 0.5)
+    memo.put(later, "inputs", float, 0.5)
+    earlier = RequestStages.FINDING_LITERATURE
+    monkeypatch.setitem(memo_module.stage_versions, stage, 2)
+    assert memo.get(stage, "inputs", float) is None
+    assert memo.get(later, "inputs", float) is None
+    memo.put(earlier, "inputs", float, 0.5)
+    assert memo.get(earlier, "inputs", float) == 0.5
+
+
+def test_memoized_is_opt_in_and_skips_the_call_on_a_hit():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return 0.5
+
+    async def run(status):
+        return await memoized(status, stage, "inputs", float, call)
+
+    set_memo(StageMemo(":memory:"))
+    try:
+        status = RequestStatus("Why do cats purr?")
+        assert status.settings.memoize_stages is False
+        asyncio.run(run(status))
+        asyncio.run(run(status))
+        assert len(calls) == 2  # Not memoized unless the request asks for it.
+
+        status.settings.memoize_stages = True
+        assert asyncio.run(run(status)) == 0.5
+        assert asyncio.run(run(status)) == 0.5
+        assert len(calls) == 3
+    finally:
+        set_memo(None)
+
+
+def test_the_calibration_is_part_of_the_logprob_fingerprint(monkeypatch):
+    agent = "check_literature_relevance_logprob_agent"
+    monkeypatch.setattr(logprob_scoring, "_calibrations", {})
+    assert engine_fingerprint("generate", agent) == ["generate"]
+    uncalibrated = engine_fingerprint("logprob", agent)
+    logprob_scoring._calibrations[agent] = Calibration(2.0, -1.0)
+    calibrated = engine_fingerprint("logprob", agent)
+    assert uncalibrated != calibrated
+    memo = StageMemo(":memory:")
+    assert memo.key(stage, ["q", calibrated]) != memo.key(stage, ["q", uncalibrated])
+
+
+def test_outputs_of_another_model_are_not_reused():
+    memo = StageMemo(":memory:")
+    memo.put(stage, "inputs", float, 0.5, model="llama3.2")
+    assert memo.get(stage, "inputs", float) is None
+    assert memo.get(stage, "inputs", float, model="llama3.2") == 0.5
+    # The default model is the same whether it is named or not.
+    memo.put(stage, "inputs", float, 0.25)
+    assert memo.get(stage, "inputs", float, model=memo_module.DEFAULT_MODEL) == 0.25
+
+
+def test_memoized_uses_the_memo_from_threads():
+    async def call():
+        return 0.5
+
+    async def run(status):
+        # Many items of a stage look up the memo at the same time.
+        return await asyncio.gather(
+            *(
+                memoized(status, stage, i % 5, float, call, model="llama3.2")
+                for i in range(50)
+            )
+        )
+
+    memo = StageMemo(":memory:")
+    set_memo(memo)
+    try:
+        status = RequestStatus("Why do cats purr?")
+        status.settings.memoize_stages = True
+        assert asyncio.run(run(status)) == [0.5] * 50
+        assert memo.get(stage, 3, float, model="llama3.2") == 0.5
+        assert memo.hits + memo.misses == 51
+    finally:
+        set_memo(None)
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from MCP.ollama import NoBackendAvailable, OllamaBackendPool
+
+
+def test_calls_go_to_the_least_loaded_backend():
+    pool = OllamaBackendPool(["http://a", "http://b"])
+    first = pool.acquire("qwen3:0.6b")
+    second = pool.acquire("qwen3:0.6b")
+    assert {first.base_url, second.base_url} == {"http://a", "http://b"}
+
+
+def test_backends_with_the_model_loaded_are_preferred():
+    pool = OllamaBackendPool(["http://a", "http://b"], affinity_slack=2)
+    pool.backends[1].loaded_models.add("qwen3:0.6b")
+    chosen = [pool.acquire("qwen3:0.6b").base_url for _ in range(3)]
+    # b takes calls until it has more than affinity_slack calls more than a.
+    assert chosen == ["http://b", "http://b", "http://b"]
+    assert pool.acquire("qwen3:0.6b").base_url == "http://a"
+
+
+def _fail(pool: OllamaBackendPool, times: int):
+    for _ in range(times):
+        backend = pool.acquire("qwen3:0.6b")
+        pool.release(backend, "qwen3:0.6b", failed=True)
+
+
+def test_failing_backend_is_ejected_and_readmitted_half_open():
+    pool = OllamaBackendPool(["http://a"], max_failures=3, ejection_time=0.05)
+    _fail(pool, 3)
+    with pytest.raises(NoBackendAvailable):
+        pool.acquire("qwen3:0.6b")
+
+    time.sleep(0.06)
+    # Without any health check, a single trial call is let through...
+    trial = pool.acquire("qwen3:0.6b")
+    with pytest.raises(NoBackendAvailable):
+        pool.acquire("qwen3:0.6b")
+    # ... and readmits the backend once it worked.
+    pool.release(trial, "qwen3:0.6b", failed=False)
+    assert trial.ejected_until is None
+    pool.acquire("qwen3:0.6b")
+    pool.acquire("qwen3:0.6b")
+
+
+def test_failed_trial_ejects_the_backend_again():
+    pool = OllamaBackendPool(["http://a"], max_failures=3, ejection_time=0.05)
+    _fail(pool, 3)
+    time.sleep(0.06)
+    _fail(pool, 1)
+    with pytest.raises(NoBackendAvailable):
+        pool.acquire("qwen3:0.6b")
+
+
+def test_a_cancelled_trial_does_not_readmit_the_backend():
+    pool = OllamaBackendPool(["http://a"], max_failures=3, ejection_time=0.05)
+    _fail(pool, 3)
+    time.sleep(0.06)
+
+    async def trial(started: asyncio.Event):
+        async with pool.backend("qwen3:0.6b"):
+            started.set()
+            await asyncio.sleep(10)
+
+    async def main():
+        started = asyncio.Event()
+        task = asyncio.create_task(trial(started))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    backend = pool.backends[0]
+    assert backend.ejected_until is not None
+    assert backend.outstanding == 0 and not backend.loaded_models
+    # It is still half-open, so the next call may try it.
+    pool.acquire("qwen3:0.6b")
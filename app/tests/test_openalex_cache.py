@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import time
+
+import httpx
+
+import literature_access.cache as cache_module
+from literature_access.cache import (
+    CachedOpenAlex,
+    RateLimiter,
+    ResponseCache,
+    cache_key,
+)
+
+BASE_URL = "https://openalex.test/works?"
+
+
+def _client(tmp_path, handler) -> CachedOpenAlex:
+    openalex = CachedOpenAlex(
+        BASE_URL,
+        "me@example.org",
+        ResponseCache(str(tmp_path / "cache.sqlite")),
+        RateLimiter(1000),
+    )
+    openalex._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return openalex
+
+
+def _age(openalex: CachedOpenAlex, params: dict, seconds: float):
+    """Makes the cached response of the parameters look as old as given."""
+    with openalex.cache._connection as connection:
+        connection.execute(
+            "UPDATE responses SET fetched_at = ? WHERE key = ?",
+            (time.time() - seconds, cache_key(BASE_URL, params)),
+        )
+
+
+def test_keys_ignore_case_whitespace_order_and_the_mail():
+    assert cache_key(BASE_URL, {"search": "Sleep  Quality", "per_page": 5}) == (
+        cache_key(BASE_URL, {"per_page": "5", "search": "sleep quality", "mailto": "x"})
+    )
+    assert cache_key(BASE_URL, {"search": "sleep"}) != cache_key(
+        BASE_URL, {"search": "coffee"}
+    )
+
+
+def test_fresh_responses_come_from_the_cache_and_misses_share_a_request(tmp_path):
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"results": [1]}, headers={"ETag": "v1"})
+
+    openalex = _client(tmp_path, handler)
+
+    async def main():
+        first = await asyncio.gather(
+            *(openalex.get({"search": "sleep"}) for _ in range(5))
+        )
+        again = await openalex.get({"search": "SLEEP"})
+        await openalex.close()
+        return first, again
+
+    first, again = asyncio.run(main())
+    assert first == [{"results": [1]}] * 5
+    assert again == {"results": [1]}
+    assert len(requests) == 1
+    assert requests[0].url.params["mailto"] == "me@example.org"
+
+
+def test_stale_responses_are_answered_and_revalidated_in_the_background(tmp_path):
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        if request.headers.get("If-None-Match") == "v1":
+            return httpx.Response(304)
+        return httpx.Response(200, json={"results": [1]}, headers={"ETag": "v1"})
+
+    openalex = _client(tmp_path, handler)
+
+    async def main():
+        await openalex.get({"search": "sleep"})
+        _age(openalex, {"search": "sleep"}, cache_module.fresh_seconds + 1)
+        stale = await openalex.get({"search": "sleep"})
+        await asyncio.sleep(0.05)  # The background refresh.
+        entry = openalex.cache.get(cache_key(BASE_URL, {"search": "sleep"}))
+        await openalex.close()
+        return stale, entry
+
+    stale, entry = asyncio.run(main())
+    assert stale == {"results": [1]}
+    assert len(requests) == 2
+    assert requests[1].headers["If-None-Match"] == "v1"
+    assert entry.age() < cache_module.fresh_seconds  # Fresh again after the 304.
+
+
+def test_a_very_old_response_is_used_when_openalex_fails(tmp_path):
+    failing = False
+
+    async def handler(request):
+        if failing:
+            return httpx.Response(503)
+        return httpx.Response(200, json={"results": [1]})
+
+    openalex = _client(tmp_path, handler)
+
+    async def main():
+        nonlocal failing
+        await openalex.get({"search": "sleep"})
+        _age(
+            openalex,
+            {"search": "sleep"},
+            cache_module.fresh_seconds + cache_module.stale_seconds + 1,
+        )
+        failing = True
+        old = await openalex.get({"search": "sleep"})
+        try:
+            await openalex.get({"search": "coffee"})
+        except httpx.HTTPError:
+            missing = None
+        else:
+            missing = "answered"
+        await openalex.close()
+        return old, missing
+
+    old, missing = asyncio.run(main())
+    assert old == {"results": [1]}
+    assert missing is None  # Nothing to fall back on.
+
+
+def test_the_least_recently_used_responses_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=10**9)
+    filler = {"text": "".join(chr(33 + (i * 7919) % 90) for i in range(5000))}
+    for key in ("a", "b", "c"):
+        cache.put(key, filler, None, None)
+        time.sleep(0.01)
+    size = cache._total_bytes // 3
+    cache.get("a")  # Now b is the least recently used.
+    cache.max_bytes = int(size * 3.5)
+    cache.put("d", filler, None, None)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("d") is not None
+    cache.close()
+
+
+def test_the_cache_is_not_used_on_the_event_loop(tmp_path):
+    async def handler(request):
+        return httpx.Response(200, json={"results": [1]})
+
+    openalex = _client(tmp_path, handler)
+    threads = []
+    for name in ("get", "put"):
+        original = getattr(openalex.cache, name)
+
+        def record(*args, original=original):
+            threads.append(threading.get_ident())
+            return original(*args)
+
+        setattr(openalex.cache, name, record)
+
+    async def main():
+        await openalex.get({"search": "sleep"})
+        await openalex.get({"search": "sleep"})
+        await openalex.close()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    assert len(threads) == 3  # A miss, the put and a hit.
+    assert loop_thread not in threads
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import time
+
+import MCP.agents.base as agent_base
+import MCP.main as main
+from MCP.profile import StageProfiler, StandInModel, stand_in_embedding_size
+from MCP.types import Article, SurveyQuestion
+
+
+def test_the_stand_in_model_answers_the_same_prompt_the_same_way():
+    model = StandInModel(latency=0.0)
+
+    async def answers():
+        return [
+            await model.replay(
+                "some_agent", None, "Question: Do you sleep well?", float
+            ),
+            await model.replay(
+                "some_agent", None, "Question: Do you sleep well?", float
+            ),
+            await model.replay(
+                "some_agent", None, "Limit the number of articles to 3.", list[Article]
+            ),
+            await model.replay(
+                "some_agent", None, "Question: Do you sleep well?", SurveyQuestion
+            ),
+            await model.replay(
+                "embed", None, json.dumps(["a", "b", "a"]), list[list[float]]
+            ),
+        ]
+
+    score, same_score, articles, question, embeddings = asyncio.run(answers())
+    assert 0 <= score <= 1 and score == same_score
+    assert len(articles) == 3
+    assert question.question == "Do you sleep well?"
+    assert len(embeddings) == 3 and len(embeddings[0]) == stand_in_embedding_size
+    assert embeddings[0] == embeddings[2] != embeddings[1]
+
+
+def test_the_stand_in_model_fails_when_asked_to():
+    model = StandInModel(latency=0.0, failure_rate=1.0)
+    assert asyncio.run(model.replay("some_agent", None, "Question: ?", float)) is None
+
+
+def test_the_profiler_finds_the_stage_that_blocks_the_loop(monkeypatch):
+    # attach() replaces these, so they are put back after the test.
+    monkeypatch.setattr(main, "run_single_stage", main.run_single_stage)
+    monkeypatch.setattr(agent_base, "_run_ollama_agent", agent_base._run_ollama_agent)
+
+    async def blocking_request():
+        await asyncio.sleep(0.1)
+        time.sleep(0.5)  # A synchronous call in the middle of the request.
+        await asyncio.sleep(0.1)
+
+    profiler = StageProfiler(trace_memory=False)
+    asyncio.run(profiler.run(blocking_request()))
+
+    assert [window.stage for window in profiler.windows] == ["setup"]
+    assert profiler.windows[0].wall >= 0.7
+    assert any(
+        stage == "setup" and "blocking_request" in stack
+        for stage, stack in profiler.blocking_stacks
+    )
+    report = profiler.report("Test run")
+    assert "setup" in report and "never" not in report
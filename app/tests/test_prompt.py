@@ -0,0 +1,112 @@
+import asyncio
+
+import MCP.prompt as prompt
+from MCP.prompt import TRIM_MARKER, build_prompt, count_tokens, trim_to_tokens
+
+
+class _CharTokenizer:
+    """Every character is a token."""
+
+    class _Encoding:
+        def __init__(self, text):
+            self.ids = list(range(len(text)))
+
+    def encode(self, text, add_special_tokens=False):
+        return self._Encoding(text)
+
+
+def test_trim_keeps_first_and_last_sentence():
+    text = " ".join(f"Sentence number {i} is here." for i in range(40))
+    trimmed = trim_to_tokens(text, 30)
+    assert count_tokens(trimmed) <= 30
+    assert trimmed.startswith("Sentence number 0")
+    assert trimmed.endswith("Sentence number 39 is here.")
+    assert TRIM_MARKER in trimmed
+
+
+def test_build_prompt_trims_to_the_budget(monkeypatch):
+    monkeypatch.setitem(prompt.agent_token_budgets, "test_agent", 60)
+    abstract = " ".join(f"Sentence number {i} is here." for i in range(100))
+    text = build_prompt(
+        "test_agent",
+        "Q: {question}\nA: {abstract}",
+        ("abstract",),
+        question="Why?",
+        abstract=abstract,
+    )
+    assert count_tokens(text) <= 60
+    assert text.startswith("Q: Why?\nA: Sentence number 0")
+
+
+def test_build_prompt_counts_with_the_tokenizer_of_the_given_model(monkeypatch):
+    monkeypatch.setitem(prompt.agent_token_budgets, "test_agent", 100)
+    monkeypatch.setitem(
+        prompt._tokenizers, prompt.tokenizer_repositories["llama3.2"], _CharTokenizer()
+    )
+    count_tokens.cache_clear()
+    abstract = " ".join(f"Sentence number {i} is here." for i in range(30))
+    try:
+        default = build_prompt(
+            "test_agent", "{abstract}", ("abstract",), abstract=abstract
+        )
+        llama = build_prompt(
+            "test_agent",
+            "{abstract}",
+            ("abstract",),
+            model="llama3.2:1b",
+            abstract=abstract,
+        )
+    finally:
+        count_tokens.cache_clear()
+    # One token per character is much more than the estimate, so the prompt for llama is trimmed much shorter.
+    assert len(llama) <= 100 < len(default)
+
+
+def test_failed_tokenizer_download_falls_back_to_estimates(monkeypatch):
+    monkeypatch.setattr(prompt, "_tokenizers", {})
+    monkeypatch.setattr(prompt, "_download_tokenizer", lambda repository: None)
+    asyncio.run(prompt.load_tokenizer("qwen3:0.6b"))
+    assert prompt._tokenizers == {prompt.tokenizer_repositories["qwen3"]: None}
+    assert count_tokens("abcdefgh", "qwen3:0.6b") == 2
+
+
+def test_token_log_errors_are_not_raised(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        prompt, "TOKEN_LOG_FILE", str(tmp_path / "missing" / "log.jsonl")
+    )
+    monkeypatch.setattr(prompt, "_token_log_buffer", [])
+    prompt.record_token_usage("test_agent", None, "Some prompt", 0.1)
+    prompt.flush_token_usage()
+
+    monkeypatch.setattr(prompt, "TOKEN_LOG_FILE", str(tmp_path / "log.jsonl"))
+    prompt.record_token_usage("test_agent", None, "Some prompt", 0.1, 5)
+    prompt.flush_token_usage()
+    assert '"completion_tokens": 5' in (tmp_path / "log.jsonl").read_text()
+
+
+def test_token_usage_is_written_in_batches(monkeypatch, tmp_path):
+    log = tmp_path / "log.jsonl"
+    monkeypatch.setattr(prompt, "TOKEN_LOG_FILE", str(log))
+    monkeypatch.setattr(prompt, "TOKEN_LOG_BATCH", 3)
+    monkeypatch.setattr(prompt, "_token_log_buffer", [])
+
+    async def calls(count):
+        for i in range(count):
+            prompt.record_token_usage("test_agent", None, f"Prompt {i}", 0.1)
+
+    # Nothing is written until the batch is full.
+    asyncio.run(calls(2))
+    assert not log.exists()
+    # The full batch is written from a thread, which asyncio.run waits for.
+    asyncio.run(calls(2))
+    assert len(log.read_text().splitlines()) == 3
+    # The rest is written at shutdown.
+    prompt.flush_token_usage()
+    assert len(log.read_text().splitlines()) == 4
+    prompt.flush_token_usage()
+    assert len(log.read_text().splitlines()) == 4
+
+    # An old entry is written with the next call, even if the batch isn't full.
+    monkeypatch.setattr(prompt, "TOKEN_LOG_FLUSH_INTERVAL", 0.0)
+    prompt.record_token_usage("test_agent", None, "Prompt", 0.1)
+    assert len(log.read_text().splitlines()) == 5
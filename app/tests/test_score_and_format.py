@@ -0,0 +1,85 @@
+import asyncio
+
+import MCP.agents.check_question_relevance as check_question_relevance
+import MCP.agents.score_and_format_question as score_and_format_question
+from MCP.steps import next_step
+from MCP.types import (
+    Article,
+    RequestStages,
+    RequestStatus,
+    ScoredSurveyQuestion,
+    SurveyQuestion,
+)
+
+
+def _status(n: int = 2) -> RequestStatus:
+    status = RequestStatus("How do people sleep?", paper_limit=1)
+    status.settings.question_per_article = n
+    status.settings.max_attempts = 1
+    status.add_papers(
+        [Article(title="Sleep", author="A", abstract="...", url="u")], [0.9]
+    )
+    status.questions = [
+        (
+            SurveyQuestion(question=f"Question {i}?", answer_type=None, options=None),
+            None,
+        )
+        for i in range(n)
+    ]
+    return status
+
+
+def test_the_fused_stage_is_only_used_with_generated_scores():
+    status = _status()
+    assert next_step(status)[3] == RequestStages.CHECKING_QUESTION_RELEVANCE
+    status.settings.fuse_question_stages = True
+    assert next_step(status)[3] == RequestStages.SCORING_AND_FORMATTING_SURVEY_QUESTIONS
+    status.settings.relevance_engine = "logprob"
+    assert next_step(status)[3] == RequestStages.CHECKING_QUESTION_RELEVANCE
+
+
+def test_the_fused_stage_formats_only_relevant_questions(monkeypatch):
+    async def score_and_format(question, research_question, threshold):
+        relevance = 0.9 if question == "Question 0?" else 0.1
+        return ScoredSurveyQuestion(
+            relevance=relevance, answer_type="Yes/No", options=["Yes", "No"]
+        )
+
+    monkeypatch.setattr(
+        score_and_format_question,
+        "run_score_and_format_question_agent",
+        score_and_format,
+    )
+    status = _status()
+    status.settings.question_relevance_threshold = 0.5
+    status, _ = asyncio.run(
+        score_and_format_question.run_all_score_and_format_question_agent(status)
+    )
+
+    (relevant, relevant_score), (other, other_score) = status.questions
+    assert (relevant_score, relevant.answer_type) == (0.9, "Yes/No")
+    assert (other_score, other.answer_type) == (0.1, None)
+    assert next_step(status) is None  # The irrelevant question is never formatted.
+
+
+def test_logprob_scores_with_fusion_say_that_fusion_is_off(monkeypatch):
+    engines = []
+
+    async def check(question, research_question, engine):
+        engines.append(engine)
+        return 0.7
+
+    monkeypatch.setattr(
+        check_question_relevance, "run_check_question_relevance_agent", check
+    )
+    status = _status()
+    status.settings.fuse_question_stages = True
+    status.settings.relevance_engine = "logprob"
+    status, step_info = asyncio.run(
+        check_question_relevance.run_all_check_question_relevance_agent(status)
+    )
+
+    assert engines == ["logprob", "logprob"]
+    assert [score for _, score in status.questions] == [0.7, 0.7]
+    assert any("fuse_question_stages" in warning for warning in step_info.warnings)
+    assert next_step(status)[3] == RequestStages.FORMATTING_SURVEY_QUESTIONS
@@ -0,0 +1,56 @@
+import httpx
+from fastapi.testclient import TestClient
+
+import literature_access.main as service
+from literature_access.fusion import reciprocal_rank_fusion, work_key
+
+
+def test_works_are_recognized_by_id_doi_or_title():
+    assert work_key({"id": "https://openalex.org/w1"}) == "W1"
+    assert work_key({"doi": "https://doi.org/10.1/ABC"}) == "doi:10.1/abc"
+    assert work_key({"title": "Sleep  Quality"}) == "title:sleep quality"
+    assert work_key({}) is None
+
+
+def test_works_found_by_several_queries_rank_first():
+    fused = reciprocal_rank_fusion(
+        {
+            "sleep": [{"id": "W1"}, {"id": "W2"}, {"id": "W1"}],
+            "coffee": [{"id": "W3"}, {"id": "W2"}],
+            "other": [{}],  # Can't be recognized, so it is dropped.
+        },
+        k=60,
+    )
+    assert [work["id"] for work in fused] == ["W2", "W1", "W3"]
+    assert fused[0]["matched_queries"] == ["sleep", "coffee"]
+    assert fused[0]["fusion_score"] == 1 / 62 + 1 / 62
+    assert (
+        fused[1]["fusion_score"] == 1 / 61
+    )  # The duplicate in "sleep" only counts once.
+
+
+def test_multi_search_deduplicates_queries_and_reports_failures(monkeypatch):
+    asked = []
+
+    async def search(params):
+        asked.append(params["search"])
+        if params["search"] == "broken":
+            raise httpx.ConnectError("down")
+        return {"results": [{"id": f"W-{params['search']}"}, {"id": "W-common"}]}
+
+    monkeypatch.setattr(service, "search_works", search)
+    client = TestClient(service.app)
+    answer = client.get(
+        "/search/multi",
+        params={"q": ["sleep", " Sleep ", "coffee", "broken"], "limit": 2},
+    ).json()
+
+    assert answer["queries"] == ["sleep", "coffee", "broken"]
+    assert sorted(asked) == ["broken", "coffee", "sleep"]
+    assert [work["id"] for work in answer["results"]] == ["W-common", "W-sleep"]
+    assert list(answer["errors"]) == ["broken"]
+
+    too_many = client.get(
+        "/search/multi", params={"q": [f"q{i}" for i in range(service.MAX_QUERIES + 1)]}
+    ).json()
+    assert "error" in too_many
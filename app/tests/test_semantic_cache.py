@@ -0,0 +1,85 @@
+import asyncio
+import sqlite3
+
+import numpy as np
+
+import MCP.semantic_cache as semantic_cache
+from MCP.semantic_cache import (
+    SemanticCache,
+    remember_request,
+    seed_from_similar_request,
+)
+from MCP.types import Article, RequestStatus
+
+
+def _unit(*values: float) -> np.ndarray:
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_only_rows_of_the_same_model_and_dimension_are_searched(tmp_path):
+    cache = SemanticCache(str(tmp_path / "cache.sqlite"))
+    cache.add("three", _unit(1, 0, 0), [["a", 0.5]], model="small")
+    cache.add("four", _unit(1, 0, 0, 0), [["b", 0.5]], model="big")
+    cache.add("other", _unit(1, 0, 0), [["c", 0.5]], model="other")
+
+    # A fresh cache loads the mixed rows from the file, which must not crash on the different dimensions.
+    cache = SemanticCache(cache.path)
+    assert cache.nearest(_unit(1, 0, 0), model="small")[0] == "three"
+    assert cache.nearest(_unit(1, 0, 0, 0), model="big")[0] == "four"
+    assert cache.nearest(_unit(1, 0, 0, 0), model="small") is None
+    assert cache.nearest(_unit(0, 1, 0), model="small") is None  # Too far away.
+
+    # Rows added after the index was loaded are found as well.
+    cache.add("three again", _unit(0, 1, 0), [], model="small")
+    assert cache.nearest(_unit(0, 1, 0), model="small")[0] == "three again"
+
+
+def test_old_caches_without_a_model_column_are_migrated(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE requests (id INTEGER PRIMARY KEY, question TEXT NOT NULL, embedding BLOB NOT NULL, papers TEXT NOT NULL)"
+        )
+        connection.execute(
+            "INSERT INTO requests (question, embedding, papers) VALUES (?, ?, ?)",
+            ("old", _unit(1, 0, 0).tobytes(), "[]"),
+        )
+    connection.close()
+
+    cache = SemanticCache(path)
+    assert cache.nearest(_unit(1, 0, 0)) is None  # The model of the old row is unknown.
+    cache.add("new", _unit(1, 0, 0), [])
+    assert cache.nearest(_unit(1, 0, 0))[0] == "new"
+
+
+def test_requests_only_reuse_and_remember_papers_when_they_opt_in(
+    tmp_path, monkeypatch
+):
+    cache = SemanticCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(semantic_cache, "_cache", cache)
+
+    async def fake_embed(texts, model):
+        return [[1.0, 0.0, 0.0] for _ in texts]
+
+    monkeypatch.setattr(semantic_cache, "embed", fake_embed)
+
+    async def run():
+        first = RequestStatus("Why do cats purr?")
+        first.add_papers(
+            [Article(title="Purring", author="A", abstract="...", url="u")], [0.8]
+        )
+        await remember_request(first)
+        assert cache.nearest(_unit(1, 0, 0)) is None  # Not opted in.
+
+        first.settings.reuse_similar_requests = True
+        await remember_request(first)
+
+        second = RequestStatus("Why do cats make that purring sound?")
+        assert await seed_from_similar_request(second) == "Why do cats purr?"
+        assert second.get_paper(0).title == "Purring"
+        assert second.paper_relevances() == [None]
+
+    asyncio.run(run())
+    assert RequestStatus("q").settings.reuse_similar_requests is False
@@ -0,0 +1,100 @@
+import asyncio
+
+import MCP.agents.base as agent_base
+from MCP.agents.base import run_basic_ollama_agent
+from MCP.speculation import current_attempt
+
+
+def _fake_agent(monkeypatch, latency: float = 0.05):
+    """Replaces the actual agent run, counting the calls that really reach the model."""
+    calls = []
+
+    async def run(name, prompt, server_list, custom_llm, output_type):
+        calls.append(prompt)
+        await asyncio.sleep(latency)
+        return f"answer to {prompt}"
+
+    monkeypatch.setattr(agent_base, "_run_ollama_agent", run)
+    return calls
+
+
+def _call(prompt: str):
+    return run_basic_ollama_agent(
+        name="agent", prompt=prompt, server_list=[], output_type=str
+    )
+
+
+def test_identical_running_calls_are_shared(monkeypatch):
+    calls = _fake_agent(monkeypatch)
+
+    async def main():
+        return await asyncio.gather(_call("a"), _call("a"), _call("a"), _call("b"))
+
+    assert asyncio.run(main()) == ["answer to a"] * 3 + ["answer to b"]
+    assert sorted(calls) == ["a", "b"]
+    assert agent_base._in_flight == {}
+
+
+def test_finished_calls_are_not_reused(monkeypatch):
+    calls = _fake_agent(monkeypatch, latency=0.0)
+
+    async def main():
+        await _call("a")
+        await _call("a")
+
+    asyncio.run(main())
+    assert calls == ["a", "a"]
+
+
+def test_a_backup_attempt_does_not_join_the_call_it_backs_up(monkeypatch):
+    calls = _fake_agent(monkeypatch)
+
+    async def backup():
+        current_attempt.set(2)
+        return await _call("a")
+
+    async def main():
+        return await asyncio.gather(_call("a"), asyncio.create_task(backup()))
+
+    asyncio.run(main())
+    assert calls == ["a", "a"]
+
+
+def test_cancelling_one_waiter_keeps_the_call_for_the_others(monkeypatch):
+    calls = _fake_agent(monkeypatch, latency=0.1)
+
+    async def main():
+        first = asyncio.create_task(_call("a"))
+        second = asyncio.create_task(_call("a"))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await asyncio.gather(first, second, return_exceptions=True)
+
+    first, second = asyncio.run(main())
+    assert isinstance(first, asyncio.CancelledError)
+    assert second == "answer to a"
+    assert calls == ["a"]
+
+
+def test_cancelling_the_last_waiter_cancels_the_call(monkeypatch):
+    cancelled = []
+
+    async def run(name, prompt, server_list, custom_llm, output_type):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(prompt)
+            raise
+
+    monkeypatch.setattr(agent_base, "_run_ollama_agent", run)
+
+    async def main():
+        waiter = asyncio.create_task(_call("a"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert cancelled == ["a"]
+    assert agent_base._in_flight == {}
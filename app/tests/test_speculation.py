@@ -0,0 +1,86 @@
+import asyncio
+
+import MCP.agents.base as agent_base
+import MCP.speculation as speculation
+from MCP.limiter import AdaptiveLimiter
+from MCP.speculation import LatencyTracker, SpeculationBudget, run_speculatively
+
+
+def _fresh_speculation(monkeypatch, name: str, latency: float):
+    tracker = LatencyTracker()
+    for _ in range(speculation.min_latency_samples):
+        tracker.record(name, latency)
+    monkeypatch.setattr(speculation, "latency_tracker", tracker)
+    monkeypatch.setattr(speculation, "budget", SpeculationBudget(share=1.0, burst=10.0))
+
+
+def test_failed_attempt_is_replaced():
+    calls = 0
+
+    async def attempt():
+        nonlocal calls
+        calls += 1
+        return None if calls == 1 else "ok"
+
+    assert asyncio.run(run_speculatively("agent", attempt, 2)) == "ok"
+    assert calls == 2
+
+
+def test_all_attempts_failing_returns_none():
+    async def attempt():
+        raise ValueError("broken")
+
+    assert asyncio.run(run_speculatively("agent", attempt, 3)) is None
+
+
+def test_slow_attempt_is_backed_up(monkeypatch):
+    _fresh_speculation(monkeypatch, "agent", 0.01)
+    cancelled = []
+
+    async def attempt():
+        if speculation.current_attempt.get() == 1:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+        return "backup"
+
+    assert asyncio.run(run_speculatively("agent", attempt, 2)) == "backup"
+    assert cancelled == [True]
+
+
+def test_hedges_do_not_lower_the_llm_limit(monkeypatch):
+    """The losing attempts are cancelled inside their limiter slot, which must not count as congestion."""
+    _fresh_speculation(monkeypatch, "hedged_agent", 0.01)
+    limiter = AdaptiveLimiter(initial_limit=4, window=2)
+    monkeypatch.setattr(agent_base, "llm_limiter", limiter)
+    monkeypatch.setattr(agent_base, "record_token_usage", lambda *args: None)
+    monkeypatch.setattr(agent_base, "get_cassette", lambda: None)
+
+    async def call(name, prompt, server_list, custom_llm, output_type):
+        # The first attempt hangs, the backup answers right away.
+        if speculation.current_attempt.get() == 1:
+            await asyncio.sleep(10)
+        await asyncio.sleep(0.001)
+        return "answer"
+
+    monkeypatch.setattr(agent_base, "_call_ollama_agent", call)
+
+    async def main():
+        for i in range(4):
+            result = await run_speculatively(
+                "hedged_agent",
+                lambda: agent_base.run_basic_ollama_agent(
+                    "hedged_agent", f"prompt {i}", []
+                ),
+                2,
+            )
+            assert result == "answer"
+        # Give the cancelled attempts the chance to release their slots.
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert limiter.total_failures == 0
+    assert limiter.in_flight == 0
+    assert limiter.limit >= 4
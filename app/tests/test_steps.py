@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import MCP.agents.create_survey_question as create_survey_question
+from MCP.steps import run_step_function
+from MCP.types import RequestStatus, SurveyQuestion
+
+
+def _status_with_questions(n: int, deadline: float | None = None) -> RequestStatus:
+    status = RequestStatus("How do people sleep?", deadline=deadline)
+    status.settings.memoize_stages = False
+    status.settings.max_attempts = 1
+    status.questions = [
+        (SurveyQuestion(question=f"Question {i}?", answer_type=None, options=None), 0.9)
+        for i in range(n)
+    ]
+    return status
+
+
+def test_deadline_keeps_the_finished_items(monkeypatch):
+    """Half of the questions are formatted quickly, the other half would take forever. The deadline cuts the stage off,
+    but the formatted half stays in the request, so it ends with complete questions."""
+
+    async def format_question(question: str, research_question: str):
+        if int(question.split()[1].rstrip("?")) % 2:
+            await asyncio.sleep(10)
+        return SurveyQuestion(
+            question=question, answer_type="Yes/No", options=["Yes", "No"]
+        )
+
+    monkeypatch.setattr(
+        create_survey_question, "run_create_survey_question_agent", format_question
+    )
+    status = _status_with_questions(6, deadline=time.time() + 0.3)
+
+    start = time.monotonic()
+    status, step_info = asyncio.run(
+        run_step_function(
+            status, create_survey_question.run_all_create_survey_questions_agent
+        )
+    )
+
+    assert time.monotonic() - start < 2
+    assert step_info.errors
+    assert sorted(q.question for q, _ in status.complete_questions()) == [
+        "Question 0?",
+        "Question 2?",
+        "Question 4?",
+    ]
+
+
+def test_cancelled_request_stops_the_step(monkeypatch):
+    async def format_question(question: str, research_question: str):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(
+        create_survey_question, "run_create_survey_question_agent", format_question
+    )
+    status = _status_with_questions(2)
+
+    async def main():
+        async def cancel_soon():
+            await asyncio.sleep(0.05)
+            status.cancel()
+
+        asyncio.ensure_future(cancel_soon())
+        return await run_step_function(
+            status, create_survey_question.run_all_create_survey_questions_agent
+        )
+
+    start = time.monotonic()
+    status, step_info = asyncio.run(main())
+    assert time.monotonic() - start < 2
+    assert step_info.errors
+    assert status.complete_questions() == []
+
+
+def test_questions_below_the_default_threshold_are_not_formatted():
+    status = RequestStatus("How do people sleep?")
+    assert status.settings.question_relevance_threshold == 0.5
+    question = SurveyQuestion(question="Question?", answer_type=None, options=None)
+    assert not status.needs_formatting(question, 0.4)
+    assert status.needs_formatting(question, 0.5)
+    assert status.needs_formatting(question, None)  # Not scored yet.
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import MCP.agents.base as agent_base
+from MCP.agents.base import run_basic_ollama_agent
+from MCP.limiter import AdaptiveLimiter
+from MCP.ollama import OllamaBackendPool, close_llm_http_clients
+
+
+def _run_streamed(
+    fake_ollama, monkeypatch, name="check_literature_relevance_agent", limiter=None
+):
+    """Runs a scoring agent over the streaming API of the fake server. Returns the result, the elapsed time and the logged tokens."""
+    logged = []
+    monkeypatch.setattr(
+        agent_base, "backend_pool", OllamaBackendPool([fake_ollama.base_url])
+    )
+    monkeypatch.setattr(agent_base, "llm_limiter", limiter or AdaptiveLimiter())
+    monkeypatch.setattr(
+        agent_base,
+        "record_token_usage",
+        lambda name, model, prompt, latency, tokens: logged.append(tokens),
+    )
+    monkeypatch.setattr(agent_base, "get_cassette", lambda: None)
+    monkeypatch.setitem(agent_base.streaming_agents, name, False)
+
+    async def main():
+        try:
+            start = time.monotonic()
+            result = await run_basic_ollama_agent(
+                name=name, prompt="Score this.", server_list=[], output_type=float
+            )
+            return result, time.monotonic() - start
+        finally:
+            await close_llm_http_clients()
+
+    result, elapsed = asyncio.run(main())
+    return result, elapsed, logged[0]
+
+
+def test_the_stream_is_closed_after_the_first_complete_answer(fake_ollama, monkeypatch):
+    """A model that keeps sending whitespace for 5 s after its answer is not waited for."""
+    fake_ollama.answer = {"value": 0.8}
+    fake_ollama.trailing_chunks = 100
+    fake_ollama.chunk_delay = 0.05
+
+    result, elapsed, tokens = _run_streamed(fake_ollama, monkeypatch)
+
+    assert result == 0.8
+    assert elapsed < 1.0, f"the call took {elapsed:.2f} s"
+    deadline = time.monotonic() + 2
+    while not fake_ollama.closed_early and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fake_ollama.closed_early
+    assert fake_ollama.chunks_sent < 10
+    # The done chunk with the count of Ollama was never read, so the answer was counted with the tokenizer.
+    assert 0 < tokens < 20
+
+
+def test_the_count_of_ollama_is_used_when_the_stream_ends(fake_ollama, monkeypatch):
+    fake_ollama.content = '{"value": '  # The model stops before the answer is complete.
+    fake_ollama.trailing_chunks = 3
+
+    result, _, tokens = _run_streamed(fake_ollama, monkeypatch)
+
+    assert result is None
+    assert tokens == 4  # eval_count of the done chunk, not the tokenizer count.
+
+
+def test_an_invalid_answer_is_not_congestion(fake_ollama, monkeypatch):
+    fake_ollama.content = '{"value": "very relevant"}'
+    limiter = AdaptiveLimiter()
+
+    result, _, _ = _run_streamed(fake_ollama, monkeypatch, limiter=limiter)
+
+    assert result is None
+    assert limiter.total_calls == 1 and limiter.total_failures == 0
+
+
+def test_an_unreachable_server_is_congestion(fake_ollama, monkeypatch):
+    fake_ollama.base_url = "http://127.0.0.1:1"  # Nothing listens there.
+    limiter = AdaptiveLimiter()
+
+    result, _, _ = _run_streamed(fake_ollama, monkeypatch, limiter=limiter)
+
+    assert result is None
+    assert limiter.total_calls == 1 and limiter.total_failures == 1
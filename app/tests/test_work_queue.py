@@ -0,0 +1,157 @@
+import asyncio
+
+import MCP.work_queue as work_queue
+import MCP.worker as worker
+from MCP.types import Article, RequestStages, RequestStatus, StepInformation
+from MCP.work_queue import WorkQueue, run_stage_on_queue
+
+stage = RequestStages.CHECKING_LITERATURE_RELEVANCE
+
+
+def _status(**kwargs) -> RequestStatus:
+    status = RequestStatus("Why do cats purr?", **kwargs)
+    status.add_papers([Article(title="Paper", author="A", abstract="...", url="u")])
+    return status
+
+
+def test_a_job_goes_to_one_worker_and_back(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    job_id = queue.publish(stage, _status())
+
+    job = queue.lease("worker-1")
+    assert job.id == job_id and job.stage == stage and job.deliveries == 1
+    assert queue.lease("worker-2") is None  # Leased jobs are not handed out twice.
+    assert queue.result(job_id) is None
+
+    done = RequestStatus.from_json(job.payload)
+    done.set_paper_relevance(0, 0.9)
+    assert not queue.ack(job_id, "worker-2", done, StepInformation())
+    assert queue.ack(job_id, "worker-1", done, StepInformation())
+
+    status, info = queue.result(job_id)
+    assert status.paper_relevances() == [0.9]
+    assert not info.errors
+    queue.close()
+
+
+def test_an_expired_lease_is_redelivered_and_the_old_worker_is_ignored(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    job_id = queue.publish(stage, _status())
+
+    assert queue.lease("worker-1", lease_seconds=-1) is not None  # Already expired.
+    job = queue.lease("worker-2")
+    assert job.id == job_id and job.deliveries == 2
+    assert not queue.extend(job_id, "worker-1")
+    assert not queue.ack(job_id, "worker-1", _status(), StepInformation())
+    assert queue.extend(job_id, "worker-2")
+    queue.close()
+
+
+def test_a_job_fails_after_too_many_deliveries(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, "max_deliveries", 2)
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    job_id = queue.publish(stage, _status())
+
+    for owner in ("worker-1", "worker-2"):
+        queue.lease(owner)
+        queue.nack(job_id, owner, "boom")
+    assert queue.lease("worker-3") is None
+
+    status, info = queue.result(job_id)
+    assert status is None
+    assert "boom" in info.errors[0]
+    queue.close()
+
+
+def test_large_run_requests_are_not_published(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    status = _status(article_store=str(tmp_path / "store.sqlite"))
+    try:
+        queue.publish(stage, status)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("publish accepted a large-run request")
+    assert queue.counts() == {}
+    status.close()
+    queue.close()
+
+
+def test_run_stage_on_queue_merges_the_result_of_a_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, "poll_interval", 0.01)
+    path = str(tmp_path / "queue.sqlite")
+    owner_queue = WorkQueue(path)
+    worker_queue = WorkQueue(path)  # Like a separate worker process.
+
+    async def worker():
+        while (job := worker_queue.lease("worker")) is None:
+            await asyncio.sleep(0.01)
+        done = RequestStatus.from_json(job.payload)
+        done.set_paper_relevance(0, 0.3)
+        worker_queue.ack(job.id, "worker", done, StepInformation())
+
+    async def run():
+        status = _status()
+        settings = status.settings
+        (status, _), _ = await asyncio.gather(
+            run_stage_on_queue(owner_queue, status, stage), worker()
+        )
+        return status, settings
+
+    status, settings = asyncio.run(run())
+    assert status.paper_relevances() == [0.3]
+    assert status.settings is settings  # Only the stage results are taken over.
+    assert owner_queue.counts() == {}  # The job is forgotten once merged.
+    owner_queue.close()
+    worker_queue.close()
+
+
+def test_cancelling_the_owner_cancels_the_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, "poll_interval", 0.01)
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+
+    async def run():
+        waiting = asyncio.create_task(run_stage_on_queue(queue, _status(), stage))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+
+    asyncio.run(run())
+    assert queue.counts() == {"cancelled": 1}
+    assert queue.lease("worker") is None
+    queue.close()
+
+
+def test_a_crashed_worker_leaves_its_finished_items_to_the_next_one(
+    tmp_path, monkeypatch
+):
+    """The worker saves the status with every lease extension, the next delivery starts from there."""
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    status = _status()
+    status.add_papers([Article(title="Paper 2", author="B", abstract="...", url="v")])
+    job_id = queue.publish(stage, status)
+    job = queue.lease("worker-1", lease_seconds=0.3)
+
+    async def half_done_stage(status):
+        status.set_paper_relevance(0, 0.8)
+        await asyncio.sleep(10)  # The worker "crashes" before the second paper is done.
+
+    monkeypatch.setattr(
+        worker, "next_step", lambda status: ("Checking", None, half_done_stage, stage)
+    )
+
+    async def crash():
+        running = asyncio.create_task(worker.run_job(queue, job, "worker-1", 0.3))
+        await asyncio.sleep(0.25)  # Long enough for one extension.
+        running.cancel()
+        await asyncio.gather(running, return_exceptions=True)
+        await asyncio.sleep(0.35)  # The lease expires.
+
+    asyncio.run(crash())
+    redelivered = queue.lease("worker-2")
+    assert redelivered.id == job_id and redelivered.deliveries == 2
+    assert RequestStatus.from_json(redelivered.payload).paper_relevances() == [
+        0.8,
+        None,
+    ]
+    queue.close()